@@ -20,7 +20,7 @@ Todo:
 
 import json
 from functools import cached_property
-from collections import deque
+from collections import deque, OrderedDict
 import datetime
 import sys
 import argparse
@@ -29,10 +29,35 @@ import sqlite3
 import hashlib
 import string
 import re
+import pickle
+import io
+import codecs
+import mmap
 from functools import cached_property
-from dataclasses import dataclass
-from typing import Iterator, Union, Callable, Type
+from dataclasses import dataclass, field
+from typing import Any, Iterator, Union, Callable, Type
 import subprocess as sp
+import atexit
+import contextlib
+import glob
+import multiprocessing
+import multiprocessing.util
+import os
+import shutil
+import signal
+import socketserver
+import tempfile
+import threading
+import time
+import http.client
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+
+
+# Bump this whenever the bytecode classes or the way programs are parsed change, so stale entries
+# in the program cache are ignored.
+INTERPRETER_VERSION = "5"
 
 
 def log(msg: str) -> None:
@@ -41,7 +66,144 @@ def log(msg: str) -> None:
 
 # Computation model
 
-CompiledIterator = Union[deque[str | dict[str, str]], "InfiniteIterator"]
+class ItemDeque(deque):
+    """
+    The items a loop goes over. The list they came from is kept, so a checkpoint can refer to the
+    list saved by an earlier checkpoint, and only record how many of the items are left.
+    """
+
+    __slots__ = ("items",)
+
+    def __init__(self, items: list, start: int = 0) -> None:
+        super().__init__(items[start:] if start > 0 else items)
+        self.items = items
+
+
+CompiledIterator = Union[
+    deque[str | dict[str, str]], "InfiniteIterator", "StreamingLineIterator", "MappedLineIterator", "SQLRowIterator"
+]
+# Variables hold a str, text that an LLM is still generating, the contents of a file, or text
+# that's been built up by appending
+Value = Union[str, "StreamingText", "MappedText", "RopeText"]
+NonAlphanumeric = re.compile(r"[^a-z0-9]+")
+
+
+class Frame:
+    """
+    A procedure call in progress. Frames are updated in place as execution moves through the
+    procedure's bytecode.
+    """
+
+    __slots__ = ("name", "code", "idx")
+
+    def __init__(self, name: str, code: list["BaseByteCode"], idx: int = 0) -> None:
+        self.name = name
+        self.code = code
+        self.idx = idx
+
+
+class Environment:
+    """
+    The stack of variable scopes. Next to the stack it keeps the currently visible value of every
+    variable, so lookups don't walk the stack. Each scope remembers the values it hid when it set
+    a variable, and popping the scope puts them back.
+    """
+
+    __slots__ = ("layers", "hidden", "visible")
+
+    def __init__(self) -> None:
+        self.layers: list[dict[str, Value]] = [{}]
+        self.hidden: list[dict[str, Value | None]] = [{}]
+        self.visible: dict[str, Value] = {}
+
+    @classmethod
+    def based_on(cls, visible: dict[str, Value]) -> "Environment":
+        """
+        An environment that starts out seeing the given variables, but whose only scope holds
+        just the variables set in it.
+        """
+        result = cls()
+        result.visible = dict(visible)
+        return result
+
+    def __len__(self) -> int:
+        return len(self.layers)
+
+    def get(self, name: str) -> Value:
+        return self.visible.get(name, "")
+
+    def set(self, name: str, value: Value) -> None:
+        layer = self.layers[-1]
+        if name not in layer:
+            self.hidden[-1][name] = self.visible.get(name)
+        layer[name] = value
+        self.visible[name] = value
+
+    def push(self) -> None:
+        self.layers.append({})
+        self.hidden.append({})
+
+    def pop(self) -> dict[str, Value]:
+        visible = self.visible
+        for name, value in self.hidden.pop().items():
+            if value is None:
+                del visible[name]
+            else:
+                visible[name] = value
+        return self.layers.pop()
+
+
+class Profiler:
+    """
+    Timings collected for --profile: how long each procedure and kind of bytecode took, how long
+    LLM calls took split by whether they were answered from a cache, and how long each SQL query
+    took. Each table maps a name to [count, seconds]. The iterations of parallel loops are timed
+    as they run side by side, so with parallel loops the totals can add up to more than the run.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.phases: dict[str, float] = {}
+        self.procedures: dict[str, list] = {}
+        self.bytecodes: dict[str, list] = {}
+        self.llm: dict[str, list] = {}
+        self.sql: dict[str, list] = {}
+        # Seconds spent in each bytecode class under each stack of procedure names
+        self.stacks: dict[str, float] = {}
+
+    def add(self, table: dict[str, list], key: str, seconds: float, count: int = 1) -> None:
+        with self.lock:
+            entry = table.get(key)
+            if entry is None:
+                table[key] = [count, seconds]
+            else:
+                entry[0] += count
+                entry[1] += seconds
+
+    def report(self) -> dict:
+        def table(entries: dict[str, list]) -> dict[str, dict]:
+            ordered = sorted(entries.items(), key=lambda item: -item[1][1])
+            return {key: {"count": count, "seconds": seconds} for key, (count, seconds) in ordered}
+
+        return {
+            "phases": self.phases,
+            "procedures": table(self.procedures),
+            "bytecodes": table(self.bytecodes),
+            "llm": table(self.llm),
+            "sql": table(self.sql),
+        }
+
+    def collapsed_stacks(self) -> str:
+        """
+        The time under each stack in the collapsed format flamegraph tools read, in microseconds.
+        """
+        return "".join(f"{stack} {round(seconds * 1e6)}\n" for stack, seconds in sorted(self.stacks.items()))
+
+    def write(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        with open(f"{path}.folded", "w") as f:
+            f.write(self.collapsed_stacks())
 
 
 class System:
@@ -56,15 +218,38 @@ class System:
         llm_manager: "BaseLLMManager",
         sql_manager: "SQLManager",
         verbose: bool = False,
+        max_llm_calls: int | None = None,
+        stream: bool = False,
     ):
-        self.stack: list[dict[str, str]] = [{}]
-        self.call_stack: list[tuple[str, int]]
+        self.env = Environment()
+        self.call_stack: list[Frame] = []
         self.procedures = procedures
         self.compiled_procedures: dict[str, list["BaseByteCode"]] = {}
+        self.linked_procedures: dict[str, list["BaseByteCode"]] = {}
         self.llm_manager = llm_manager
         self.sql_manager = sql_manager
         self.verbose = verbose
+        # Whether LLM responses are used while they're still being generated
+        self.stream = stream
         self.iterators: list[CompiledIterator] = []
+        # The large values the last checkpoint saved or referred to, by id, with their keys
+        self.checkpoint_references: dict[int, tuple[object, str]] = {}
+        # Limits how many LLM calls parallel loops can have in flight at once. Forks share it, so the
+        # limit covers every iteration of every loop, however deeply nested
+        self.llm_slots = None if max_llm_calls is None else threading.BoundedSemaphore(max_llm_calls)
+        # When set, output is collected here instead of being printed
+        self.output_buffer: list[str] | None = None
+        # Set when an iteration of a parallel loop hits a break
+        self.iteration_broken = False
+        # Set while running with --profile, so parallel loops profile their iterations too
+        self.profiler: Profiler | None = None
+        # For an iteration of a parallel loop, the names of the procedures the loop is running in
+        self.stack_prefix: list[str] | None = None
+        # The directory /read and /write resolve relative paths against, when it isn't the current
+        # one, as for jobs sent to the server
+        self.directory: str | None = None
+        # Whether ask can read answers from stdin, which the server's jobs can't
+        self.interactive = True
 
     def get_procedure(self, name: str) -> "BaseProcedure":
         if self.verbose:
@@ -87,35 +272,46 @@ class System:
     def get_var(self, name: str) -> str:
         if self.verbose:
             log(f"Retrievieving variable value: {name}")
-        for layer in reversed(self.stack):
-            if name in layer:
-                return layer[name]
-        return ""
+        value = self.env.visible.get(name, "")
+        return value if type(value) is str else str(value)
 
     def set_var(self, name: str, value: str) -> None:
         if self.verbose:
             log(f"Saving to variable: {name}, value: {value}")
-        self.stack[-1][name] = str(value)
+        self.env.set(name, str(value))
+
+    def get_value(self, name: str) -> Value:
+        """
+        Like get_var, but doesn't wait for streaming text to finish.
+        """
+        if self.verbose:
+            log(f"Retrievieving variable value: {name}")
+        return self.env.visible.get(name, "")
+
+    def set_value(self, name: str, value: Value) -> None:
+        if self.verbose:
+            log(f"Saving to variable: {name}, value: {value!r}")
+        self.env.set(name, value)
 
     def new_env(self) -> None:
-        self.stack.append({})
+        self.env.push()
         if self.verbose:
-            log(f"adding a new env. new depth: {len(self.stack)}")
+            log(f"adding a new env. new depth: {len(self.env)}")
 
     def pop_env(self) -> None:
-        if len(self.stack) <= 1:
+        if len(self.env) <= 1:
             breakpoint()
             if self.verbose:
-                log(f"Tried to pop an env, but the stack is length: {len(self.stack)}")
+                log(f"Tried to pop an env, but the stack is length: {len(self.env)}")
             return
-        dropped_env = self.stack.pop()
+        dropped_env = self.env.pop()
         for key, value in dropped_env.items():
             if key == "prompt":
-                self.set_var("prompt", value)
+                self.set_value("prompt", value)
             else:
-                self.set_var(f"out.{key}", value)
+                self.set_value(f"out.{key}", value)
         if self.verbose:
-            log(f"Popped an env, new stack depth is: {len(self.stack)}")
+            log(f"Popped an env, new stack depth is: {len(self.env)}")
 
     def execute_sql(self, query: str, read_only: bool) -> Iterator[dict[str, str]]:
         if self.verbose:
@@ -125,15 +321,39 @@ class System:
                 log(f"Result: {row=}")
             yield row
 
-    def run_llm(self, procedure: "LLMProcedure", data: dict[str, str]) -> str:
+    def run_llm(self, procedure: "LLMProcedure", data: dict[str, str]) -> Value:
         if self.verbose:
             log(f"Calling LLM {procedure.model=} {procedure.name=} {data=}")
-        result = self.llm_manager.run_llm(procedure, data)
+        if self.stream:
+            if self.llm_slots is not None:
+                self.llm_slots.acquire()
+            try:
+                text = self.llm_manager.stream_llm(procedure, data)
+            except BaseException:
+                if self.llm_slots is not None:
+                    self.llm_slots.release()
+                raise
+            if self.llm_slots is not None:
+                # The call is in flight until the whole response has been generated
+                text.add_done_callback(self.llm_slots.release)
+            return text
+        if self.llm_slots is None:
+            result = self.llm_manager.run_llm(procedure, data)
+        else:
+            with self.llm_slots:
+                result = self.llm_manager.run_llm(procedure, data)
         if self.verbose:
-            log(f"Response from LLM was: {result}")
+            log(f"Response from LLM was: {result!r}")
         return result
 
+    def resolve_path(self, filename: str) -> str:
+        if self.directory is None:
+            return filename
+        return os.path.join(self.directory, filename)
+
     def ask_questions(self, questions: list[tuple[str, str]]) -> None:
+        if not self.interactive:
+            raise RuntimeError("ask needs a terminal to read answers from, so it can't be used here")
         import readline
 
         for name, question in questions:
@@ -153,24 +373,65 @@ class System:
             self.compiled_procedures[name] = proc.compile(self)
         self.procedures = {}
 
-    def new_call(self, name: str) -> None:
-        self.call_stack.append((name, 0))
+    def register_llm_procedures(self) -> None:
+        """
+        Registers the models of all LLM procedures up front, instead of on their first call.
+        """
+        for code in self.compiled_procedures.values():
+            for command in code:
+                if isinstance(command, LLMProcedure):
+                    self.llm_manager.register_model(command)
+
+    def load_compiled(self, compiled_procedures: dict[str, list["BaseByteCode"]]) -> None:
+        self.compiled_procedures = compiled_procedures
+        self.procedures = {}
+
+    def link(self) -> None:
+        """
+        Prepares compiled procedures for running. Each procedure gets a ReturnFromProcedure at the
+        end, so running off the end of a procedure doesn't need a bounds check, and procedure calls
+        point directly at the bytecode they call instead of looking it up by name.
+        """
+        self.linked_procedures = {
+            name: code + [ReturnFromProcedure()] for name, code in self.compiled_procedures.items()
+        }
+        for code in self.linked_procedures.values():
+            self.link_calls(code)
+
+    def link_calls(self, code: list["BaseByteCode"]) -> None:
+        for command in code:
+            if isinstance(command, CallProcedureByName):
+                command.target = self.linked_procedures.get(command.name)
+            elif isinstance(command, RunParallelLoop):
+                self.link_calls(command.body)
+
+    def new_call(self, name: str, code: list["BaseByteCode"] | None = None) -> None:
+        if code is None:
+            code = self.linked_procedures[name]
+        self.call_stack.append(Frame(name, code))
+
+    def return_from_call(self) -> None:
+        if len(self.call_stack) > 1:
+            self.pop_env()
+        self.call_stack.pop()
 
     def jump(self, jump: int) -> None:
-        name, idx = self.call_stack[-1]
-        self.call_stack[-1] = (name, idx + jump)
+        self.call_stack[-1].idx += jump
 
     def step(self) -> None:
-        name, idx = self.call_stack[-1]
-        procedure = self.compiled_procedures[name]
-        if idx >= len(procedure):
-            if len(self.call_stack) > 1:
-                self.pop_env()
-            self.call_stack.pop()
-        else:
-            command = procedure[idx]
-            self.call_stack[-1] = (name, idx + 1)
-            command.execute(self)
+        frame = self.call_stack[-1]
+        idx = frame.idx
+        frame.idx = idx + 1
+        frame.code[idx].execute(self)
+
+    def run(self) -> None:
+        # This is step() in a loop, with the lookups hoisted out of the loop
+        call_stack = self.call_stack
+        while call_stack:
+            frame = call_stack[-1]
+            idx = frame.idx
+            frame.idx = idx + 1
+            frame.code[idx].execute(self)
 
     def next_iterator_empty(self) -> bool:
         return len(self.iterators[-1]) == 0
@@ -178,8 +439,8 @@ class System:
     def get_next_iterator_value(self) -> str | dict[str, str]:
         return self.iterators[-1].popleft()
 
-    def new_iterator(self) -> CompiledIterator:
-        result: CompiledIterator = deque()
+    def new_iterator(self, items: list[str | dict[str, str]], start: int = 0) -> CompiledIterator:
+        result = ItemDeque(items, start)
         self.iterators.append(result)
         return result
 
@@ -188,21 +449,267 @@ class System:
         self.iterators.append(result)
         return result
 
+    def new_streaming_iterator(self, text: "StreamingText", separator: str) -> CompiledIterator:
+        result = StreamingLineIterator(text, separator)
+        self.iterators.append(result)
+        return result
+
+    def new_mapped_iterator(self, text: "MappedText", separator: str, position: int = 0) -> CompiledIterator:
+        result = MappedLineIterator(text, separator, position)
+        self.iterators.append(result)
+        return result
+
+    def new_sql_iterator(self, query: str, skip: int = 0) -> CompiledIterator | None:
+        if self.verbose:
+            log(f"Opening read only sql query: {query}")
+        result = self.sql_manager.open_query(query, self.get_var, skip)
+        if result is not None:
+            self.iterators.append(result)
+        return result
+
     def pop_iterator(self) -> None:
         self.iterators.pop()
 
+    def end_loop(self) -> None:
+        # The body of a parallel loop breaks out of a loop that isn't running in this system
+        if len(self.iterators) == 0:
+            return
+        iterator = self.iterators.pop()
+        if isinstance(iterator, SQLRowIterator):
+            iterator.close()
+
     def next_commnd_like(self, cls: Type) -> int:
-        name, idx = self.call_stack[-1]
-        procedure = self.compiled_procedures[name]
+        frame = self.call_stack[-1]
+        idx = frame.idx
+        procedure = frame.code
         result = 0
+        # Loops inside the one being broken out of have EndLoopMarkers of their own to skip
+        nested_loops = 0
         while idx + result < len(procedure):
-            if isinstance(procedure[idx + result], cls):
+            command = procedure[idx + result]
+            if isinstance(command, LoopStartCommands):
+                nested_loops += 1
+            elif isinstance(command, EndLoopMarker) and nested_loops > 0:
+                nested_loops -= 1
+            # A break outside of a loop returns from the procedure
+            elif isinstance(command, (cls, ReturnFromProcedure)):
                 break
-            else:
-                result += 1
+            result += 1
         return result
 
-    def begin(self, procedure_name: str | None) -> None:
+    def run_with_checkpoints(self, every: int, save: Callable[[dict], None]) -> None:
+        """
+        Like run, but passes the state to save every so many steps.
+        """
+        call_stack = self.call_stack
+        steps = 0
+        while call_stack:
+            frame = call_stack[-1]
+            idx = frame.idx
+            frame.idx = idx + 1
+            frame.code[idx].execute(self)
+            steps += 1
+            # Try again after each step until the state can be saved without waiting on an LLM
+            if steps >= every and call_stack and self.can_checkpoint():
+                steps = 0
+                save(self.get_state())
+
+    def run_profiled(
+        self, profiler: Profiler, checkpoint_every: int = 0, save: Callable[[dict], None] | None = None
+    ) -> None:
+        """
+        Like run, but timing every step. Kept separate from run so there's no cost when not
+        profiling.
+        """
+        call_stack = self.call_stack
+        clock = time.perf_counter
+        bytecodes: dict[str, list] = {}
+        stacks: dict[str, float] = {}
+        # When each frame on the call stack started
+        starts = [clock() for _ in call_stack]
+        # An iteration of a parallel loop starts inside a call that's timed by the system running
+        # the loop, so its first frame isn't timed again
+        timed_depth = 0 if self.stack_prefix is None else 1
+        stack_prefix = self.stack_prefix or []
+        stack_names = ";".join(stack_prefix + [frame.name for frame in call_stack])
+        steps = 0
+        while call_stack:
+            frame = call_stack[-1]
+            idx = frame.idx
+            frame.idx = idx + 1
+            command = frame.code[idx]
+            depth = len(call_stack)
+            start = clock()
+            command.execute(self)
+            end = clock()
+            elapsed = end - start
+            name = type(command).__name__
+            entry = bytecodes.get(name)
+            if entry is None:
+                bytecodes[name] = [1, elapsed]
+            else:
+                entry[0] += 1
+                entry[1] += elapsed
+            key = f"{stack_names};{name}"
+            stacks[key] = stacks.get(key, 0.0) + elapsed
+            if len(call_stack) != depth:
+                while len(starts) > len(call_stack):
+                    # frame is the one that just returned
+                    frame_start = starts.pop()
+                    if len(starts) >= timed_depth:
+                        profiler.add(profiler.procedures, frame.name, end - frame_start)
+                while len(starts) < len(call_stack):
+                    starts.append(end)
+                stack_names = ";".join(stack_prefix + [frame.name for frame in call_stack])
+            steps += 1
+            if save is not None and steps >= checkpoint_every > 0 and call_stack and self.can_checkpoint():
+                steps = 0
+                save(self.get_state())
+        for name, (count, seconds) in bytecodes.items():
+            profiler.add(profiler.bytecodes, name, seconds, count)
+        with profiler.lock:
+            for key, seconds in stacks.items():
+                profiler.stacks[key] = profiler.stacks.get(key, 0.0) + seconds
+
+    def can_checkpoint(self) -> bool:
+        """
+        Whether the state can be saved now. Text that an LLM is still generating can't be saved
+        until it's finished.
+        """
+        for iterator in self.iterators:
+            if isinstance(iterator, StreamingLineIterator) and not iterator.text.done:
+                return False
+        for layer in self.env.layers:
+            for value in layer.values():
+                if isinstance(value, StreamingText) and not value.done:
+                    return False
+        return True
+
+    def get_state(self) -> dict:
+        """
+        The state of execution between two steps, as json compatible data.
+
+        Large values are saved once, in the "values" of the first state that has them, and later
+        states refer to them by key, so saving a state doesn't cost as much as the input each
+        time. States have to be kept in order, as CheckpointStore does, for the keys to resolve.
+        """
+        values: dict[str, object] = {}
+        referenced: dict[int, tuple[object, str]] = {}
+
+        def reference(value: object, data: Callable[[], object]) -> dict[str, str]:
+            entry = self.checkpoint_references.get(id(value))
+            if entry is None or entry[0] is not value:
+                key = uuid.uuid4().hex
+                values[key] = data()
+            else:
+                key = entry[1]
+            referenced[id(value)] = (value, key)
+            return {"stored": key}
+
+        def save_variable(value: Value) -> object:
+            if isinstance(value, MappedText):
+                return save_value(value)
+            if isinstance(value, str) and len(value) < CHECKPOINT_REFERENCE_SIZE:
+                return value
+            text = str(value)
+            if len(text) < CHECKPOINT_REFERENCE_SIZE:
+                return text
+            return reference(value, lambda: text)
+
+        iterators: list[dict] = []
+        for idx, iterator in enumerate(self.iterators):
+            if isinstance(iterator, InfiniteIterator):
+                iterators.append({"type": "infinite"})
+                continue
+            if isinstance(iterator, MappedLineIterator):
+                iterators.append(
+                    {
+                        "type": "mapped",
+                        "path": iterator.text.path,
+                        "separator": iterator.separator.decode(),
+                        "position": iterator.unused_position(),
+                    }
+                )
+                continue
+            if isinstance(iterator, SQLRowIterator):
+                # Run the query again when resuming, skipping the rows that have been used
+                iterators.append(
+                    {"type": "sql", "query": iterator.query, "params": iterator.params, "consumed": iterator.consumed}
+                )
+                continue
+            if isinstance(iterator, StreamingLineIterator):
+                # The text is finished, so the rest of the lines are all there
+                lines: list[str | dict[str, str]] = []
+                while len(iterator) > 0:
+                    lines.append(iterator.popleft())
+                iterator = ItemDeque(lines)
+                self.iterators[idx] = iterator
+            elif not isinstance(iterator, ItemDeque):
+                iterator = ItemDeque(list(iterator))
+                self.iterators[idx] = iterator
+            items = iterator.items
+            iterators.append(
+                {"type": "items", "items": reference(items, lambda: items), "position": len(items) - len(iterator)}
+            )
+        state = {
+            "version": INTERPRETER_VERSION,
+            "call_stack": [[frame.name, frame.idx] for frame in self.call_stack],
+            "env": [{key: save_variable(value) for key, value in layer.items()} for layer in self.env.layers],
+            "iterators": iterators,
+            "values": values,
+        }
+        self.checkpoint_references = referenced
+        return state
+
+    def set_state(self, state: dict) -> None:
+        if state["version"] != INTERPRETER_VERSION:
+            raise RuntimeError(f"can't resume a checkpoint from interpreter version {state['version']}")
+        values = state.get("values", {})
+        self.checkpoint_references = {}
+
+        def load_stored(reference: dict[str, str]) -> object:
+            result = values[reference["stored"]]
+            # The next checkpoint can refer to what's already stored instead of storing it again
+            self.checkpoint_references[id(result)] = (result, reference["stored"])
+            return result
+
+        def load_variable(value: str | dict[str, str]) -> Value:
+            if isinstance(value, dict) and "stored" in value:
+                return load_stored(value)  # type: ignore
+            return load_value(value)
+
+        self.env = Environment()
+        for depth, layer in enumerate(state["env"]):
+            if depth > 0:
+                self.env.push()
+            for key, value in layer.items():
+                self.env.set(key, load_variable(value))
+        self.iterators = []
+        for iterator in state["iterators"]:
+            if iterator["type"] == "infinite":
+                self.iterators.append(InfiniteIterator())
+            elif iterator["type"] == "mapped":
+                self.new_mapped_iterator(MappedText(iterator["path"]), iterator["separator"], iterator["position"])
+            elif iterator["type"] == "sql":
+                get_value = ValueGetter(iterator["params"])
+                rows = self.sql_manager.open_query(iterator["query"], get_value, iterator["consumed"])
+                if rows is None:
+                    # The database isn't in WAL mode any more, so fetch the rows that are left at once
+                    rows = list(self.sql_manager.execute_sql(iterator["query"], True, get_value))
+                    self.new_iterator(rows, iterator["consumed"])
+                else:
+                    self.iterators.append(rows)
+            else:
+                self.new_iterator(load_stored(iterator["items"]), iterator["position"])  # type: ignore
+        self.call_stack = [Frame(name, self.linked_procedures[name], idx) for name, idx in state["call_stack"]]
+
+    def begin(
+        self,
+        procedure_name: str | None,
+        checkpoint_every: int = 0,
+        save_checkpoint: Callable[[dict], None] | None = None,
+        profiler: Profiler | None = None,
+    ) -> None:
         self.compile_all()
         if procedure_name is None:
             for name in self.compiled_procedures.keys():
@@ -210,15 +717,160 @@ class System:
                 break
             else:
                 return
-        self.call_stack = [(procedure_name, 0)]
-        while len(self.call_stack) > 0:
-            self.step()
+        self.link()
+        self.call_stack = [Frame(procedure_name, self.linked_procedures[procedure_name])]
+        self.finish(checkpoint_every, save_checkpoint, profiler)
+
+    def resume(
+        self,
+        state: dict,
+        checkpoint_every: int = 0,
+        save_checkpoint: Callable[[dict], None] | None = None,
+        profiler: Profiler | None = None,
+    ) -> None:
+        self.compile_all()
+        self.link()
+        self.set_state(state)
+        self.finish(checkpoint_every, save_checkpoint, profiler)
+
+    def finish(
+        self,
+        checkpoint_every: int,
+        save_checkpoint: Callable[[dict], None] | None,
+        profiler: Profiler | None = None,
+    ) -> None:
+        if profiler is not None:
+            start = time.perf_counter()
+            self.profiler = profiler
+            self.run_profiled(profiler, checkpoint_every, save_checkpoint)
+            profiler.phases["run"] = time.perf_counter() - start
+        elif checkpoint_every > 0 and save_checkpoint is not None:
+            self.run_with_checkpoints(checkpoint_every, save_checkpoint)
+        else:
+            self.run()
         print(self.get_var("prompt"))
 
-    def output_text(self, text: str) -> None:
-        print(text)
+    def output_text(self, text: Value) -> None:
+        if self.output_buffer is not None:
+            self.output_buffer.append(str(text))
+        elif isinstance(text, StreamingText):
+            ends_with_newline = True
+            for chunk in text.iter_chunks():
+                sys.stdout.write(chunk)
+                sys.stdout.flush()
+                ends_with_newline = chunk.endswith("\n")
+            if not ends_with_newline:
+                sys.stdout.write("\n")
+        else:
+            print(text)
         return None
 
+    def set_item_variables(self, data: str | dict[str, str]) -> None:
+        if isinstance(data, str):
+            self.set_var("prompt", data)
+        elif isinstance(data, dict):
+            for key, value in data.items():
+                self.set_var(key, value)
+
+    def fork(self, visible: dict[str, str]) -> "System":
+        """
+        Makes a system for running one iteration of a parallel loop. It shares procedures and
+        managers with this one, but has its own variables (starting from the given ones), call
+        stack, iterators and output.
+        """
+        result = System({}, self.llm_manager, self.sql_manager, self.verbose)
+        result.compiled_procedures = self.compiled_procedures
+        result.linked_procedures = self.linked_procedures
+        result.llm_slots = self.llm_slots
+        result.profiler = self.profiler
+        result.directory = self.directory
+        result.interactive = self.interactive
+        # The iteration's own frame stands in for the frame running the loop
+        result.stack_prefix = (self.stack_prefix or []) + [frame.name for frame in self.call_stack[:-1]]
+        result.env = Environment.based_on(visible)
+        result.output_buffer = []
+        return result
+
+    def run_iteration(self, name: str, code: list["BaseByteCode"], item: str | dict[str, str]) -> "IterationResult":
+        self.set_item_variables(item)
+        self.call_stack = [Frame(name, code)]
+        if self.profiler is None:
+            self.run()
+        else:
+            self.run_profiled(self.profiler)
+        assert self.output_buffer is not None
+        return IterationResult(self.env.layers[0], self.output_buffer, self.iteration_broken)
+
+    def run_parallel(
+        self, code: list["BaseByteCode"], items: Iterator[str | dict[str, str]], workers: int
+    ) -> None:
+        """
+        Runs code once for each item, up to workers at a time. Each iteration starts from the
+        variables as they are now, so iterations don't see each other's changes. Once an iteration
+        is done, and all the ones before it, its output is written and the variables it set are set
+        here, so the result doesn't depend on which iterations finish first.
+
+        A break stops the loop after the iteration that broke, and the results of later iterations
+        are discarded. Once any iteration breaks, no later iteration is started, but later ones
+        that were already running when it broke run to the end, so their side effects (SQL writes,
+        LLM calls, files written) still happen.
+        """
+        name = self.call_stack[-1].name
+        visible = dict(self.env.visible)
+        pending: deque[Future] = deque()
+        # The index of the earliest iteration that broke so far
+        first_break: int | None = None
+        first_break_lock = threading.Lock()
+
+        def run_iteration(index: int, item: str | dict[str, str]) -> IterationResult | None:
+            nonlocal first_break
+            if first_break is not None and first_break < index:
+                return None
+            iteration = self.fork(visible).run_iteration(name, code, item)
+            if iteration.broken:
+                with first_break_lock:
+                    if first_break is None or index < first_break:
+                        first_break = index
+            return iteration
+
+        def merge(iteration: IterationResult | None) -> bool:
+            # Only iterations after one that broke are skipped, and merging stops at that one
+            assert iteration is not None
+            for text in iteration.output:
+                self.output_text(text)
+            for key, value in iteration.variables.items():
+                self.set_value(key, value)
+            return iteration.broken
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                broken = False
+                for index, item in enumerate(items):
+                    if first_break is not None:
+                        break
+                    pending.append(executor.submit(run_iteration, index, item))
+                    # Keep enough work queued to keep the workers busy without reading every item up front
+                    if len(pending) >= workers * 2:
+                        broken = merge(pending.popleft().result())
+                        if broken:
+                            break
+                while len(pending) > 0 and not broken:
+                    broken = merge(pending.popleft().result())
+                for future in pending:
+                    future.cancel()
+        finally:
+            # The workers have ended, so the connections they opened won't be used again
+            self.sql_manager.close_finished_thread_connections()
+            if self.llm_manager is not None:
+                self.llm_manager.sql_manager.close_finished_thread_connections()
+
+
+@dataclass
+class IterationResult:
+    variables: dict[str, Value]
+    output: list[str]
+    broken: bool
+
 
 class InfiniteIterator:
     def __len__(self):
@@ -228,23 +880,317 @@ class InfiniteIterator:
         return ""
 
 
+class StreamingText:
+    """
+    Text that is still being written, like an LLM response while it's being generated. Readers can
+    follow the chunks as they arrive, and converting it to a str waits for the rest of it.
+    """
+
+    def __init__(self) -> None:
+        self.chunks: list[str] = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.callbacks: list[Callable[[], object]] = []
+        self.changed = threading.Condition()
+
+    @classmethod
+    def complete(cls, text: str) -> "StreamingText":
+        result = cls()
+        result.append(text)
+        result.finish()
+        return result
+
+    def append(self, chunk: str) -> None:
+        with self.changed:
+            if len(self.chunks) == 0:
+                chunk = chunk.lstrip()
+            if chunk == "":
+                return
+            self.chunks.append(chunk)
+            self.changed.notify_all()
+
+    def finish(self, error: BaseException | None = None) -> None:
+        with self.changed:
+            self.done = True
+            self.error = error
+            callbacks = self.callbacks
+            self.callbacks = []
+            self.changed.notify_all()
+        for callback in callbacks:
+            callback()
+
+    def add_done_callback(self, callback: Callable[[], object]) -> None:
+        with self.changed:
+            if not self.done:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def written(self) -> str:
+        with self.changed:
+            return "".join(self.chunks).strip()
+
+    def iter_chunks(self) -> Iterator[str]:
+        idx = 0
+        while True:
+            with self.changed:
+                while idx >= len(self.chunks) and not self.done:
+                    self.changed.wait()
+                new_chunks = self.chunks[idx:]
+                done = self.done
+                error = self.error
+            idx += len(new_chunks)
+            yield from new_chunks
+            if done:
+                if error is not None:
+                    raise error
+                return
+
+    def __str__(self) -> str:
+        with self.changed:
+            while not self.done:
+                self.changed.wait()
+        if self.error is not None:
+            raise self.error
+        return self.written()
+
+    def __repr__(self) -> str:
+        return f"StreamingText(done={self.done})"
+
+
+class RopeText:
+    """
+    Text built up by appending to other text, like an accumulator in a loop. The pieces are kept in
+    a list that's shared with the text that was appended to, so appending doesn't copy what's
+    already there, and the pieces are only joined when a str is needed.
+    """
+
+    __slots__ = ("chunks", "count", "flat")
+    # Appending checks whether the shared list has been appended to already
+    lock = threading.Lock()
+
+    def __init__(self, chunks: list[str], count: int) -> None:
+        self.chunks = chunks
+        # This text is the first count pieces of the list, later pieces belong to longer texts
+        self.count = count
+        self.flat: str | None = None
+
+    def append(self, pieces: list[str]) -> "RopeText":
+        with RopeText.lock:
+            if self.count == len(self.chunks):
+                chunks = self.chunks
+            else:
+                chunks = self.chunks[: self.count]
+            chunks.extend(pieces)
+            return RopeText(chunks, len(chunks))
+
+    def __str__(self) -> str:
+        if self.flat is None:
+            self.flat = "".join(self.chunks[: self.count])
+        return self.flat
+
+    def __repr__(self) -> str:
+        return f"RopeText(pieces={self.count})"
+
+
+# Format strings starting with a variable at least this long append to it instead of copying it
+ROPE_MIN_LENGTH = 1024
+# Checkpoints save text at least this long once, and refer to it from later checkpoints
+CHECKPOINT_REFERENCE_SIZE = 4096
+
+
+class MappedText:
+    """
+    The contents of a file, mapped into memory instead of read, so a large file can be looped over
+    a line at a time without ever holding all of it as a str. Like a file opened in text mode,
+    "\r\n" and "\r" line endings read as "\n".
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            self.data.madvise(mmap.MADV_SEQUENTIAL)
+        # The whole file as a str, once something has needed it
+        self.text: str | None = None
+
+    @cached_property
+    def has_carriage_returns(self) -> bool:
+        return self.data.find(b"\r") != -1
+
+    def release(self, start: int, end: int) -> None:
+        """
+        Lets the OS drop the pages between start and end from memory. They're read from the file
+        again if they're used later.
+        """
+        start -= start % mmap.PAGESIZE
+        end -= end % mmap.PAGESIZE
+        if hasattr(mmap, "MADV_DONTNEED") and end > start:
+            self.data.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    def __str__(self) -> str:
+        if self.text is None:
+            self.text = translate_newlines(self.data[:].decode())
+        return self.text
+
+    def __repr__(self) -> str:
+        return f"MappedText({self.path!r})"
+
+
+def translate_newlines(text: str) -> str:
+    if "\r" not in text:
+        return text
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def read_file(path: str) -> Value:
+    # Empty files can't be mapped
+    if os.path.getsize(path) == 0:
+        return ""
+    return MappedText(path)
+
+
+def save_value(value: Value) -> str | dict[str, str]:
+    if isinstance(value, MappedText):
+        return {"mapped_file": value.path}
+    return str(value)
+
+
+def load_value(value: str | dict[str, str]) -> Value:
+    if isinstance(value, dict):
+        return read_file(value["mapped_file"])
+    return value
+
+
+class MappedLineIterator:
+    """
+    Loops over the lines of a mapped file, decoding each one as it's needed.
+    """
+
+    def __init__(self, text: MappedText, separator: str, position: int = 0) -> None:
+        self.text = text
+        self.separator = separator.encode()
+        # Files with other line endings need a slower search that finds every kind of newline
+        self.separator_pattern = None
+        if text.has_carriage_returns:
+            newline = rb"(?:\r\n|\r(?!\n)|\n)"
+            self.separator_pattern = re.compile(newline * separator.count("\n"))
+        self.position = position
+        self.next_line: str | None = None
+        self.next_line_position = position
+        # Everything before this has been handed back to the OS
+        self.released = position
+
+    def __len__(self) -> int:
+        data = self.text.data
+        if self.position - self.released > 64 * 1024 * 1024:
+            self.text.release(self.released, self.position)
+            self.released = self.position
+        while self.next_line is None and self.position < len(data):
+            if self.separator_pattern is None:
+                end = data.find(self.separator, self.position)
+                if end == -1:
+                    end = len(data)
+                next_position = end + len(self.separator)
+                line = data[self.position : end].decode().strip()
+            else:
+                match = self.separator_pattern.search(data, self.position)
+                end = len(data) if match is None else match.start()
+                next_position = len(data) if match is None else match.end()
+                line = translate_newlines(data[self.position : end].decode()).strip()
+            self.next_line_position = self.position
+            self.position = next_position
+            if line != "":
+                self.next_line = line
+        return 0 if self.next_line is None else 1
+
+    def popleft(self) -> str:
+        if self.next_line is None:
+            len(self)
+        assert self.next_line is not None
+        result = self.next_line
+        self.next_line = None
+        return result
+
+    def unused_position(self) -> int:
+        # Where the first line that hasn't been used starts
+        return self.position if self.next_line is None else self.next_line_position
+
+
+class StreamingLineIterator:
+    """
+    Loops over the lines of streaming text as each one is finished, without waiting for the rest.
+    """
+
+    def __init__(self, text: StreamingText, separator: str) -> None:
+        self.text = text
+        self.chunks = text.iter_chunks()
+        self.separator = separator
+        self.partial = ""
+        self.ready: deque[str] = deque()
+        self.exhausted = False
+
+    def add_line(self, line: str) -> None:
+        line = line.strip()
+        if line != "":
+            self.ready.append(line)
+
+    def __len__(self) -> int:
+        # Wait until there's another line, or there won't be any more
+        while len(self.ready) == 0 and not self.exhausted:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.exhausted = True
+                self.add_line(self.partial)
+                self.partial = ""
+                break
+            lines = (self.partial + chunk).split(self.separator)
+            self.partial = lines.pop()
+            for line in lines:
+                self.add_line(line)
+        return len(self.ready)
+
+    def popleft(self) -> str:
+        return self.ready.popleft()
+
+
 # ByteCodeCommands are the most primitive part of execution. Compiling programs to VM bytecode
 # makes it easier to store and restore execution state.
 class BaseByteCode:
+    __slots__ = ()
+
     def execute(self, system: System) -> None:
         raise NotImplementedError()
 
 
-@dataclass
+@dataclass(slots=True)
 class CallProcedureByName(BaseByteCode):
     name: str
+    # Filled in by System.link
+    target: list[BaseByteCode] | None = field(default=None, repr=False, compare=False)
 
     def execute(self, system: System) -> None:
         system.new_env()
-        system.new_call(self.name)
+        system.new_call(self.name, self.target)
 
+    def __getstate__(self):
+        # The bytecode this links to is pickled along with its own procedure
+        return {"name": self.name}
 
-@dataclass
+    def __setstate__(self, state) -> None:
+        self.name = state["name"]
+        self.target = None
+
+
+class ReturnFromProcedure(BaseByteCode):
+    __slots__ = ()
+
+    def execute(self, system: System) -> None:
+        system.return_from_call()
+
+
+@dataclass(slots=True)
 class Jump(BaseByteCode):
     jump: int
 
@@ -253,80 +1199,135 @@ class Jump(BaseByteCode):
 
 
 class JumpIfIteratorEmpty(Jump):
+    __slots__ = ()
+
     def execute(self, system: System) -> None:
         if system.next_iterator_empty():
             system.pop_iterator()
             system.jump(self.jump)
 
 
-@dataclass
+@dataclass(slots=True)
 class JumpIfNoMatch(Jump):
     case: str
 
     def execute(self, system: System) -> None:
         input_var = system.get_var("prompt").lower()
-        normalized = re.compile(r"[^a-z0-9]+").sub(" ", input_var).strip()
+        normalized = NonAlphanumeric.sub(" ", input_var).strip()
         if normalized != self.case:
             system.jump(self.jump)
 
 
 class SetIteratorItemVariables(BaseByteCode):
+    __slots__ = ()
+
     def execute(self, system: System) -> None:
-        data = system.get_next_iterator_value()
-        if isinstance(data, str):
-            system.set_var("prompt", data)
-        elif isinstance(data, dict):
-            for key, value in data.items():
-                system.set_var(key, value)
+        system.set_item_variables(system.get_next_iterator_value())
 
 
-@dataclass
+@dataclass(slots=True)
 class AddSQLIterator(BaseByteCode):
     read_only: bool
 
     def execute(self, system: System) -> None:
-        iterator = system.new_iterator()
         query = system.get_var("prompt")
-        for row in system.execute_sql(query, read_only=self.read_only):
-            iterator.append(row)
+        # Rows of read only queries are fetched as the loop goes
+        if self.read_only and system.new_sql_iterator(query) is not None:
+            return
+        system.new_iterator(list(system.execute_sql(query, read_only=self.read_only)))
 
 
 class AddLineIterator(BaseByteCode):
+    __slots__ = ()
+
     def execute(self, system: System) -> None:
-        iterator = system.new_iterator()
-        for line in system.get_var("prompt").split("\n"):
+        value = system.get_value("prompt")
+        if isinstance(value, StreamingText):
+            system.new_streaming_iterator(value, "\n")
+            return
+        if isinstance(value, MappedText):
+            system.new_mapped_iterator(value, "\n")
+            return
+        lines = []
+        for line in str(value).split("\n"):
             line = line.strip()
             if line == "":
                 continue
-            iterator.append(line)
+            lines.append(line)
+        system.new_iterator(lines)
 
 
 class AddParagraphIterator(BaseByteCode):
+    __slots__ = ()
+
     def execute(self, system: System) -> None:
-        iterator = system.new_iterator()
-        for line in system.get_var("prompt").split("\n\n"):
+        value = system.get_value("prompt")
+        if isinstance(value, StreamingText):
+            system.new_streaming_iterator(value, "\n\n")
+            return
+        if isinstance(value, MappedText):
+            system.new_mapped_iterator(value, "\n\n")
+            return
+        paragraphs = []
+        for line in str(value).split("\n\n"):
             line = line.strip()
             if line == "":
                 continue
-            iterator.append(line)
+            paragraphs.append(line)
+        system.new_iterator(paragraphs)
 
 
 class AddInfiniteIterator(BaseByteCode):
+    __slots__ = ()
+
     def execute(self, system: System) -> None:
         system.new_infinite_iterator()
 
 
 class EndLoopMarker(BaseByteCode):
+    __slots__ = ()
+
     def execute(self, system: System) -> None:
-        return None
+        # Only reached by breaking out of a loop, which leaves the loop's iterator behind
+        system.end_loop()
+
+
+LoopStartCommands = (AddSQLIterator, AddLineIterator, AddParagraphIterator, AddInfiniteIterator)
 
 
 class BreakCommand(BaseByteCode):
+    __slots__ = ()
+
     def execute(self, system: System) -> None:
         jump = system.next_commnd_like(EndLoopMarker)
         system.jump(jump)
 
 
+class MarkIterationBroken(BaseByteCode):
+    __slots__ = ()
+
+    def execute(self, system: System) -> None:
+        system.iteration_broken = True
+
+
+@dataclass(slots=True)
+class RunParallelLoop(BaseByteCode):
+    iterator_command: BaseByteCode
+    body: list[BaseByteCode]
+    workers: int
+
+    def execute(self, system: System) -> None:
+        self.iterator_command.execute(system)
+        iterator = system.iterators[-1]
+
+        def items() -> Iterator[str | dict[str, str]]:
+            while len(iterator) > 0:
+                yield iterator.popleft()
+
+        system.run_parallel(self.body, items(), self.workers)
+        system.pop_iterator()
+
+
 # A program / procedure is a statement which has more statements following
 
 
@@ -381,7 +1382,7 @@ class LLMProcedure(BaseProcedure, BaseByteCode):
 
     def execute(self, system: System) -> None:
         data = {key: system.get_var(key) for key in self.prompt_keys}
-        system.set_var("prompt", system.run_llm(self, data))
+        system.set_value("prompt", system.run_llm(self, data))
 
     def compile(self, system: System) -> list[BaseByteCode]:
         return [self]
@@ -391,6 +1392,8 @@ class LLMProcedure(BaseProcedure, BaseByteCode):
 
 
 class Statement:
+    __slots__ = ()
+
     def execute(self, system: System) -> None:
         raise NotImplementedError()
 
@@ -520,12 +1523,56 @@ class ForEachParagraph(ForEach):
 
 
 @dataclass
+class ParallelLoop(Statement):
+    """
+    A loop whose iterations run at the same time, each on its own copy of the variables.
+    """
+
+    loop: LoopStatement
+    workers: int
+
+    def execute(self, system: System) -> None:
+        self.loop.execute(system)
+
+    def get_undefined_procedures(self, system: System) -> set[str]:
+        return self.loop.get_undefined_procedures(system)
+
+    def compile(self, system: System) -> list[BaseByteCode]:
+        body = [] if self.loop.procedure is None else self.loop.procedure.compile(system)
+        # A break jumps to the EndLoopMarker, which marks the iteration as broken before returning
+        body += [Jump(2), EndLoopMarker(), MarkIterationBroken(), ReturnFromProcedure()]
+        return [RunParallelLoop(self.loop.get_iterator_command(), body, self.workers)]
+
+
+@dataclass(slots=True)
 class FormatString(Statement, BaseByteCode):
     template: str
+    pieces: list[tuple[str, str | None]] = field(init=False, repr=False, compare=False)
+    # The variable the template starts with, if any, which it may be able to append to
+    appends_to: str | None = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        self.pieces = [(text, name) for text, name, _, _ in string.Formatter().parse(self.template)]
+        if len(self.pieces) > 0 and self.pieces[0][0] == "":
+            self.appends_to = self.pieces[0][1]
+        else:
+            self.appends_to = None
 
     def execute(self, system: System) -> None:
+        if self.appends_to is not None:
+            start = system.get_value(self.appends_to)
+            if isinstance(start, RopeText) or (type(start) is str and len(start) >= ROPE_MIN_LENGTH):
+                rest = []
+                for text, name in self.pieces[1:]:
+                    rest.append(text)
+                    if name is not None:
+                        rest.append(system.get_var(name))
+                if isinstance(start, str):
+                    start = RopeText([start], 1)
+                system.set_value("prompt", start.append(rest))
+                return
         result = []
-        for text, name, _, _ in string.Formatter().parse(self.template):
+        for text, name in self.pieces:
             result.append(text)
             if name is not None:
                 result.append(system.get_var(name))
@@ -535,23 +1582,23 @@ class FormatString(Statement, BaseByteCode):
         return [self]
 
 
-@dataclass
+@dataclass(slots=True)
 class SetVariable(Statement, BaseByteCode):
     name: str
 
     def execute(self, system: System) -> None:
-        system.set_var(self.name, system.get_var("prompt"))
+        system.set_value(self.name, system.get_value("prompt"))
 
     def compile(self, system: System) -> list[BaseByteCode]:
         return [self]
 
 
-@dataclass
+@dataclass(slots=True)
 class FetchVariable(Statement, BaseByteCode):
     name: str
 
     def execute(self, system: System) -> None:
-        system.set_var("prompt", system.get_var(self.name))
+        system.set_value("prompt", system.get_value(self.name))
 
     def compile(self, system: System) -> list[BaseByteCode]:
         return [self]
@@ -597,7 +1644,7 @@ class Branch(Statement):
         return result
 
 
-@dataclass
+@dataclass(slots=True)
 class AskQuestions(Statement, BaseByteCode):
     questions: list[tuple[str, str]]
 
@@ -621,8 +1668,10 @@ class BreakStatement(Statement):
 
 
 class OutputText(Statement, BaseByteCode):
+    __slots__ = ()
+
     def execute(self, system: System) -> None:
-        system.output_text(system.get_var("prompt"))
+        system.output_text(system.get_value("prompt"))
         return None
 
     def compile(self, system: System) -> list[BaseByteCode]:
@@ -630,10 +1679,24 @@ class OutputText(Statement, BaseByteCode):
 
 
 class WriteFile(Statement, BaseByteCode):
+    __slots__ = ()
+
     def execute(self, system: System) -> None:
-        filename = system.get_var("filename")
-        with open(filename, "w") as f:
-            f.write(system.get_var("prompt"))
+        filename = system.resolve_path(system.get_var("filename"))
+        # The text may be mapped from the file being written, so it has to be read before the file
+        # changes, and the file is replaced rather than truncated so the mapping stays valid
+        text = system.get_var("prompt")
+        temp_filename = f"{filename}.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            with open(temp_filename, "w") as f:
+                f.write(text)
+            if os.path.exists(filename):
+                shutil.copymode(filename, temp_filename)
+            os.replace(temp_filename, filename)
+        except BaseException:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
         return None
 
     def compile(self, system: System) -> list[BaseByteCode]:
@@ -641,10 +1704,10 @@ class WriteFile(Statement, BaseByteCode):
 
 
 class ReadFile(Statement, BaseByteCode):
+    __slots__ = ()
+
     def execute(self, system: System) -> None:
-        filename = system.get_var("filename")
-        with open(filename, "w") as f:
-            system.set_var("prompt", f.read())
+        system.set_value("prompt", read_file(system.resolve_path(system.get_var("filename"))))
         return None
 
     def compile(self, system: System) -> list[BaseByteCode]:
@@ -652,6 +1715,8 @@ class ReadFile(Statement, BaseByteCode):
 
 
 class CallLLM(Statement, BaseByteCode):
+    __slots__ = ()
+
     def parse_history(self, history: str):
         lines = history.splitlines()
         result: list[tuple[str, str]] = []
@@ -713,27 +1778,204 @@ class ParseResult:
             raise ValueError("Can't convert {self.value} to data")
 
 
+# Results of parsing a pattern at a position, shared by every pattern in a single parse() call
+ParseMemo = dict[tuple[int, int], tuple[ParseResult | None, int]]
+# The characters a pattern can start with (None if that isn't known), and whether it can match
+# an empty string
+Lookahead = tuple[frozenset[str] | None, bool]
+LEADING_SPACES = re.compile(" *")
+
+
 class Pattern:
-    def parse(self, text) -> ParseResult | None:
-        result, remaining = self.parse_partial(text)
-        if remaining.strip() == "":
+    """
+    Patterns parse from an offset into the source text, returning the result and the offset
+    where parsing stopped, so parsing never copies the remaining text.
+
+    Patterns with memoize set remember their result at each position for the duration of a
+    parse() call (packrat parsing), so backtracking never parses the same span twice.
+    """
+
+    memoize = False
+
+    def parse(self, text, memoize: bool = True) -> ParseResult | None:
+        result, pos = self.parse_at(text, 0, {} if memoize else None)
+        if text[pos:].strip() == "":
             return result
         else:
             breakpoint()
         return None
 
-    def parse_partial(self, text: str) -> tuple[ParseResult | None, str]:
-        result, rest = self._parse_partial(text)
-        return result, rest
+    def parse_partial(self, text: str, memoize: bool = True) -> tuple[ParseResult | None, str]:
+        result, pos = self.parse_at(text, 0, {} if memoize else None)
+        return result, text[pos:]
+
+    def parse_at(self, text: str, pos: int, memo: ParseMemo | None = None) -> tuple[ParseResult | None, int]:
+        if memo is None or not self.memoize:
+            return self._parse_at(text, pos, memo)
+        return memoized_parse_at(self, text, pos, memo)
+
+    def _parse_at(self, text: str, pos: int, memo: ParseMemo | None) -> tuple[ParseResult | None, int]:
+        # Patterns written against the old slicing api only implement _parse_partial
+        result, rest = self._parse_partial(text[pos:])
+        return result, len(text) - len(rest)
 
     def _parse_partial(self, text: str) -> tuple[ParseResult | None, str]:
         return None, text
 
-    def optimize(self) -> "Pattern":
+    def optimize(self, seen: dict[int, "Pattern"] | None = None) -> "Pattern":
+        """
+        Returns an equivalent pattern that parses faster, producing identical results. seen maps
+        already optimized patterns to their replacements, so shared and recursive sub patterns stay
+        shared in the optimized grammar.
+        """
+        if seen is None:
+            seen = {}
+        if id(self) not in seen:
+            seen[id(self)] = self._optimize(seen)
+        return seen[id(self)]
+
+    def _optimize(self, seen: dict[int, "Pattern"]) -> "Pattern":
         return self
 
     def to_regex_pattern(self) -> Union["RegexPattern", None]:
-        return self.optimize().to_regex_pattern()
+        """
+        Returns a regex that matches exactly what this pattern does, with the matched text as its
+        result, or None if there isn't one.
+        """
+        return None
+
+    def lookahead(self) -> Lookahead:
+        return None, True
+
+    def indented_lookahead(self) -> Lookahead:
+        """
+        Like lookahead, but for text starting with a space: the characters that can follow the
+        leading spaces, so indented lines can be dispatched on their first non-space character.
+        """
+        return lookahead_at_spaces(self.lookahead())
+
+    def only_spaces(self) -> bool:
+        return False
+
+
+def memoized_parse_at(pattern: Pattern, text: str, pos: int, memo: ParseMemo) -> tuple[ParseResult | None, int]:
+    key = (id(pattern), pos)
+    result = memo.get(key)
+    if result is None:
+        result = memo[key] = pattern._parse_at(text, pos, memo)
+    return result
+
+
+def sequence_lookahead(pieces: list[Pattern]) -> Lookahead:
+    first_chars: set[str] = set()
+    for piece in pieces:
+        chars, empty_ok = piece.lookahead()
+        if chars is None:
+            return None, True
+        first_chars |= chars
+        if not empty_ok:
+            return frozenset(first_chars), False
+    return frozenset(first_chars), True
+
+
+def lookahead_at_spaces(lookahead: Lookahead) -> Lookahead:
+    # For patterns that don't skip leading spaces themselves, only an empty match is possible on
+    # text starting with a space, unless they can start with one
+    chars, empty_ok = lookahead
+    if chars is None or " " in chars:
+        return None, True
+    return frozenset(), empty_ok
+
+
+def sequence_indented_lookahead(pieces: list[Pattern]) -> Lookahead:
+    # Leading pieces that only match spaces consume all of them, so whatever follows them starts
+    # at the first non-space character
+    skipped = 0
+    while skipped < len(pieces) and pieces[skipped].only_spaces():
+        skipped += 1
+    if skipped > 0:
+        return sequence_lookahead(pieces[skipped:])
+    if pieces:
+        # The first piece may skip the spaces itself, like a FusedRegex starting with MaybeSpaces
+        chars, empty_ok = pieces[0].indented_lookahead()
+        if chars is not None and not empty_ok:
+            return chars, False
+    return lookahead_at_spaces(sequence_lookahead(pieces))
+
+
+def union_lookahead(options: list[Pattern], indented: bool = False) -> Lookahead:
+    first_chars: set[str] = set()
+    any_empty_ok = False
+    for option in options:
+        chars, empty_ok = option.indented_lookahead() if indented else option.lookahead()
+        if chars is None:
+            return None, True
+        first_chars |= chars
+        any_empty_ok = any_empty_ok or empty_ok
+    return frozenset(first_chars), any_empty_ok
+
+
+def make_dispatch_table(options: list[Pattern], indented: bool = False) -> tuple[dict[str, list[int]], list[int]]:
+    """
+    Maps each character to the indexes of the options that could match text starting with it, so
+    unions skip options that can't possibly match. Options that can match an empty string, or
+    whose first character isn't known, are always tried. Characters not in the table (and the end
+    of the text) use the second list. With indented set the table is for text starting with a
+    space, keyed on the first character after the leading spaces.
+    """
+    lookaheads = [option.indented_lookahead() if indented else option.lookahead() for option in options]
+    always = [idx for idx, (chars, empty_ok) in enumerate(lookaheads) if chars is None or empty_ok]
+    all_chars: set[str] = set()
+    for chars, _ in lookaheads:
+        if chars is not None:
+            all_chars |= chars
+    table = {
+        char: [
+            idx for idx, (chars, empty_ok) in enumerate(lookaheads) if chars is None or empty_ok or char in chars
+        ]
+        for char in all_chars
+    }
+    return table, always
+
+
+def fuse_regex_pieces(pieces: list[Pattern], seen: dict[int, Pattern]) -> list[Pattern]:
+    """
+    Optimizes each piece of a sequence, and replaces runs of adjacent pieces that can be expressed
+    as regexes with a single FusedRegex. A FusedRegex produces one result per original piece, so
+    indexes into the results of the sequence don't change.
+    """
+    result: list[Pattern] = []
+    run: list[RegexPattern] = []
+    for piece in pieces:
+        optimized = piece.optimize(seen)
+        as_regex = optimized.to_regex_pattern()
+        if as_regex is None:
+            result += run if len(run) < 2 else [FusedRegex(run)]
+            run = []
+            result.append(optimized)
+        else:
+            run.append(as_regex)
+    result += run if len(run) < 2 else [FusedRegex(run)]
+    return result
+
+
+def parse_sequence(
+    pieces: list[Pattern], text: str, pos: int, memo: ParseMemo | None
+) -> tuple[list[ParseResult] | None, int]:
+    all_results = []
+    end = pos
+    for piece in pieces:
+        if isinstance(piece, FusedRegex):
+            parsed_pieces, end = piece.parse_pieces(text, end)
+            if parsed_pieces is None:
+                return None, pos
+            all_results += parsed_pieces
+        else:
+            parsed_piece, end = piece.parse_at(text, end, memo)
+            if parsed_piece is None:
+                return None, pos
+            all_results.append(parsed_piece)
+    return all_results, end
 
 
 class RegexPattern(Pattern):
@@ -741,7 +1983,8 @@ class RegexPattern(Pattern):
 
     @cached_property
     def final_regex(self) -> re.Pattern:
-        return re.compile("^" + self.regex)
+        # re.Pattern.match is anchored at the position it is given
+        return re.compile(self.regex)
 
     @property
     def regex(self) -> str:
@@ -760,15 +2003,15 @@ class RegexPattern(Pattern):
             value = value.replace(x, y)
         return value
 
-    def _parse_partial(self, text: str) -> tuple[ParseResult | None, str]:
-        result = self.final_regex.match(text)
+    def _parse_at(self, text: str, pos: int, memo: ParseMemo | None) -> tuple[ParseResult | None, int]:
+        result = self.final_regex.match(text, pos)
         if result is None:
-            return None, text
+            return None, pos
         inner_result = None if self.return_none else result.group(0)
-        return ParseResult(inner_result), text[result.span()[1] :]
+        return ParseResult(inner_result), result.end()
 
     def to_regex_pattern(self) -> Union["RegexPattern", None]:
-        return self
+        return None if self.return_none else self
 
 
 @dataclass
@@ -790,6 +2033,12 @@ class OnlyChars(RegexPattern):
     def regex(self) -> str:
         return "[" + "".join([self.escape(x) for x in self.include]) + "]" + ("*" if self.empty_ok else "+")
 
+    def lookahead(self) -> Lookahead:
+        return frozenset("".join(self.include)), self.empty_ok
+
+    def only_spaces(self) -> bool:
+        return self.include == [" "]
+
 
 @dataclass
 class IncludeExclude(RegexPattern):
@@ -817,11 +2066,35 @@ class BasicRegex(RegexPattern):
 class ExactString(Pattern):
     search: str
 
-    def _parse_partial(self, text: str) -> tuple[ParseResult | None, str]:
-        if text.startswith(self.search):
-            return ParseResult(self.search), text[len(self.search) :]
+    def _parse_at(self, text: str, pos: int, memo: ParseMemo | None) -> tuple[ParseResult | None, int]:
+        if text.startswith(self.search, pos):
+            return ParseResult(self.search), pos + len(self.search)
         else:
-            return None, text
+            return None, pos
+
+    def to_regex_pattern(self) -> Union["RegexPattern", None]:
+        return LiteralRegex(self.search)
+
+    def lookahead(self) -> Lookahead:
+        if self.search == "":
+            return frozenset(), True
+        return frozenset(self.search[0]), False
+
+
+@dataclass
+class LiteralRegex(RegexPattern):
+    literal: str
+
+    @property
+    def regex(self) -> str:
+        return re.escape(self.literal)
+
+    def lookahead(self) -> Lookahead:
+        return ExactString(self.literal).lookahead()
+
+
+# Pieces of combined regexes are wrapped in atomic groups. Patterns never backtrack into a piece
+# that has already matched, so without them the combined regex could match differently.
 
 
 @dataclass
@@ -830,7 +2103,34 @@ class ConcatenatedRegex(RegexPattern):
 
     @property
     def regex(self) -> str:
-        return "".join(piece.regex for piece in self.pieces)
+        return "".join("(?>" + piece.regex + ")" for piece in self.pieces)
+
+    def lookahead(self) -> Lookahead:
+        return sequence_lookahead(self.pieces)
+
+    def indented_lookahead(self) -> Lookahead:
+        return sequence_indented_lookahead(self.pieces)
+
+
+@dataclass
+class FusedRegex(ConcatenatedRegex):
+    """
+    Adjacent pieces of a sequence matched with a single regex, giving a result for each piece.
+    """
+
+    @cached_property
+    def pieces_regex(self) -> tuple[re.Pattern, list[int]]:
+        regex = re.compile(
+            "".join(f"(?P<piece{idx}>(?>{piece.regex}))" for idx, piece in enumerate(self.pieces))
+        )
+        return regex, [regex.groupindex[f"piece{idx}"] for idx in range(len(self.pieces))]
+
+    def parse_pieces(self, text: str, pos: int) -> tuple[list[ParseResult] | None, int]:
+        regex, groups = self.pieces_regex
+        result = regex.match(text, pos)
+        if result is None:
+            return None, pos
+        return [ParseResult(result.group(group)) for group in groups], result.end()
 
 
 @dataclass
@@ -839,47 +2139,125 @@ class UnionRegex(RegexPattern):
 
     @property
     def regex(self) -> str:
-        return "(" + "|".join(piece.regex for piece in self.pieces) + ")"
+        return "(?>" + "|".join("(?>" + piece.regex + ")" for piece in self.pieces) + ")"
+
+    def lookahead(self) -> Lookahead:
+        return union_lookahead(self.pieces)
+
+    def indented_lookahead(self) -> Lookahead:
+        return union_lookahead(self.pieces, indented=True)
 
 
 @dataclass
 class UnionPattern(Pattern):
     options: list[Pattern]
+    memoize = True
 
-    def _parse_partial(self, text: str) -> tuple[ParseResult | None, str]:
-        for option in self.options:
-            result, remaining = option.parse_partial(text)
+    @cached_property
+    def dispatch(self) -> tuple[dict[str, list[Pattern]], list[Pattern]]:
+        return self.make_dispatch(indented=False)
+
+    @cached_property
+    def indented_dispatch(self) -> tuple[dict[str, list[Pattern]], list[Pattern]]:
+        return self.make_dispatch(indented=True)
+
+    def make_dispatch(self, indented: bool) -> tuple[dict[str, list[Pattern]], list[Pattern]]:
+        table, always = make_dispatch_table(self.options, indented)
+        return {char: [self.options[idx] for idx in idxs] for char, idxs in table.items()}, [
+            self.options[idx] for idx in always
+        ]
+
+    def _parse_at(self, text: str, pos: int, memo: ParseMemo | None) -> tuple[ParseResult | None, int]:
+        if text.startswith(" ", pos):
+            table, always = self.indented_dispatch
+            key_pos = LEADING_SPACES.match(text, pos).end()
+        else:
+            table, always = self.dispatch
+            key_pos = pos
+        for option in table.get(text[key_pos : key_pos + 1], always):
+            result, end = option.parse_at(text, pos, memo)
             if result is not None:
-                return result, remaining
-        return None, text
+                return result, end
+        return None, pos
+
+    def _optimize(self, seen: dict[int, Pattern]) -> Pattern:
+        options = [option.optimize(seen) for option in self.options]
+        as_regexes = [option.to_regex_pattern() for option in options]
+        if all(as_regex is not None for as_regex in as_regexes):
+            return UnionRegex(as_regexes)
+        return UnionPattern(options)
+
+    def lookahead(self) -> Lookahead:
+        return union_lookahead(self.options)
+
+    def indented_lookahead(self) -> Lookahead:
+        return union_lookahead(self.options, indented=True)
 
 
 @dataclass
 class TaggedUnionPattern(Pattern):
     options: dict[str, Pattern]
+    memoize = True
 
-    def _parse_partial(self, text: str) -> tuple[ParseResult | None, str]:
-        for tag, option in self.options.items():
-            result, remaining = option.parse_partial(text)
+    @cached_property
+    def dispatch(self) -> tuple[dict[str, list[tuple[str, Pattern]]], list[tuple[str, Pattern]]]:
+        return self.make_dispatch(indented=False)
+
+    @cached_property
+    def indented_dispatch(self) -> tuple[dict[str, list[tuple[str, Pattern]]], list[tuple[str, Pattern]]]:
+        return self.make_dispatch(indented=True)
+
+    def make_dispatch(self, indented: bool) -> tuple[dict[str, list[tuple[str, Pattern]]], list[tuple[str, Pattern]]]:
+        options = list(self.options.items())
+        table, always = make_dispatch_table([option for _, option in options], indented)
+        return {char: [options[idx] for idx in idxs] for char, idxs in table.items()}, [
+            options[idx] for idx in always
+        ]
+
+    def _parse_at(self, text: str, pos: int, memo: ParseMemo | None) -> tuple[ParseResult | None, int]:
+        if text.startswith(" ", pos):
+            table, always = self.indented_dispatch
+            key_pos = LEADING_SPACES.match(text, pos).end()
+        else:
+            table, always = self.dispatch
+            key_pos = pos
+        for tag, option in table.get(text[key_pos : key_pos + 1], always):
+            result, end = option.parse_at(text, pos, memo)
             if result is not None:
-                return ParseResult({"type": ParseResult(tag), "value": result}), remaining
-        return None, text
+                return ParseResult({"type": ParseResult(tag), "value": result}), end
+        return None, pos
+
+    def _optimize(self, seen: dict[int, Pattern]) -> Pattern:
+        return TaggedUnionPattern({tag: option.optimize(seen) for tag, option in self.options.items()})
+
+    def lookahead(self) -> Lookahead:
+        return union_lookahead(list(self.options.values()))
+
+    def indented_lookahead(self) -> Lookahead:
+        return union_lookahead(list(self.options.values()), indented=True)
 
 
 @dataclass
 class StringPiecesPattern(Pattern):
     pieces: list[Pattern]
 
-    def _parse_partial(self, text: str) -> tuple[ParseResult | None, str]:
-        all_results = []
-        rest = text
-        for piece in self.pieces:
-            parsed_piece, rest = piece.parse_partial(rest)
-            if parsed_piece is None:
-                return None, text
-            else:
-                all_results.append(parsed_piece)
-        return ParseResult("".join(x.as_string() for x in all_results)), rest
+    def _parse_at(self, text: str, pos: int, memo: ParseMemo | None) -> tuple[ParseResult | None, int]:
+        all_results, end = parse_sequence(self.pieces, text, pos, memo)
+        if all_results is None:
+            return None, pos
+        return ParseResult("".join(x.as_string() for x in all_results)), end
+
+    def _optimize(self, seen: dict[int, Pattern]) -> Pattern:
+        pieces = fuse_regex_pieces(self.pieces, seen)
+        if len(pieces) == 1 and isinstance(pieces[0], FusedRegex):
+            return ConcatenatedRegex(pieces[0].pieces)
+        return StringPiecesPattern(pieces)
+
+    def lookahead(self) -> Lookahead:
+        return sequence_lookahead(self.pieces)
+
+    def indented_lookahead(self) -> Lookahead:
+        return sequence_indented_lookahead(self.pieces)
 
 
 @dataclass
@@ -887,33 +2265,59 @@ class StructPattern(Pattern):
     pieces: list[Pattern]
     fields: dict[str, int]
 
-    def _parse_partial(self, text: str) -> tuple[ParseResult | None, str]:
-        all_results = []
-        rest = text
-        for piece in self.pieces:
-            parsed_piece, rest = piece.parse_partial(rest)
-            if parsed_piece is None:
-                return None, text
-            else:
-                all_results.append(parsed_piece)
-        return ParseResult({key: all_results[idx] for key, idx in self.fields.items()}), rest
+    def _parse_at(self, text: str, pos: int, memo: ParseMemo | None) -> tuple[ParseResult | None, int]:
+        all_results, end = parse_sequence(self.pieces, text, pos, memo)
+        if all_results is None:
+            return None, pos
+        return ParseResult({key: all_results[idx] for key, idx in self.fields.items()}), end
+
+    def _optimize(self, seen: dict[int, Pattern]) -> Pattern:
+        return StructPattern(fuse_regex_pieces(self.pieces, seen), self.fields)
+
+    def lookahead(self) -> Lookahead:
+        return sequence_lookahead(self.pieces)
+
+    def indented_lookahead(self) -> Lookahead:
+        return sequence_indented_lookahead(self.pieces)
 
 
 @dataclass
 class PrefixPattern(Pattern):
     prefix: Pattern
     pattern: Pattern
+    fused: FusedRegex | None = field(default=None, repr=False, compare=False)
 
-    def _parse_partial(self, text: str) -> tuple[ParseResult | None, str]:
-        prefix, rest = self.prefix.parse_partial(text)
+    def _parse_at(self, text: str, pos: int, memo: ParseMemo | None) -> tuple[ParseResult | None, int]:
+        if self.fused is not None:
+            results, end = self.fused.parse_pieces(text, pos)
+            if results is None:
+                return None, pos
+            return results[1], end
+
+        prefix, end = self.prefix.parse_at(text, pos, memo)
         if prefix is None:
-            return None, text
+            return None, pos
 
-        result, rest = self.pattern.parse_partial(rest)
+        result, end = self.pattern.parse_at(text, end, memo)
         if result is None:
-            return None, text
+            return None, pos
+
+        return result, end
+
+    def _optimize(self, seen: dict[int, Pattern]) -> Pattern:
+        prefix = self.prefix.optimize(seen)
+        pattern = self.pattern.optimize(seen)
+        prefix_regex = prefix.to_regex_pattern()
+        pattern_regex = pattern.to_regex_pattern()
+        if prefix_regex is not None and pattern_regex is not None:
+            return PrefixPattern(prefix, pattern, FusedRegex([prefix_regex, pattern_regex]))
+        return PrefixPattern(prefix, pattern)
 
-        return result, rest
+    def lookahead(self) -> Lookahead:
+        return sequence_lookahead([self.prefix, self.pattern])
+
+    def indented_lookahead(self) -> Lookahead:
+        return sequence_indented_lookahead([self.prefix, self.pattern])
 
 
 @dataclass
@@ -921,46 +2325,75 @@ class ListPattern(Pattern):
     first: Pattern
     rest: Pattern
 
-    def _parse_partial(self, text: str) -> tuple[ParseResult | None, str]:
-        result, rest = self.first.parse_partial(text)
+    def _parse_at(self, text: str, pos: int, memo: ParseMemo | None) -> tuple[ParseResult | None, int]:
+        result, end = self.first.parse_at(text, pos, memo)
         if result is None:
-            return ParseResult([]), text
+            return ParseResult([]), pos
         else:
             all_results = [result]
             while True:
-                result, rest = self.rest.parse_partial(rest)
+                result, end = self.rest.parse_at(text, end, memo)
                 if result is None:
-                    return ParseResult(all_results), rest
+                    return ParseResult(all_results), end
                 else:
                     all_results.append(result)
 
+    def _optimize(self, seen: dict[int, Pattern]) -> Pattern:
+        return ListPattern(self.first.optimize(seen), self.rest.optimize(seen))
+
+    def lookahead(self) -> Lookahead:
+        return self.first.lookahead()[0], True
+
 
 @dataclass
 class RepeatedString(Pattern):
     pattern: Pattern
 
-    def _parse_partial(self, text: str) -> tuple[ParseResult | None, str]:
-        rest = text
+    def _parse_at(self, text: str, pos: int, memo: ParseMemo | None) -> tuple[ParseResult | None, int]:
+        end = pos
         full_result = []
         while True:
-            result, rest = self.pattern.parse_partial(rest)
+            result, end = self.pattern.parse_at(text, end, memo)
             if result is None:
                 break
             else:
                 full_result.append(result)
-        return ParseResult("".join(x.as_string() for x in full_result)), rest
+        return ParseResult("".join(x.as_string() for x in full_result)), end
+
+    def _optimize(self, seen: dict[int, Pattern]) -> Pattern:
+        pattern = self.pattern.optimize(seen)
+        as_regex = pattern.to_regex_pattern()
+        if as_regex is None:
+            return RepeatedString(pattern)
+        return BasicRegex("(?:(?>" + as_regex.regex + "))*")
+
+    def lookahead(self) -> Lookahead:
+        return self.pattern.lookahead()[0], True
 
 
 @dataclass
 class AsString(Pattern):
     pattern: Pattern
 
-    def _parse_partial(self, text: str) -> tuple[ParseResult | None, str]:
-        result, rest = self.pattern.parse_partial(text)
+    def _parse_at(self, text: str, pos: int, memo: ParseMemo | None) -> tuple[ParseResult | None, int]:
+        result, end = self.pattern.parse_at(text, pos, memo)
         if result is None:
-            return None, text
+            return None, pos
         else:
-            return ParseResult(result.as_string()), rest
+            return ParseResult(result.as_string()), end
+
+    def _optimize(self, seen: dict[int, Pattern]) -> Pattern:
+        pattern = self.pattern.optimize(seen)
+        as_regex = pattern.to_regex_pattern()
+        if as_regex is None:
+            return AsString(pattern)
+        return as_regex
+
+    def lookahead(self) -> Lookahead:
+        return self.pattern.lookahead()
+
+    def indented_lookahead(self) -> Lookahead:
+        return self.pattern.indented_lookahead()
 
 
 @dataclass
@@ -968,15 +2401,24 @@ class WithReplacements(Pattern):
     pattern: Pattern
     replacements: list[tuple[str, str]]
 
-    def _parse_partial(self, text: str) -> tuple[ParseResult | None, str]:
-        result, rest = self.pattern.parse_partial(text)
+    def _parse_at(self, text: str, pos: int, memo: ParseMemo | None) -> tuple[ParseResult | None, int]:
+        result, end = self.pattern.parse_at(text, pos, memo)
         if result is None:
-            return None, text
+            return None, pos
         else:
             result_as_string = result.as_string()
             for key, value in self.replacements:
                 result_as_string = result_as_string.replace(key, value)
-            return ParseResult(result_as_string), rest
+            return ParseResult(result_as_string), end
+
+    def _optimize(self, seen: dict[int, Pattern]) -> Pattern:
+        return WithReplacements(self.pattern.optimize(seen), self.replacements)
+
+    def lookahead(self) -> Lookahead:
+        return self.pattern.lookahead()
+
+    def indented_lookahead(self) -> Lookahead:
+        return self.pattern.indented_lookahead()
 
 
 @dataclass
@@ -986,12 +2428,41 @@ class SwappablePattern(Pattern):
     """
 
     inner_pattern: Pattern | None
+    memoize = True
+    in_lookahead = False
 
-    def _parse_partial(self, text: str) -> tuple[ParseResult | None, str]:
+    def _parse_at(self, text: str, pos: int, memo: ParseMemo | None) -> tuple[ParseResult | None, int]:
         if self.inner_pattern is None:
             raise ValueError("Swapable pattern used without an inner pattern")
         else:
-            return self.inner_pattern.parse_partial(text)
+            return self.inner_pattern.parse_at(text, pos, memo)
+
+    def _optimize(self, seen: dict[int, Pattern]) -> Pattern:
+        if self.inner_pattern is None:
+            raise ValueError("Swapable pattern used without an inner pattern")
+        # Register the replacement before optimizing the inner pattern, which may refer back to us
+        result = SwappablePattern(None)
+        seen[id(self)] = result
+        result.inner_pattern = self.inner_pattern.optimize(seen)
+        return result
+
+    def lookahead(self) -> Lookahead:
+        if self.inner_pattern is None or self.in_lookahead:
+            return None, True
+        self.in_lookahead = True
+        try:
+            return self.inner_pattern.lookahead()
+        finally:
+            self.in_lookahead = False
+
+    def indented_lookahead(self) -> Lookahead:
+        if self.inner_pattern is None or self.in_lookahead:
+            return None, True
+        self.in_lookahead = True
+        try:
+            return self.inner_pattern.indented_lookahead()
+        finally:
+            self.in_lookahead = False
 
 
 # Patterns for parsing program files
@@ -1051,6 +2522,67 @@ SQLMut = StructPattern(
     {"block": 2},
 )
 
+Workers = BasicRegex("[0-9]+")
+
+ParallelForEachLoop = StructPattern(
+    [
+        MaybeSpaces,
+        ExactString("for"),
+        Spaces,
+        ExactString("each"),
+        Spaces,
+        ExactString("parallel"),
+        Spaces,
+        Workers,
+        SpacesOrNewLines,
+        CodeBlock,
+    ],
+    {"workers": 7, "block": 9},
+)
+ParallelForEachParagraphLoop = StructPattern(
+    [
+        MaybeSpaces,
+        ExactString("for"),
+        Spaces,
+        ExactString("each"),
+        Spaces,
+        ExactString("para"),
+        Spaces,
+        ExactString("parallel"),
+        Spaces,
+        Workers,
+        SpacesOrNewLines,
+        CodeBlock,
+    ],
+    {"workers": 9, "block": 11},
+)
+ParallelSQLReadOnly = StructPattern(
+    [
+        MaybeSpaces,
+        ExactString("/sql"),
+        Spaces,
+        ExactString("parallel"),
+        Spaces,
+        Workers,
+        SpacesOrNewLines,
+        CodeBlock,
+    ],
+    {"workers": 5, "block": 7},
+)
+ParallelSQLMut = StructPattern(
+    [
+        MaybeSpaces,
+        ExactString("/sql!"),
+        Spaces,
+        ExactString("parallel"),
+        Spaces,
+        Workers,
+        SpacesOrNewLines,
+        CodeBlock,
+    ],
+    {"workers": 5, "block": 7},
+)
+
 InfiniteLoopPattern = StructPattern(
     [
         MaybeSpaces,
@@ -1123,6 +2655,10 @@ CodeStatement = TaggedUnionPattern(
     {
         "set_var": SetVarStatement,
         "get_var": GetVarStatement,
+        "parallel_for_each_paragraph": ParallelForEachParagraphLoop,
+        "parallel_for_each": ParallelForEachLoop,
+        "parallel_sql_mut": ParallelSQLMut,
+        "parallel_sql_read_only": ParallelSQLReadOnly,
         "for_each_paragraph": ForEachParagraphLoop,
         "for_each": ForEachLoop,
         "ask": AskPattern,
@@ -1203,11 +2739,28 @@ ProcedureDefinition = StructPattern(
 )
 
 ProcedureDefinitions = ListPattern(ProcedureDefinition, ProcedureDefinition)
+OptimizedProcedureDefinition = ProcedureDefinition.optimize()
+OptimizedProcedureDefinitions = ListPattern(OptimizedProcedureDefinition, OptimizedProcedureDefinition)
+ProcedureHeader = re.compile(r"^# ", re.MULTILINE)
+
+
+class ProgramParseError(ValueError):
+    pass
 
 
-def parse_program(text: str) -> dict[str, BaseProcedure]:
+def parse_program(text: str, strict: bool = False) -> dict[str, BaseProcedure]:
+    """
+    With strict, a program that doesn't parse raises ProgramParseError instead of stopping in the
+    debugger, for when nobody is at the terminal.
+    """
     result = {}
-    parsed_data = ProcedureDefinitions.parse(text)
+    if strict:
+        parsed_data, remaining = OptimizedProcedureDefinitions.parse_partial(text)
+        if parsed_data is None or remaining.strip() != "":
+            line = text.count("\n", 0, len(text) - len(remaining)) + 1
+            raise ProgramParseError(f"couldn't parse the program from line {line}")
+    else:
+        parsed_data = OptimizedProcedureDefinitions.parse(text)
     if parsed_data is None:
         return {}
     program_code = parsed_data.as_data()
@@ -1220,6 +2773,50 @@ def parse_program(text: str) -> dict[str, BaseProcedure]:
     return result
 
 
+def split_program_sections(text: str) -> list[str] | None:
+    """
+    Splits a program into the text of each procedure, from its "# name" header up to the next
+    one. Returns None if there is text before the first header.
+    """
+    starts = [match.start() for match in ProcedureHeader.finditer(text)]
+    if len(starts) == 0 or text[: starts[0]].strip() != "":
+        return None
+    return [text[start:end] for start, end in zip(starts, starts[1:] + [len(text)])]
+
+
+def parse_section(text: str) -> tuple[str, BaseProcedure] | None:
+    """
+    Parses the text of a single procedure. Returns None unless the whole text is one procedure,
+    eg. when a string in the procedure contains a line that looks like a header.
+    """
+    parsed_data, end = OptimizedProcedureDefinition.parse_at(text, 0, {})
+    if parsed_data is None or text[end:].strip() != "":
+        return None
+    proc = parsed_data.as_data()
+    assert isinstance(proc, dict)
+    assert isinstance(proc["body"], dict)
+    assert isinstance(proc["name"], str)
+    if has_unterminated_string(proc["body"]):
+        return None
+    return proc["name"], make_procedure(proc["body"], proc["name"])
+
+
+def has_unterminated_string(data: CompoundType) -> bool:
+    """
+    Whether parsed code has a string that isn't closed, which is parsed as a procedure call. The
+    string may be closed after a line that looks like a header, so the text after that line is
+    part of the same procedure.
+    """
+    if isinstance(data, dict):
+        if data.get("type") == "call":
+            value = data["value"]
+            return isinstance(value, dict) and str(value["name"]).startswith('"')
+        return any(has_unterminated_string(value) for value in data.values())
+    if isinstance(data, list):
+        return any(has_unterminated_string(value) for value in data)
+    return False
+
+
 def make_procedure(proc: dict, name: str) -> BaseProcedure:
     if proc["type"] == "procedure":
         proc = proc["value"]
@@ -1282,6 +2879,18 @@ def make_statements(statements: list[dict]) -> list[Statement]:
                         False,
                     )
                 )
+            case "parallel_for_each":
+                block = Procedure(make_statements(statement["block"]["statements"]))
+                result.append(ParallelLoop(ForEach(block), int(statement["workers"])))
+            case "parallel_for_each_paragraph":
+                block = Procedure(make_statements(statement["block"]["statements"]))
+                result.append(ParallelLoop(ForEachParagraph(block), int(statement["workers"])))
+            case "parallel_sql_read_only":
+                block = Procedure(make_statements(statement["block"]["statements"]))
+                result.append(ParallelLoop(SQLStatement(block, True), int(statement["workers"])))
+            case "parallel_sql_mut":
+                block = Procedure(make_statements(statement["block"]["statements"]))
+                result.append(ParallelLoop(SQLStatement(block, False), int(statement["workers"])))
             case "loop":
                 result.append(InfiniteLoop(Procedure(make_statements(statement["block"]["statements"]))))
             case "llm":
@@ -1316,26 +2925,188 @@ def make_statements(statements: list[dict]) -> list[Statement]:
 
 
 class SQLManager:
-    def __init__(self, filename="data.db") -> None:
+    def __init__(self, filename="data.db", cached_statements: int = 128, wal: bool = False) -> None:
         self.filename = filename
-        self.connection = sqlite3.connect(self.filename)
+        # How many prepared statements each connection keeps
+        self.cached_statements = cached_statements
+        # Whether to put the database in WAL mode, which stays that way after the program ends
+        self.wal = wal
+        # sqlite connections can't be shared between threads, so parallel loops get one each
+        self.local = threading.local()
+        # Every open connection, with the thread it belongs to
+        self.connections: dict[sqlite3.Connection, threading.Thread] = {}
+        self.connections_lock = threading.Lock()
+        # The names of the parameters in each query, found the first time it's run
+        self.param_names: dict[str, list[str]] = {}
+        self.profiler: Profiler | None = None
+        # Whether a failing query stops in the debugger before the error is raised
+        self.debug_errors = True
+
+    def record(self, query: str, start: float) -> None:
+        if self.profiler is not None:
+            self.profiler.add(self.profiler.sql, query, time.perf_counter() - start)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            # Each connection is only used by its own thread, but __del__ may close it from another
+            connection = sqlite3.connect(
+                self.filename, check_same_thread=False, cached_statements=self.cached_statements
+            )
+            self.local.connection = connection
+            with self.connections_lock:
+                self.connections[connection] = threading.current_thread()
+            if self.wal:
+                connection.execute("pragma journal_mode = WAL;")
+        return connection
+
+    @cached_property
+    def lazy_queries(self) -> bool:
+        """
+        Whether read only queries in loops can fetch their rows as they're needed. Each query has
+        its own connection, which keeps seeing the database as it was when the query started, so
+        the database has to be in WAL mode for other statements to write to it meanwhile. An in
+        memory database can't be opened twice.
+        """
+        if self.filename in ("", ":memory:"):
+            return False
+        return self.connection.execute("pragma journal_mode;").fetchone()[0] == "wal"
+
+    def open_read_connection(self) -> sqlite3.Connection:
+        # Opening the main connection first makes sure the database file exists
+        self.connection
+        uri = f"file:{urllib.parse.quote(os.path.abspath(self.filename))}?mode=ro"
+        return sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=self.cached_statements)
+
+    def use_wal(self) -> None:
+        """
+        Puts the database in WAL mode, so it can be read while it's being written, including by
+        other processes.
+        """
+        self.connection.execute("pragma journal_mode = WAL;")
 
     def execute_sql_script(self, query: str) -> None:
         cur = self.connection.cursor()
         cur.executescript(query)
         self.connection.commit()
 
+    @property
+    def read_connection(self) -> sqlite3.Connection | None:
+        """
+        A read only connection for read only statements. Returns None for an in memory database,
+        which can't be opened twice.
+        """
+        if self.filename in ("", ":memory:"):
+            return None
+        connection = getattr(self.local, "read_connection", None)
+        if connection is None:
+            connection = self.open_read_connection()
+            self.local.read_connection = connection
+            with self.connections_lock:
+                self.connections[connection] = threading.current_thread()
+        return connection
+
+    def open_query(
+        self, query: str, get_value: Callable[[str], str] | None, skip: int = 0
+    ) -> "SQLRowIterator | None":
+        """
+        Runs a read only query, returning an iterator that fetches its rows in chunks as they're
+        needed, after skipping the first skip rows. Returns None if the rows have to be fetched
+        all at once with execute_sql.
+        """
+        if not self.lazy_queries:
+            return None
+        start = time.perf_counter() if self.profiler is not None else 0.0
+        # The open query keeps its connection reading the database as it was when it started, so
+        # it can't be shared with other statements, which should see the loop's own writes
+        connection = self.open_read_connection()
+        cur = connection.cursor()
+        try:
+            params = self._execute(connection, cur, query, get_value)
+        except BaseException:
+            connection.close()
+            raise
+        self.record(query, start)
+        result = SQLRowIterator(connection, cur, query, params, self)
+        result.skip(skip)
+        return result
+
     def execute_sql(
         self, query: str, read_only: bool, get_value: Callable[[str], str] | None
     ) -> Iterator[dict[str, str]]:
-        cur = self.connection.cursor()
+        start = time.perf_counter() if self.profiler is not None else 0.0
+        connection = None
+        # The read only connection can't see writes this thread hasn't committed yet, which happens
+        # when a statement reads inside the loop over the rows of a /sql! statement
+        if read_only and not self.connection.in_transaction:
+            connection = self.read_connection
+        if connection is not None:
+            # Fetching every row and closing the cursor ends the read, so the next statement on the
+            # connection sees everything committed since
+            cur = connection.cursor()
+            self._execute(connection, cur, query, get_value)
+            rows = cur.fetchall()
+            columns = [] if cur.description is None else [column[0] for column in cur.description]
+            cur.close()
+            self.record(query, start)
+            for row in rows:
+                yield dict(zip(columns, row))
+            return
+
+        # An in memory database has no separate read only connection
+        connection = self.connection
+        in_transaction = connection.in_transaction
+        cur = connection.cursor()
         if read_only:
             cur.execute("pragma query_only = ON;")
-        data: dict[str, str] = {}
+        try:
+            self._execute(connection, cur, query, get_value)
+            rows = cur.fetchall()
+            columns = [] if cur.description is None else [column[0] for column in cur.description]
+        finally:
+            # Also when the query fails, so later statements can still write
+            if read_only:
+                cur.execute("pragma query_only = OFF;")
+        self.record(query, start)
+
+        for row in rows:
+            yield dict(zip(columns, row))
+
+        if read_only:
+            # Leave the uncommitted writes of an enclosing /sql! for it to commit
+            if not in_transaction:
+                connection.rollback()
+        else:
+            connection.commit()
+
+    def _execute(
+        self,
+        connection: sqlite3.Connection,
+        cur: sqlite3.Cursor,
+        query: str,
+        get_value: Callable[[str], str] | None,
+    ) -> dict[str, str]:
+        """
+        Executes the query, filling in its parameters from get_value. Returns the parameters.
+        """
+        names = self.param_names.get(query)
+        if names is not None:
+            data = {name: "" if get_value is None else get_value(name) for name in names}
+            try:
+                cur.execute(query, data)
+                return data
+            except Exception:
+                # Find the parameters again below, which reports the error if there is one
+                pass
+
+        # sqlite reports the first parameter that doesn't have a value, so fill them in one at a time
+        data = {}
         while True:
             try:
                 cur.execute(query, data)
-                break
+                self.param_names[query] = list(data.keys())
+                return data
             except sqlite3.ProgrammingError as e:
                 pattern = re.compile(r"^[^:]*:(.*)\.$")
                 match = pattern.match(e.args[0])
@@ -1347,51 +3118,560 @@ class SQLManager:
                         data[key_name] = get_value(key_name)
                 else:
                     print(f"Error on query: {query}")
-                    self.connection.rollback()
+                    connection.rollback()
                     traceback.print_exc()
-                    breakpoint()
+                    if self.debug_errors:
+                        breakpoint()
                     raise
             except Exception as e:
                 print(f"Error on query: {query}")
-                self.connection.rollback()
+                connection.rollback()
                 traceback.print_exc()
-                breakpoint()
+                if self.debug_errors:
+                    breakpoint()
                 raise
 
-        for row in cur.fetchall():
-            result = {}
-            for col, value in zip(cur.description, row):
-                result[col[0]] = value
-            yield result
+    def close(self) -> None:
+        """
+        Closes every connection. Statements run afterwards open new ones, so this can be used to
+        avoid carrying open connections into a forked process.
+        """
+        with self.connections_lock:
+            connections, self.connections = self.connections, {}
+        self.local = threading.local()
+        for connection in connections:
+            connection.close()
 
-        if read_only:
-            self.connection.rollback()
-        else:
-            self.connection.commit()
-        cur.execute("pragma query_only = OFF;")
+    def close_thread_connections(self) -> None:
+        """
+        Closes the connections of the current thread, for threads that end before the manager
+        does.
+        """
+        connections = [getattr(self.local, name, None) for name in ("connection", "read_connection")]
+        self.local.connection = None
+        self.local.read_connection = None
+        with self.connections_lock:
+            for connection in connections:
+                if connection is not None:
+                    self.connections.pop(connection, None)
+        for connection in connections:
+            if connection is not None:
+                connection.close()
+
+    def close_finished_thread_connections(self) -> None:
+        """
+        Closes the connections of threads that have ended, like the workers of a parallel loop
+        that's done.
+        """
+        with self.connections_lock:
+            finished = [connection for connection, thread in self.connections.items() if not thread.is_alive()]
+            for connection in finished:
+                del self.connections[connection]
+        for connection in finished:
+            connection.close()
 
     def __del__(self) -> None:
-        self.connection.close()
+        for connection in self.connections:
+            connection.close()
 
 
-class BaseLLMManager:
-    sql_manager: "SQLManager"
-    checked: bool
+class SQLRowIterator:
+    """
+    The rows of a query, fetched from its cursor a chunk at a time as a loop needs them. Rows are
+    kept as tuples until they're used. The connection belongs to the iterator, and is closed once
+    all the rows have been fetched or the loop ends.
+    """
 
-    def check(self) -> None:
-        if self.checked:
-            return
+    def __init__(
+        self,
+        connection: sqlite3.Connection,
+        cursor: sqlite3.Cursor,
+        query: str,
+        params: dict[str, str],
+        manager: SQLManager | None = None,
+        chunk_size: int = 256,
+    ) -> None:
+        self.connection = connection
+        self.cursor = cursor
+        self.query = query
+        self.params = params
+        # Only used to record how long fetching takes when profiling
+        self.manager = manager
+        self.chunk_size = chunk_size
+        self.columns = [] if cursor.description is None else [column[0] for column in cursor.description]
+        self.ready: deque[tuple] = deque()
+        self.exhausted = False
+        # How many rows have been used, so a checkpoint can pick up from the same row
+        self.consumed = 0
+
+    def __len__(self) -> int:
+        if len(self.ready) == 0 and not self.exhausted:
+            manager = self.manager if self.manager is not None and self.manager.profiler is not None else None
+            start = time.perf_counter() if manager is not None else 0.0
+            rows = self.cursor.fetchmany(self.chunk_size)
+            if manager is not None:
+                manager.record(self.query, start)
+            if len(rows) == 0:
+                self.exhausted = True
+                self.cursor.close()
+                self.connection.close()
+            else:
+                self.ready.extend(rows)
+        return len(self.ready)
+
+    def popleft(self) -> dict[str, str]:
+        if len(self.ready) == 0:
+            # After resuming from a checkpoint, the emptiness check may not have fetched this row yet
+            len(self)
+        self.consumed += 1
+        return dict(zip(self.columns, self.ready.popleft()))
+
+    def skip(self, rows: int) -> None:
+        while rows > 0 and len(self) > 0:
+            self.popleft()
+            rows -= 1
+
+    def close(self) -> None:
+        if not self.exhausted:
+            self.exhausted = True
+            self.ready.clear()
+            self.cursor.close()
+            self.connection.close()
+
+
+class BytecodeUnpickler(pickle.Unpickler):
+    """
+    Bytecode pickled while this file runs as a script refers to __main__, and to aicoding when it
+    is imported. Resolve both to the classes defined here.
+    """
+
+    def find_class(self, module: str, name: str):
+        if module in ("__main__", __name__):
+            return globals()[name]
+        return super().find_class(module, name)
+
+
+@dataclass
+class ProgramSection:
+    section_hash: str
+    name: str
+    procedure: BaseProcedure
+    bytecode: list[BaseByteCode] | None
+    is_new: bool
+
+
+class ProgramCache:
+    """
+    Stores compiled bytecode on disk, keyed by a hash of the program text and the interpreter
+    version, so running an unchanged program skips parsing and compiling entirely.
+
+    When a program has changed, it is split into procedure sections, and only the sections that
+    changed are parsed and compiled again.
+
+    Only the keep_programs programs and keep_sections sections saved most recently are kept, so
+    the file doesn't keep growing with every edit of a program.
+    """
+
+    def __init__(self, filename="program_cache.db", keep_programs: int = 100, keep_sections: int = 2000) -> None:
+        self.keep_programs = keep_programs
+        self.keep_sections = keep_sections
+        self.sql_manager = SQLManager(filename)
         self.sql_manager.execute_sql_script(
             """
-        create table if not exists responses(
-            model_id text,
-            prompt_hash text,
-            data text,
-            response text,
-            deleted integer default 0,
+        create table if not exists compiled_programs(
+            program_hash text primary key,
+            bytecode blob,
             created_at timestamp default current_timestamp);
-        create table if not exists llm_models(
-            id integer primary key,
+        create table if not exists program_sections(
+            section_hash text primary key,
+            name text,
+            procedure blob,
+            bytecode blob,
+            created_at timestamp default current_timestamp);
+        """
+        )
+
+    @staticmethod
+    def get_program_hash(text: str) -> str:
+        return hashlib.sha256(f"{INTERPRETER_VERSION}:{text}".encode()).hexdigest()
+
+    def load_sections(self, text: str) -> list[ProgramSection] | None:
+        """
+        Returns the procedures of a program, reusing the procedures and bytecode of sections that
+        have been seen before and parsing the rest. Returns None if the program has to be parsed as
+        a whole.
+        """
+        section_texts = split_program_sections(text)
+        if section_texts is None:
+            return None
+        hashes = [self.get_program_hash(section_text) for section_text in section_texts]
+        known = {}
+        for row in self.sql_manager.execute_sql(
+            """select section_hash, name, procedure, bytecode from program_sections
+            where section_hash in (select value from json_each(:hashes))""",
+            True,
+            ValueGetter(hashes=json.dumps(hashes)),
+        ):
+            try:
+                procedure = BytecodeUnpickler(io.BytesIO(row["procedure"])).load()
+                bytecode = BytecodeUnpickler(io.BytesIO(row["bytecode"])).load()
+            except Exception:
+                log("Ignoring unreadable section in the program cache")
+                continue
+            known[row["section_hash"]] = ProgramSection(row["section_hash"], row["name"], procedure, bytecode, False)
+
+        result = []
+        for section_hash, section_text in zip(hashes, section_texts):
+            if section_hash in known:
+                result.append(known[section_hash])
+                continue
+            parsed = parse_section(section_text)
+            if parsed is None:
+                return None
+            name, procedure = parsed
+            result.append(ProgramSection(section_hash, name, procedure, None, True))
+        return result
+
+    def compile_sections(self, sections: list[ProgramSection], system: System) -> dict[str, list[BaseByteCode]]:
+        """
+        Compiles the sections that were parsed by load_sections, saves them, and returns the
+        bytecode of the whole program.
+        """
+        for section in sections:
+            if section.bytecode is None:
+                section.bytecode = section.procedure.compile(system)
+            if section.is_new:
+                list(
+                    self.sql_manager.execute_sql(
+                        """insert or replace into program_sections(section_hash, name, procedure, bytecode)
+                        values (:section_hash, :name, :procedure, :bytecode)""",
+                        False,
+                        ValueGetter(
+                            section_hash=section.section_hash,
+                            name=section.name,
+                            procedure=pickle.dumps(section.procedure),
+                            bytecode=pickle.dumps(section.bytecode),
+                        ),
+                    )
+                )
+                section.is_new = False
+        # Sections still in use count as new, so they aren't dropped while the program uses them
+        list(
+            self.sql_manager.execute_sql(
+                """update program_sections set created_at = current_timestamp
+                where section_hash in (select value from json_each(:hashes))""",
+                False,
+                ValueGetter(hashes=json.dumps([section.section_hash for section in sections])),
+            )
+        )
+        self._evict("program_sections", self.keep_sections)
+        result = {}
+        for section in sections:
+            assert section.bytecode is not None
+            result[section.name] = section.bytecode
+        return result
+
+    def load(self, text: str) -> dict[str, list[BaseByteCode]] | None:
+        rows = list(
+            self.sql_manager.execute_sql(
+                "select bytecode from compiled_programs where program_hash = :program_hash",
+                True,
+                ValueGetter(program_hash=self.get_program_hash(text)),
+            )
+        )
+        if len(rows) == 0:
+            return None
+        try:
+            return BytecodeUnpickler(io.BytesIO(rows[0]["bytecode"])).load()
+        except Exception:
+            # Entries written by an older version of this file may no longer unpickle
+            log("Ignoring unreadable entry in the program cache")
+            return None
+
+    def save(self, text: str, compiled_procedures: dict[str, list[BaseByteCode]]) -> None:
+        list(
+            self.sql_manager.execute_sql(
+                "insert or replace into compiled_programs(program_hash, bytecode) values (:program_hash, :bytecode)",
+                False,
+                ValueGetter(program_hash=self.get_program_hash(text), bytecode=pickle.dumps(compiled_procedures)),
+            )
+        )
+        self._evict("compiled_programs", self.keep_programs)
+
+    def _evict(self, table: str, keep: int) -> None:
+        # Rows saved within the same second are told apart by rowid, which insert or replace renews
+        list(
+            self.sql_manager.execute_sql(
+                f"""delete from {table} where rowid not in
+                (select rowid from {table} order by created_at desc, rowid desc limit :keep)""",
+                False,
+                ValueGetter(keep=keep),
+            )
+        )
+
+    def clear(self) -> None:
+        self.sql_manager.execute_sql_script("delete from compiled_programs; delete from program_sections;")
+
+
+class CheckpointStore:
+    """
+    The last saved state of each run of a program with checkpoints, so a run that was interrupted
+    can carry on from there instead of starting again. A run is the program, the procedure it
+    started from and its input, so runs of the same program on different inputs don't share
+    checkpoints. The large values that states refer to are saved alongside them.
+    """
+
+    def __init__(self, program_hash: str, procedure: str | None, input_id: str, filename="checkpoints.db") -> None:
+        self.program_hash = program_hash
+        self.procedure = procedure or ""
+        self.input_id = input_id
+        self.run_key = hashlib.sha256(f"{program_hash}:{self.procedure}:{input_id}".encode()).hexdigest()
+        self.sql_manager = SQLManager(filename)
+        self.sql_manager.execute_sql_script(
+            """
+        create table if not exists run_checkpoints(
+            run_key text primary key,
+            program_hash text,
+            procedure text,
+            input_id text,
+            state text,
+            created_at timestamp default current_timestamp);
+        create index if not exists run_checkpoints_program_hash_idx on run_checkpoints(program_hash);
+        create table if not exists checkpoint_values(
+            run_key text,
+            value_key text,
+            value text,
+            primary key (run_key, value_key));
+        """
+        )
+
+    def save(self, state: dict) -> None:
+        state = dict(state)
+        for key, value in state.pop("values").items():
+            list(
+                self.sql_manager.execute_sql(
+                    "insert or replace into checkpoint_values(run_key, value_key, value) values (:run_key, :value_key, :value)",
+                    False,
+                    ValueGetter(run_key=self.run_key, value_key=key, value=json.dumps(value, default=str)),
+                )
+            )
+        list(
+            self.sql_manager.execute_sql(
+                """insert or replace into run_checkpoints(run_key, program_hash, procedure, input_id, state)
+                values (:run_key, :program_hash, :procedure, :input_id, :state)""",
+                False,
+                ValueGetter(
+                    run_key=self.run_key,
+                    program_hash=self.program_hash,
+                    procedure=self.procedure,
+                    input_id=self.input_id,
+                    state=json.dumps(state, default=str),
+                ),
+            )
+        )
+        # Values that were replaced since the last checkpoint aren't needed any more
+        list(
+            self.sql_manager.execute_sql(
+                """delete from checkpoint_values where run_key = :run_key
+                and value_key not in (select value from json_each(:keys))""",
+                False,
+                ValueGetter(run_key=self.run_key, keys=json.dumps(stored_keys(state))),
+            )
+        )
+
+    def load(self) -> dict | None:
+        for row in self.sql_manager.execute_sql(
+            "select state from run_checkpoints where run_key = :run_key",
+            True,
+            ValueGetter(run_key=self.run_key),
+        ):
+            state = json.loads(row["state"])
+            state["values"] = {
+                value_row["value_key"]: json.loads(value_row["value"])
+                for value_row in self.sql_manager.execute_sql(
+                    "select value_key, value from checkpoint_values where run_key = :run_key",
+                    True,
+                    ValueGetter(run_key=self.run_key),
+                )
+            }
+            return state
+        return None
+
+    def other_runs(self) -> list[tuple[str, str]]:
+        """
+        The procedures and inputs of the other runs of this program that have checkpoints.
+        """
+        return [
+            (row["procedure"], row["input_id"])
+            for row in self.sql_manager.execute_sql(
+                "select procedure, input_id from run_checkpoints where program_hash = :program_hash and run_key != :run_key",
+                True,
+                ValueGetter(program_hash=self.program_hash, run_key=self.run_key),
+            )
+        ]
+
+    def clear(self) -> None:
+        for query in (
+            "delete from run_checkpoints where run_key = :run_key",
+            "delete from checkpoint_values where run_key = :run_key",
+        ):
+            list(self.sql_manager.execute_sql(query, False, ValueGetter(run_key=self.run_key)))
+
+
+def stored_keys(data: object) -> list[str]:
+    """
+    The keys of the stored values a state refers to.
+    """
+    if isinstance(data, dict):
+        if "stored" in data and len(data) == 1:
+            return [data["stored"]]
+        return [key for value in data.values() for key in stored_keys(value)]
+    if isinstance(data, list):
+        return [key for value in data for key in stored_keys(value)]
+    return []
+
+
+def input_identity(path: str | None, text: str | None) -> str:
+    """
+    Identifies the input of a run: a file by its path, size and modification time, so it isn't
+    read just for this, and stdin by a hash of what was read from it.
+    """
+    if path is not None:
+        stat = os.stat(path)
+        return f"file:{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    assert text is not None
+    return f"stdin:{hashlib.sha256(text.encode()).hexdigest()}"
+
+
+def make_model_file(proc: LLMProcedure) -> str:
+    message_list = "\n".join([f"MESSAGE {x[0]} {x[1]}" for x in proc.history])
+    return f'''FROM {proc.model}
+SYSTEM """{proc.system}"""
+{message_list}
+'''
+
+
+def model_ids(proc: LLMProcedure) -> tuple[str, str]:
+    """
+    The model id of the procedure, and the id of the model file it runs on.
+    """
+    messages_flat = ":".join([x[0] + ":" + x[1] for x in proc.history])
+    data = re.compile(r"[^a-zA-Z0-9\{\}\-_]+").sub(" ", f"{proc.model}{proc.system}{proc.prompt}{messages_flat}")
+    model_id = hashlib.sha256(data.encode()).hexdigest()
+    data = re.compile(r"[^a-zA-Z0-9\{\}\-_]+").sub(" ", f"{proc.model}{proc.system}{messages_flat}")
+    model_file_id = hashlib.sha256(data.encode()).hexdigest()
+    return model_id, model_file_id
+
+
+class LLMHostError(RuntimeError):
+    pass
+
+
+class ReplayMissError(RuntimeError):
+    pass
+
+
+def finish_text(text: StreamingText, future: Future) -> None:
+    error = future.exception()
+    if error is None:
+        text.append(future.result())
+    text.finish(error)
+
+
+def stream_process(command: list[str], prompt: str, text: StreamingText) -> None:
+    """
+    Runs command with prompt as its input, writing its output to text as it comes.
+    """
+    with tempfile.TemporaryFile() as stderr:
+        process = sp.Popen(command, stdin=sp.PIPE, stdout=sp.PIPE, stderr=stderr)
+        assert process.stdin is not None and process.stdout is not None
+        process.stdin.write(prompt.encode())
+        process.stdin.close()
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while True:
+            chunk = process.stdout.read1(4096)
+            if chunk == b"":
+                break
+            text.append(decoder.decode(chunk))
+        text.append(decoder.decode(b"", final=True))
+        process.stdout.close()
+        if process.wait() != 0 or text.written() == "":
+            stderr.seek(0)
+            raise LLMHostError(f"{' '.join(command)} failed: {stderr.read().decode(errors='replace').strip()}")
+
+
+class ResponseCache:
+    """
+    Recently used LLM responses, keyed by model id and prompt hash. Once the responses add up to
+    more than max_bytes, the least recently used ones are dropped.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: OrderedDict[tuple[str, str], str] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, model_id: str, prompt_hash: str) -> str | None:
+        key = (model_id, prompt_hash)
+        with self.lock:
+            result = self.entries.get(key)
+            if result is not None:
+                self.entries.move_to_end(key)
+            return result
+
+    def put(self, model_id: str, prompt_hash: str, response: str) -> None:
+        key = (model_id, prompt_hash)
+        size = len(response.encode())
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous.encode())
+            self.entries[key] = response
+            self.size += size
+            while self.size > self.max_bytes:
+                _, dropped = self.entries.popitem(last=False)
+                self.size -= len(dropped.encode())
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class BaseLLMManager:
+    def __init__(self, sql_manager: "SQLManager") -> None:
+        self.sql_manager = sql_manager
+        self.checked = False
+        self.response_cache = ResponseCache()
+        # The model ids of procedures already registered in the database, by procedure
+        self.registered_models: dict[tuple, tuple[str, str]] = {}
+        self.registration_lock = threading.Lock()
+        # Responses currently being fetched, by model id and prompt hash
+        self.in_flight: dict[tuple[str, str], Future] = {}
+        self.in_flight_lock = threading.Lock()
+        self.profiler: Profiler | None = None
+
+    def record(self, kind: str, start: float) -> None:
+        if self.profiler is not None:
+            self.profiler.add(self.profiler.llm, kind, time.perf_counter() - start)
+
+    def check(self) -> None:
+        if self.checked:
+            return
+        self.sql_manager.execute_sql_script(
+            """
+        create table if not exists responses(
+            model_id text,
+            prompt_hash text,
+            data text,
+            response text,
+            deleted integer default 0,
+            created_at timestamp default current_timestamp);
+        create table if not exists llm_models(
+            id integer primary key,
             model_id text,
             model_file_id text,
             model text,
@@ -1404,6 +3684,8 @@ class BaseLLMManager:
             model_id text,
             name text);
         create unique index if not exists llm_model_names_idx on llm_model_names(model_id, name);
+        create index if not exists responses_lookup_idx on responses(model_id, prompt_hash, deleted);
+        create index if not exists llm_models_model_file_id_idx on llm_models(model_file_id);
         """
         )
         self.check_llm_host()
@@ -1412,12 +3694,14 @@ class BaseLLMManager:
     def check_llm_host(self) -> None:
         pass
 
+    def close(self) -> None:
+        """
+        Stops whatever the runner keeps open between calls, like connections to its host.
+        """
+        pass
+
     def _get_model_id(self, proc: LLMProcedure) -> tuple[str, str]:
-        messages_flat = ":".join([x[0] + ":" + x[1] for x in proc.history])
-        data = re.compile(r"[^a-zA-Z0-9\{\}\-_]+").sub(" ", f"{proc.model}{proc.system}{proc.prompt}{messages_flat}")
-        model_id = hashlib.sha256(data.encode()).hexdigest()
-        data = re.compile(r"[^a-zA-Z0-9\{\}\-_]+").sub(" ", f"{proc.model}{proc.system}{messages_flat}")
-        model_file_id = hashlib.sha256(data.encode()).hexdigest()
+        model_id, model_file_id = model_ids(proc)
         model_exists = list(
             self.sql_manager.execute_sql(
                 "select count(*) as count from llm_models where model_file_id=:model_file_id",
@@ -1426,11 +3710,7 @@ class BaseLLMManager:
             )
         )[0]["count"]
         if model_exists == 0:
-            message_list = "\n".join([f"MESSAGE {x[0]} {x[1]}" for x in proc.history])
-            model_file = f'''FROM {proc.model}
-SYSTEM """{proc.system}"""
-{message_list}
-'''
+            model_file = make_model_file(proc)
             if not self._upload_model_file(model_file_id, model_file):
                 raise RuntimeError("Can't upload model")
             list(
@@ -1463,6 +3743,38 @@ SYSTEM """{proc.system}"""
             )
         return model_id, model_file_id
 
+    def register_model(self, procedure: LLMProcedure) -> tuple[str, str]:
+        """
+        Makes sure the procedure's model exists, and returns its model id and model file id. This
+        only touches the database the first time it's called for each procedure.
+        """
+        key = (
+            procedure.name,
+            procedure.model,
+            procedure.system,
+            procedure.prompt,
+            tuple(tuple(message) for message in procedure.history),
+        )
+        result = self.registered_models.get(key)
+        if result is not None:
+            return result
+        with self.registration_lock:
+            result = self.registered_models.get(key)
+            if result is not None:
+                return result
+            self.check()
+            model_id, model_file_id = self._get_model_id(procedure)
+            list(
+                self.sql_manager.execute_sql(
+                    "insert into llm_model_names(model_id, name) values (:model_id, :name) on conflict do nothing",
+                    False,
+                    ValueGetter(model_id=model_id, name=procedure.name),
+                )
+            )
+            result = (model_id, model_file_id)
+            self.registered_models[key] = result
+        return result
+
     def check_model_existance(self, model_file_id: str) -> bool:
         raise NotImplementedError()
 
@@ -1479,17 +3791,104 @@ SYSTEM """{proc.system}"""
         return hashlib.sha256(":".join(text).encode()).hexdigest()
 
     def run_llm(self, procedure: LLMProcedure, data: dict[str, str]) -> str:
+        start = time.perf_counter()
         self.check()
-        result = None
         prompt_hash = self._get_input_data_hash(data)
-        model_id, model_file_id = self._get_model_id(procedure)
-        list(
-            self.sql_manager.execute_sql(
-                "insert into llm_model_names(model_id, name) values (:model_id, :name) on conflict do nothing",
-                False,
-                ValueGetter(model_id=model_id, name=procedure.name),
-            )
-        )
+        model_id, model_file_id = self.register_model(procedure)
+        result = self.response_cache.get(model_id, prompt_hash)
+        if result is not None:
+            self.record("memory_hit", start)
+            return result
+
+        # If another thread is already getting this response, wait for it instead of asking again
+        key = (model_id, prompt_hash)
+        with self.in_flight_lock:
+            in_flight = self.in_flight.get(key)
+            if in_flight is None:
+                self.in_flight[key] = Future()
+        if in_flight is not None:
+            result = in_flight.result()
+            self.record("coalesced", start)
+            return result
+        try:
+            result = self._lookup_response(model_id, prompt_hash)
+            kind = "db_hit"
+            if result is None:
+                kind = "miss"
+                result = self.run_model(model_file_id, procedure.prompt.format(**data))
+                self._save_response(model_id, prompt_hash, data, result)
+        except BaseException as e:
+            self._finish_in_flight(key, error=e)
+            raise
+        self._finish_in_flight(key, result)
+        self.record(kind, start)
+        return result
+
+    def stream_llm(self, procedure: LLMProcedure, data: dict[str, str]) -> StreamingText:
+        """
+        Like run_llm, but returns the response while it's still being generated. The response is
+        saved once it's complete.
+        """
+        start = time.perf_counter()
+        self.check()
+        prompt_hash = self._get_input_data_hash(data)
+        model_id, model_file_id = self.register_model(procedure)
+        result = self.response_cache.get(model_id, prompt_hash)
+        if result is not None:
+            self.record("memory_hit", start)
+            return StreamingText.complete(result)
+
+        text = StreamingText()
+        key = (model_id, prompt_hash)
+        with self.in_flight_lock:
+            in_flight = self.in_flight.get(key)
+            if in_flight is None:
+                self.in_flight[key] = Future()
+        if in_flight is not None:
+            in_flight.add_done_callback(lambda future: finish_text(text, future))
+            self.record("coalesced", start)
+            return text
+        try:
+            result = self._lookup_response(model_id, prompt_hash)
+        except BaseException as e:
+            self._finish_in_flight(key, error=e)
+            raise
+        if result is not None:
+            self._finish_in_flight(key, result)
+            self.record("db_hit", start)
+            return StreamingText.complete(result)
+
+        prompt = procedure.prompt.format(**data)
+
+        def generate() -> None:
+            try:
+                self.stream_model(model_file_id, prompt, text)
+                result = text.written()
+                self._save_response(model_id, prompt_hash, data, result)
+            except BaseException as e:
+                self._finish_in_flight(key, error=e)
+                text.finish(e)
+                return
+            finally:
+                # Saving opened a connection for this thread, which ends here
+                self.sql_manager.close_thread_connections()
+            self._finish_in_flight(key, result)
+            self.record("miss", start)
+            text.finish()
+
+        threading.Thread(target=generate, daemon=True).start()
+        return text
+
+    def _finish_in_flight(self, key: tuple[str, str], result: str | None = None, error: BaseException | None = None):
+        with self.in_flight_lock:
+            in_flight = self.in_flight.pop(key)
+        if error is None:
+            in_flight.set_result(result)
+        else:
+            in_flight.set_exception(error)
+
+    def _lookup_response(self, model_id: str, prompt_hash: str) -> str | None:
+        result = None
         for row in self.sql_manager.execute_sql(
             "select response from responses where model_id = :model_id and prompt_hash=:prompt_hash and deleted = 0",
             True,
@@ -1498,8 +3897,11 @@ SYSTEM """{proc.system}"""
             result = row["response"].strip()
             break
         if result is not None and result != "":
+            self.response_cache.put(model_id, prompt_hash, result)
             return result
-        result = self.run_model(model_file_id, procedure.prompt.format(**data))
+        return None
+
+    def _save_response(self, model_id: str, prompt_hash: str, data: dict[str, str], result: str) -> None:
         list(
             self.sql_manager.execute_sql(
                 "insert into responses(model_id, prompt_hash, data, response) values (:model_id, :prompt_hash, :data, :response)",
@@ -1507,88 +3909,826 @@ SYSTEM """{proc.system}"""
                 ValueGetter(model_id=model_id, prompt_hash=prompt_hash, data=json.dumps(data), response=result),
             )
         )
-        return result
+        if result != "":
+            self.response_cache.put(model_id, prompt_hash, result)
 
     def run_model(self, model_file_id: str, prompt: str) -> str:
         raise NotImplementedError()
 
+    def stream_model(self, model_file_id: str, prompt: str, text: StreamingText) -> None:
+        """
+        Writes the response to text as it's generated. Runners that can't stream write it all at
+        once.
+        """
+        text.append(self.run_model(model_file_id, prompt))
+
 
 class RemoteLLMRunner(BaseLLMManager):
+    """
+    Runs ollama on another machine over ssh. All the ssh commands share one connection to the host,
+    which is opened before the first command and closed when the program exits, so only the first
+    command pays for the ssh handshake.
+    """
+
     def __init__(self, llm_host) -> None:
-        self.sql_manager = SQLManager("llm_data.db")
-        self.checked = False
+        super().__init__(SQLManager("llm_data.db"))
         self.llm_host = llm_host
+        self.control_dir = tempfile.mkdtemp(prefix="aicoding-ssh-")
+        self.control_path = os.path.join(self.control_dir, "control")
+        self.master_started = False
+        self.master_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def start_master(self) -> None:
+        # The shared connection is started on its own with no pipes. If a captured command started
+        # it, the backgrounded master would keep that command's stderr open, and sp.run would wait
+        # for it until the program exits
+        with self.master_lock:
+            if self.master_started:
+                return
+            self.master_started = True
+            sp.run(
+                ["ssh", "-fNM", "-o", f"ControlPath={self.control_path}", self.llm_host],
+                stdin=sp.DEVNULL,
+                stdout=sp.DEVNULL,
+                stderr=sp.DEVNULL,
+            )
+
+    def ssh(self, command: str) -> list[str]:
+        self.start_master()
+        # Commands use the shared connection, or connect on their own if it couldn't be started,
+        # so their errors are still reported
+        return [
+            "ssh",
+            "-o",
+            "ControlMaster=no",
+            "-o",
+            f"ControlPath={self.control_path}",
+            self.llm_host,
+            command,
+        ]
+
+    def close(self) -> None:
+        if os.path.exists(self.control_path):
+            sp.run(
+                ["ssh", "-o", f"ControlPath={self.control_path}", "-O", "exit", self.llm_host],
+                capture_output=True,
+            )
+        shutil.rmtree(self.control_dir, ignore_errors=True)
 
     def check_llm_host(self) -> None:
-        result = sp.run(["ssh", self.llm_host, f"echo 'hi'"], capture_output=True)
+        result = sp.run(self.ssh("echo 'hi'"), capture_output=True)
         if result.returncode != 0:
             raise RuntimeError(f"couldn't connect to llm server:\n{result.stderr.decode()}")
         return None
 
     def _upload_model_file(self, model_file_id: str, model_file: str) -> bool:
-        result = sp.run(["ssh", self.llm_host, f"ollama show {model_file_id}"], capture_output=True)
+        result = sp.run(self.ssh(f"ollama show {model_file_id}"), capture_output=True)
         if result.returncode == 0:
             return True
-        result = sp.run(
-            ["ssh", self.llm_host, f"cat > /tmp/{model_file_id}.txt"], input=model_file.encode(), capture_output=True
-        )
+        result = sp.run(self.ssh(f"cat > /tmp/{model_file_id}.txt"), input=model_file.encode(), capture_output=True)
         if result.returncode != 0:
-            breakpoint()
             return False
         result = sp.run(
-            ["ssh", self.llm_host, f"ollama create {model_file_id} -f /tmp/{model_file_id}.txt"],
+            self.ssh(f"ollama create {model_file_id} -f /tmp/{model_file_id}.txt"),
             capture_output=True,
         )
-        if result.returncode != 0:
-            breakpoint()
-            return False
-        return True
+        return result.returncode == 0
 
     def run_model(self, model_file_id: str, prompt: str) -> str:
         process_result = sp.run(
-            ["ssh", self.llm_host, f"ollama run {model_file_id} --nowordwrap"],
+            self.ssh(f"ollama run {model_file_id} --nowordwrap"),
             input=prompt.encode(),
             capture_output=True,
         )
         result = process_result.stdout.decode().strip()
-        if result == "":
-            breakpoint()
+        if process_result.returncode != 0 or result == "":
+            raise LLMHostError(f"ollama run failed on {self.llm_host}: {process_result.stderr.decode().strip()}")
         return result
 
+    def stream_model(self, model_file_id: str, prompt: str, text: StreamingText) -> None:
+        stream_process(self.ssh(f"ollama run {model_file_id} --nowordwrap"), prompt, text)
+
 
 class LocalLLMRunner(BaseLLMManager):
-    def __init__(self) -> None:
-        self.sql_manager = SQLManager("llm_data.db")
-        self.checked = False
+    def __init__(self, ollama: str = "ollama") -> None:
+        super().__init__(SQLManager("llm_data.db"))
+        self.ollama = ollama
 
-    def _upload_model_file(self, model_file_id: str, model_file: str) -> None:
-        result = sp.run(["ollama", "show", model_file_id], capture_output=True)
+    def _upload_model_file(self, model_file_id: str, model_file: str) -> bool:
+        result = sp.run([self.ollama, "show", model_file_id], capture_output=True)
         if result.returncode == 0:
-            return
+            return True
         with open(f"/tmp/{model_file_id}.txt", "w") as f:
             f.write(model_file)
         result = sp.run(
-            ["ollama", "create", model_file_id, "-f", f"/tmp/{model_file_id}.txt"],
+            [self.ollama, "create", model_file_id, "-f", f"/tmp/{model_file_id}.txt"],
             capture_output=True,
         )
+        return result.returncode == 0
 
     def run_model(self, model_file_id: str, prompt: str) -> str:
         process_result = sp.run(
-            ["ollama", "run", model_file_id, "--nowordwrap"],
+            [self.ollama, "run", model_file_id, "--nowordwrap"],
             input=prompt.encode(),
             capture_output=True,
         )
         result = process_result.stdout.decode().strip()
-        if result == "":
-            breakpoint()
+        if process_result.returncode != 0 or result == "":
+            raise LLMHostError(f"{self.ollama} run failed: {process_result.stderr.decode().strip()}")
         return result
 
+    def stream_model(self, model_file_id: str, prompt: str, text: StreamingText) -> None:
+        stream_process([self.ollama, "run", model_file_id, "--nowordwrap"], prompt, text)
+
+
+class ReplayLLMRunner(BaseLLMManager):
+    """
+    Answers LLM calls only with the responses already saved in llm_data.db, without ever talking
+    to ollama. A call with no saved response raises ReplayMissError, or returns marker if one is
+    given. The database is only read: no models are registered and nothing is saved, so a later
+    live run still creates its models, and a marker never ends up in the responses table.
+    """
+
+    def __init__(self, marker: str | None = None, filename: str = "llm_data.db") -> None:
+        super().__init__(SQLManager(filename))
+        self.marker = marker
+        self.has_responses = False
+
+    def check(self) -> None:
+        if self.checked:
+            return
+        # Without a responses table every call is a miss, and the database isn't created
+        if os.path.exists(self.sql_manager.filename):
+            tables = self.sql_manager.execute_sql(
+                "select name from sqlite_master where type = 'table' and name = 'responses'", True, None
+            )
+            self.has_responses = len(list(tables)) > 0
+        self.checked = True
+
+    def register_model(self, procedure: LLMProcedure) -> tuple[str, str]:
+        self.check()
+        return model_ids(procedure)
+
+    def _upload_model_file(self, model_file_id: str, model_file: str) -> bool:
+        return True
+
+    def _lookup_response(self, model_id: str, prompt_hash: str) -> str | None:
+        if not self.has_responses:
+            return None
+        return super()._lookup_response(model_id, prompt_hash)
+
+    def _save_response(self, model_id: str, prompt_hash: str, data: dict[str, str], result: str) -> None:
+        pass
+
+    def run_model(self, model_file_id: str, prompt: str) -> str:
+        if self.marker is None:
+            raise ReplayMissError(f"no saved response for model {model_file_id} and prompt:\n{prompt}")
+        return self.marker
+
+
+class HTTPLLMRunner(BaseLLMManager):
+    """
+    Talks to the ollama HTTP API instead of starting an ollama process for every call. Connections
+    are kept open and reused between calls, and keep_alive tells ollama how long to keep the model
+    loaded after a call. A server that takes longer than timeout seconds to connect or to send the
+    next part of a response fails the call.
+    """
+
+    def __init__(
+        self, url: str = "http://localhost:11434", keep_alive: str | None = None, timeout: float = 300
+    ) -> None:
+        super().__init__(SQLManager("llm_data.db"))
+        parsed_url = urllib.parse.urlsplit(url)
+        self.connection_class = (
+            http.client.HTTPSConnection if parsed_url.scheme == "https" else http.client.HTTPConnection
+        )
+        self.netloc = parsed_url.netloc
+        self.base_path = parsed_url.path.rstrip("/")
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        # Connections that aren't in use by any thread
+        self.idle: list[http.client.HTTPConnection] = []
+        self.idle_lock = threading.Lock()
+
+    def _send(
+        self, method: str, path: str, body: dict | None = None
+    ) -> tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+        headers = {"Content-Type": "application/json"}
+        data = None if body is None else json.dumps(body).encode()
+        # The server may have closed an idle connection, in which case reconnect and try once more
+        for attempt in range(2):
+            with self.idle_lock:
+                connection = self.idle.pop() if len(self.idle) > 0 else None
+            if connection is None:
+                connection = self.connection_class(self.netloc, timeout=self.timeout)
+            try:
+                connection.request(method, self.base_path + path, body=data, headers=headers)
+                return connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if attempt == 1:
+                    raise
+            except TimeoutError:
+                connection.close()
+                raise LLMHostError(f"llm server {self.netloc} didn't answer within {self.timeout}s")
+        raise AssertionError("unreachable")
+
+    def _release(self, connection: http.client.HTTPConnection) -> None:
+        with self.idle_lock:
+            self.idle.append(connection)
+
+    def close(self) -> None:
+        with self.idle_lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+    def _request(self, method: str, path: str, body: dict | None = None) -> tuple[int, dict]:
+        connection, response = self._send(method, path, body)
+        try:
+            response_body = response.read()
+        except TimeoutError:
+            connection.close()
+            raise LLMHostError(f"llm server {self.netloc} didn't answer within {self.timeout}s")
+        except BaseException:
+            connection.close()
+            raise
+        self._release(connection)
+        try:
+            result = json.loads(response_body) if response_body else {}
+        except json.JSONDecodeError:
+            result = {"error": response_body.decode(errors="replace")}
+        return response.status, result
+
+    def check_llm_host(self) -> None:
+        try:
+            status, result = self._request("GET", "/api/version")
+        except OSError as e:
+            raise RuntimeError(f"couldn't connect to llm server:\n{e}")
+        if status != 200:
+            raise RuntimeError(f"couldn't connect to llm server:\n{result}")
+        return None
+
+    def _upload_model_file(self, model_file_id: str, model_file: str) -> bool:
+        status, _ = self._request("POST", "/api/show", {"model": model_file_id})
+        if status == 200:
+            return True
+        request = {"model": model_file_id, **model_file_fields(model_file), "stream": False}
+        status, result = self._request("POST", "/api/create", request)
+        if status != 200:
+            log(f"Couldn't create model {model_file_id}: {result}")
+            return False
+        return True
+
+    def run_model(self, model_file_id: str, prompt: str) -> str:
+        request = {"model": model_file_id, "prompt": prompt, "stream": False}
+        if self.keep_alive is not None:
+            request["keep_alive"] = self.keep_alive
+        status, result = self._request("POST", "/api/generate", request)
+        if status != 200:
+            raise LLMHostError(f"llm call failed: {result}")
+        response = result.get("response", "").strip()
+        # Raising keeps an empty answer out of the response cache, so the next run asks again
+        if response == "":
+            raise LLMHostError(f"llm server {self.netloc} gave an empty response")
+        return response
+
+    def stream_model(self, model_file_id: str, prompt: str, text: StreamingText) -> None:
+        request = {"model": model_file_id, "prompt": prompt, "stream": True}
+        if self.keep_alive is not None:
+            request["keep_alive"] = self.keep_alive
+        connection, response = self._send("POST", "/api/generate", request)
+        try:
+            if response.status != 200:
+                raise LLMHostError(f"llm call failed: {response.read().decode(errors='replace')}")
+            # The response is one json object per line, each with the next piece of the response
+            empty = True
+            for line in response:
+                if line.strip() == b"":
+                    continue
+                part = json.loads(line)
+                if "error" in part:
+                    raise LLMHostError(f"llm call failed: {part['error']}")
+                piece = part.get("response", "")
+                empty = empty and piece.strip() == ""
+                text.append(piece)
+            if empty:
+                raise LLMHostError(f"llm server {self.netloc} gave an empty response")
+        except TimeoutError:
+            connection.close()
+            raise LLMHostError(f"llm server {self.netloc} stopped sending for {self.timeout}s")
+        except BaseException:
+            connection.close()
+            raise
+        self._release(connection)
+
+
+def model_file_fields(model_file: str) -> dict:
+    """
+    The fields of an /api/create request for a model file made by make_model_file. The API
+    doesn't take model files any more.
+    """
+    result: dict = {}
+    messages = []
+    system = re.search(r'^SYSTEM """(.*?)"""$', model_file, re.MULTILINE | re.DOTALL)
+    if system is not None:
+        result["system"] = system.group(1)
+    for line in model_file.splitlines():
+        if line.startswith("FROM "):
+            result["from"] = line[len("FROM ") :].strip()
+        elif line.startswith("MESSAGE "):
+            role, _, content = line[len("MESSAGE ") :].partition(" ")
+            messages.append({"role": role, "content": content})
+    if len(messages) > 0:
+        result["messages"] = messages
+    return result
+
+
+@dataclass
+class LLMHost:
+    name: str
+    runner: BaseLLMManager
+    in_flight: int = 0
+    failures: int = 0
+    # Hosts that failed aren't used again until this time, unless every host has failed
+    down_until: float = 0.0
+    uploaded: set[str] = field(default_factory=set)
+
+
+class LLMHostPool(BaseLLMManager):
+    """
+    Spreads LLM calls over several hosts. Each call goes to the healthy host with the fewest calls
+    in flight. A host that fails is left out for a while, doubling each time it fails again, and
+    the call is retried on another host.
+
+    With hedge_percentile set, a call that takes longer than that percentile of recent calls is
+    sent to a second host as well, and whichever answers first is used.
+    """
+
+    def __init__(
+        self, runners: list[tuple[str, BaseLLMManager]], hedge_percentile: float | None = None, retry_after: float = 30
+    ) -> None:
+        super().__init__(SQLManager("llm_data.db"))
+        self.hosts = [LLMHost(name, runner) for name, runner in runners]
+        self.hedge_percentile = hedge_percentile
+        self.retry_after = retry_after
+        self.latencies: deque[float] = deque(maxlen=200)
+        self.model_files: dict[str, str] = {}
+        self.lock = threading.Lock()
+        self.executor = None if hedge_percentile is None else ThreadPoolExecutor(max_workers=64)
+        atexit.register(self.close)
+
+    def close(self) -> None:
+        if self.executor is not None:
+            # A hedged call that lost the race may still be running, and nobody wants its result
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        for host in self.hosts:
+            host.runner.close()
+
+    def check_llm_host(self) -> None:
+        errors = []
+        for host in self.hosts:
+            try:
+                host.runner.check_llm_host()
+            except Exception as e:
+                self.mark_failed(host)
+                errors.append(str(e))
+        if len(errors) == len(self.hosts):
+            raise RuntimeError("couldn't connect to any llm server:\n" + "\n".join(errors))
+
+    def register_model(self, procedure: LLMProcedure) -> tuple[str, str]:
+        result = super().register_model(procedure)
+        # Hosts get each model file the first time they run it, so keep them all
+        if result[1] not in self.model_files:
+            self.model_files[result[1]] = make_model_file(procedure)
+        return result
+
+    def _upload_model_file(self, model_file_id: str, model_file: str) -> bool:
+        self.model_files[model_file_id] = model_file
+        return True
+
+    def choose_host(self, exclude: list[LLMHost]) -> LLMHost | None:
+        with self.lock:
+            candidates = [host for host in self.hosts if host not in exclude]
+            if len(candidates) == 0:
+                return None
+            now = time.monotonic()
+            healthy = [host for host in candidates if host.down_until <= now]
+            if len(healthy) > 0:
+                result = min(healthy, key=lambda host: host.in_flight)
+            else:
+                result = min(candidates, key=lambda host: host.down_until)
+            result.in_flight += 1
+            return result
+
+    def mark_failed(self, host: LLMHost) -> None:
+        with self.lock:
+            host.failures += 1
+            host.down_until = time.monotonic() + self.retry_after * 2 ** min(host.failures - 1, 5)
+
+    def hedge_delay(self) -> float | None:
+        if self.hedge_percentile is None:
+            return None
+        with self.lock:
+            if len(self.latencies) < 20:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * self.hedge_percentile / 100), len(latencies) - 1)]
+
+    def run_on_host(self, host: LLMHost, model_file_id: str, prompt: str) -> str:
+        start = time.monotonic()
+        try:
+            if model_file_id not in host.uploaded:
+                if not host.runner._upload_model_file(model_file_id, self.model_files[model_file_id]):
+                    raise LLMHostError(f"couldn't upload model {model_file_id}")
+                host.uploaded.add(model_file_id)
+            result = host.runner.run_model(model_file_id, prompt)
+        except Exception as e:
+            with self.lock:
+                host.in_flight -= 1
+            self.mark_failed(host)
+            log(f"LLM host {host.name} failed: {e}")
+            raise LLMHostError(f"{host.name}: {e}") from e
+        with self.lock:
+            host.in_flight -= 1
+            host.failures = 0
+            self.latencies.append(time.monotonic() - start)
+        return result
+
+    def run_hedged(self, host: LLMHost, tried: list[LLMHost], model_file_id: str, prompt: str) -> str:
+        delay = self.hedge_delay()
+        if delay is None or self.executor is None:
+            return self.run_on_host(host, model_file_id, prompt)
+        first = self.executor.submit(self.run_on_host, host, model_file_id, prompt)
+        try:
+            return first.result(timeout=delay)
+        except TimeoutError:
+            pass
+        second_host = self.choose_host(tried)
+        if second_host is None:
+            return first.result()
+        tried.append(second_host)
+        pending = {first, self.executor.submit(self.run_on_host, second_host, model_file_id, prompt)}
+        error: BaseException | None = None
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is None:
+                    return future.result()
+        assert error is not None
+        raise error
+
+    def run_model(self, model_file_id: str, prompt: str) -> str:
+        tried: list[LLMHost] = []
+        while True:
+            host = self.choose_host(tried)
+            if host is None:
+                raise LLMHostError("every llm host failed")
+            tried.append(host)
+            try:
+                return self.run_hedged(host, tried, model_file_id, prompt)
+            except LLMHostError:
+                continue
+
+
+def make_llm_runner(spec: str, keep_alive: str | None = None, timeout: float = 300) -> BaseLLMManager:
+    """
+    Makes the runner for one --llm-host: "local" runs ollama here, "local:/path/to/ollama" runs
+    a different ollama binary here, an http(s) url uses the ollama HTTP API, and anything else is
+    a host to run ollama on over ssh.
+    """
+    if spec == "local":
+        return LocalLLMRunner()
+    elif spec.startswith("local:"):
+        return LocalLLMRunner(spec[len("local:") :])
+    elif spec.startswith("http://") or spec.startswith("https://"):
+        return HTTPLLMRunner(spec, keep_alive, timeout)
+    else:
+        return RemoteLLMRunner(llm_host=spec)
+
+
+def make_llm_manager(args: argparse.Namespace) -> BaseLLMManager:
+    if args.replay:
+        return ReplayLLMRunner(args.replay_marker)
+    elif args.llm_url is not None:
+        return HTTPLLMRunner(args.llm_url, args.keep_alive, args.llm_timeout)
+    elif args.llm_host is None:
+        return LocalLLMRunner()
+    llm_hosts = [host.strip() for host in args.llm_host.split(",") if host.strip() != ""]
+    if len(llm_hosts) == 1 and args.hedge_percentile is None:
+        return make_llm_runner(llm_hosts[0], args.keep_alive, args.llm_timeout)
+    runners = [(host, make_llm_runner(host, args.keep_alive, args.llm_timeout)) for host in llm_hosts]
+    return LLMHostPool(runners, args.hedge_percentile)
+
 
 class ValueGetter(dict):
     def __call__(self, key) -> str:
         return self[key]
 
 
+def batch_inputs(source: str) -> Iterator[tuple[str, str | None]]:
+    """
+    The inputs of a batch, as (name, text) pairs. source is a directory, whose files are each an
+    input, a glob matching the input files, or a file with an input on each line. The text of an
+    input file is None, so the worker reads it instead of it being sent to the worker.
+    """
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            path = os.path.join(source, name)
+            if os.path.isfile(path):
+                yield path, None
+    elif os.path.isfile(source):
+        with open(source, "r") as f:
+            for number, line in enumerate(f, 1):
+                line = line.rstrip("\n")
+                if line != "":
+                    yield f"{source}:{number}", line
+    else:
+        for path in sorted(glob.glob(source, recursive=True)):
+            if os.path.isfile(path):
+                yield path, None
+
+
+class BatchWorker:
+    """
+    A warm interpreter in one process of a batch. The program is compiled and linked once, and
+    the database connections and model registrations are kept between inputs.
+    """
+
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        compiled_procedures: dict[str, list["BaseByteCode"]],
+        llm_slots: Any = None,
+    ) -> None:
+        self.args = args
+        # A semaphore shared by every worker, so --max-llm-calls limits the whole batch
+        self.llm_slots = llm_slots
+        self.llm_manager = make_llm_manager(args)
+        self.sql_manager = SQLManager(cached_statements=args.sql_statement_cache, wal=args.sql_wal)
+        # The workers all write to the same response cache. A replay only reads it
+        if not args.replay:
+            self.llm_manager.sql_manager.use_wal()
+        self.system = System({}, self.llm_manager, self.sql_manager)
+        self.system.load_compiled(compiled_procedures)
+        self.system.link()
+        self.procedure_name = args.procedure
+        if self.procedure_name is None:
+            self.procedure_name = next(iter(compiled_procedures.keys()))
+
+    def run(self, text: Value) -> str:
+        """
+        Runs the program on one input, returning what it printed.
+        """
+        args = self.args
+        system = System({}, self.llm_manager, self.sql_manager, args.verbose, stream=args.stream)
+        system.llm_slots = self.llm_slots
+        system.compiled_procedures = self.system.compiled_procedures
+        system.linked_procedures = self.system.linked_procedures
+        system.set_value("prompt", text)
+        system.call_stack = [Frame(self.procedure_name, system.linked_procedures[self.procedure_name])]
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            system.finish(0, None)
+        return output.getvalue()
+
+    def close(self) -> None:
+        self.llm_manager.close()
+        self.llm_manager.sql_manager.close()
+        self.sql_manager.close()
+
+
+batch_worker: BatchWorker | None = None
+
+
+def start_batch_worker(
+    args: argparse.Namespace, compiled_procedures: dict[str, list["BaseByteCode"]], llm_slots: Any
+) -> None:
+    global batch_worker
+    batch_worker = BatchWorker(args, compiled_procedures, llm_slots)
+    # Pool workers don't run atexit handlers, so the worker is closed by a finalizer, which runs
+    # when the worker exits after the pool is closed
+    multiprocessing.util.Finalize(batch_worker, batch_worker.close, exitpriority=10)
+
+
+def run_batch_input(item: tuple[str, str | None]) -> dict[str, str]:
+    assert batch_worker is not None
+    name, text = item
+    try:
+        return {"input": name, "output": batch_worker.run(read_file(name) if text is None else text)}
+    except Exception as e:
+        return {"input": name, "error": f"{type(e).__name__}: {e}"}
+
+
+def run_batch(
+    args: argparse.Namespace, compiled_procedures: dict[str, list["BaseByteCode"]], source: str, workers: int
+) -> bool:
+    """
+    Runs the program on each input of a batch, spread over workers processes, writing a json line
+    with the output of each input, in the order of the inputs. Returns whether they all succeeded.
+    """
+    succeeded = True
+    llm_slots = None if args.max_llm_calls is None else multiprocessing.BoundedSemaphore(args.max_llm_calls)
+    with multiprocessing.Pool(workers, start_batch_worker, (args, compiled_procedures, llm_slots)) as pool:
+        for result in pool.imap(run_batch_input, batch_inputs(source)):
+            succeeded = succeeded and "error" not in result
+            print(json.dumps(result), flush=True)
+        # Let the workers exit on their own, so they close their runners, instead of being killed
+        pool.close()
+        pool.join()
+    return succeeded
+
+
+class ThreadOutput(io.TextIOBase):
+    """
+    Stands in for stdout in the server, sending what each thread prints to the job that thread is
+    running, so jobs running at the same time don't mix their output.
+    """
+
+    def __init__(self, default) -> None:
+        self.default = default
+        self.local = threading.local()
+
+    def write(self, text: str) -> int:
+        send = getattr(self.local, "send", None)
+        if send is None:
+            return self.default.write(text)
+        if text != "":
+            send({"output": text})
+        return len(text)
+
+    def flush(self) -> None:
+        if getattr(self.local, "send", None) is None:
+            self.default.flush()
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """
+    Reads jobs from a client, one json object per line, and answers each with json lines of
+    {"output": text} as the program prints, ending with {"done": true} or {"error": message}.
+    """
+
+    server: "AicodingServer"
+
+    def send(self, message: dict) -> None:
+        self.wfile.write(json.dumps(message).encode() + b"\n")
+        self.wfile.flush()
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            if line.strip() == b"":
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                self.send({"error": f"the job isn't valid json: {e}"})
+                continue
+            if not isinstance(request, dict) or not isinstance(request.get("program"), str):
+                self.send({"error": "a job needs to be a json object with the program's text"})
+                continue
+            # Jobs run on the server's threads, which keep their database connections between jobs
+            self.server.executor.submit(self.server.run_job, request, self.send).result()
+
+
+class AicodingServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Runs jobs sent by aicoding_client.py over a Unix socket. Compiled programs, database
+    connections, the LLM host check and model registrations are all kept between jobs, so a job
+    only pays for running its program.
+
+    Jobs resolve relative paths, including data.db, against the directory the client was run
+    from. llm_data.db and program_cache.db are the server's own, in the directory it was started
+    from.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path: str, args: argparse.Namespace) -> None:
+        super().__init__(path, JobHandler)
+        self.args = args
+        self.llm_manager = make_llm_manager(args)
+        # The data.db of each directory jobs were sent from, by path
+        self.sql_managers: dict[str, SQLManager] = {}
+        self.sql_managers_lock = threading.Lock()
+        self.sql_manager = self.get_sql_manager(None)
+        # Other aicoding processes may use the same response cache while the server is running. A
+        # replay only reads it
+        if not args.replay:
+            self.llm_manager.sql_manager.use_wal()
+        # Tells when something else changed llm_data.db, which may have marked responses deleted
+        self.responses_watch: sqlite3.Connection | None = None
+        self.responses_version: int | None = None
+        self.responses_lock = threading.Lock()
+        self.program_cache = None if args.no_cache else ProgramCache()
+        # Nobody is at the server's terminal to debug a failing query, so the job just reports it
+        self.llm_manager.sql_manager.debug_errors = False
+        if self.program_cache is not None:
+            self.program_cache.sql_manager.debug_errors = False
+        # Linked systems to start jobs from, by program hash
+        self.programs: dict[str, System] = {}
+        self.programs_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=args.serve_workers)
+        # --max-llm-calls limits the LLM calls of every job together, not each job on its own
+        self.llm_slots = None if args.max_llm_calls is None else threading.BoundedSemaphore(args.max_llm_calls)
+
+    def get_sql_manager(self, directory: str | None) -> SQLManager:
+        filename = "data.db" if directory is None else os.path.join(directory, "data.db")
+        with self.sql_managers_lock:
+            sql_manager = self.sql_managers.get(filename)
+            if sql_manager is None:
+                args = self.args
+                sql_manager = SQLManager(filename, cached_statements=args.sql_statement_cache, wal=args.sql_wal)
+                sql_manager.debug_errors = False
+                self.sql_managers[filename] = sql_manager
+            return sql_manager
+
+    def drop_changed_responses(self) -> None:
+        """
+        Empties the in memory response cache if llm_data.db has been changed since the last job,
+        since responses may have been marked deleted. Responses this server saved change it too,
+        and are then answered from the database until they're cached again.
+        """
+        filename = self.llm_manager.sql_manager.filename
+        with self.responses_lock:
+            if self.responses_watch is None:
+                if not os.path.exists(filename):
+                    return
+                uri = f"file:{urllib.parse.quote(os.path.abspath(filename))}?mode=ro"
+                self.responses_watch = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            version = self.responses_watch.execute("pragma data_version;").fetchone()[0]
+            if version != self.responses_version:
+                self.llm_manager.response_cache.clear()
+                self.responses_version = version
+
+    def get_program(self, text: str) -> System:
+        program_hash = hashlib.sha256(text.encode()).hexdigest()
+        with self.programs_lock:
+            system = self.programs.get(program_hash)
+            if system is not None:
+                return system
+            system = System({}, self.llm_manager, self.sql_manager)
+            compiled_program = None if self.program_cache is None else self.program_cache.load(text)
+            if compiled_program is None:
+                system.procedures = parse_program(text, strict=True)
+                system.compile_all()
+                if self.program_cache is not None:
+                    self.program_cache.save(text, system.compiled_procedures)
+            else:
+                system.load_compiled(compiled_program)
+            system.link()
+            self.programs[program_hash] = system
+            return system
+
+    def run_job(self, request: dict, send: Callable[[dict], None]) -> None:
+        assert isinstance(sys.stdout, ThreadOutput)
+        sys.stdout.local.send = send
+        try:
+            program = self.get_program(request["program"])
+            procedure_name = request.get("procedure")
+            if procedure_name is None:
+                procedure_name = next(iter(program.linked_procedures.keys()))
+            args = self.args
+            directory = request.get("cwd")
+            if directory is not None and not os.path.isabs(directory):
+                raise ValueError(f"the job's directory has to be an absolute path, not {directory}")
+            self.drop_changed_responses()
+            sql_manager = self.get_sql_manager(directory)
+            system = System({}, self.llm_manager, sql_manager, args.verbose, stream=args.stream)
+            system.directory = directory
+            system.interactive = False
+            system.llm_slots = self.llm_slots
+            system.compiled_procedures = program.compiled_procedures
+            system.linked_procedures = program.linked_procedures
+            system.set_value("prompt", request.get("input", ""))
+            system.call_stack = [Frame(procedure_name, system.linked_procedures[procedure_name])]
+            system.finish(0, None)
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            send({"error": f"{type(e).__name__}: {e}"})
+        else:
+            send({"done": True})
+        finally:
+            sys.stdout.local.send = None
+
+
+def serve(path: str, args: argparse.Namespace) -> None:
+    if os.path.exists(path):
+        os.remove(path)
+    sys.stdout = ThreadOutput(sys.stdout)
+    # Stop cleanly when killed, so the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with AicodingServer(path, args) as server:
+        log(f"Serving on {path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
+
+
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser()
     argparser.add_argument("--program", default="workflow.md")
@@ -1598,24 +4738,144 @@ if __name__ == "__main__":
     argparser.add_argument("--check", action="store_true", default=False)
     argparser.add_argument("--add-undefined", action="store_true", default=False)
     argparser.add_argument("--verbose", action="store_true", default=False)
-    argparser.add_argument("--llm-host", default=None)
+    llm_source = argparser.add_mutually_exclusive_group()
+    llm_source.add_argument(
+        "--llm-host", default=None, help="comma separated hosts to run the llm on, local or local:/path for this machine"
+    )
+    argparser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        default=None,
+        help="with several hosts, send a call to a second host once it's slower than this percentile",
+    )
+    llm_source.add_argument("--llm-url", default=None, help="use the ollama HTTP API at this url")
+    argparser.add_argument("--keep-alive", default=None, help="how long ollama keeps the model loaded, eg 30m")
+    argparser.add_argument(
+        "--llm-timeout",
+        type=float,
+        default=300,
+        help="seconds to wait for the ollama HTTP API to connect or send more of a response",
+    )
+    llm_source.add_argument(
+        "--replay", action="store_true", default=False, help="only use responses already saved in llm_data.db"
+    )
+    argparser.add_argument(
+        "--replay-marker",
+        default=None,
+        help="with --replay, use this as the response when none was saved instead of failing",
+    )
+    argparser.add_argument("--no-cache", action="store_true", default=False)
+    argparser.add_argument("--clear-cache", action="store_true", default=False)
+    argparser.add_argument("--max-llm-calls", type=int, default=None)
+    argparser.add_argument(
+        "--sql-statement-cache", type=int, default=128, help="how many prepared sql statements to keep per connection"
+    )
+    argparser.add_argument(
+        "--sql-wal",
+        action="store_true",
+        default=False,
+        help="put data.db in WAL mode, which it stays in afterwards, so /sql loops on a WAL database fetch their "
+        "rows as they're needed instead of all at once",
+    )
+    argparser.add_argument("--preregister", action="store_true", default=False)
+    argparser.add_argument(
+        "--stream", action="store_true", default=False, help="use llm responses while they're being generated"
+    )
+    argparser.add_argument(
+        "--checkpoint-every", type=int, default=0, help="save the state of the program every this many steps"
+    )
+    argparser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="carry on from the last checkpoint of this program, procedure and input",
+    )
+    argparser.add_argument(
+        "--batch",
+        default=None,
+        help="run the program on each file in this directory, each file matching this glob, or each line of this "
+        "file, writing the outputs in order as json lines",
+    )
+    argparser.add_argument(
+        "--batch-workers", type=int, default=None, help="how many processes --batch uses, one per core by default"
+    )
+    argparser.add_argument(
+        "--serve", default=None, help="keep running, and run jobs from aicoding_client.py sent to this unix socket"
+    )
+    argparser.add_argument("--serve-workers", type=int, default=8, help="how many jobs --serve runs at once")
+    argparser.add_argument(
+        "--profile",
+        help="write timings of procedures, bytecodes, llm calls and sql queries to this json file, and "
+        "collapsed stacks for a flamegraph next to it",
+    )
     args = argparser.parse_args()
 
+    if args.batch is not None and args.serve is not None:
+        argparser.error("--batch can't be used with --serve")
+    if args.batch is not None or args.serve is not None:
+        # Batches and the server run many inputs, which these only make sense for one of
+        mode = "--batch" if args.batch is not None else "--serve"
+        for flag, used in [
+            ("--checkpoint-every", args.checkpoint_every > 0),
+            ("--resume", args.resume),
+            ("--profile", args.profile is not None),
+        ]:
+            if used:
+                argparser.error(f"{flag} can't be used with {mode}")
+
+    if args.serve is not None:
+        serve(args.serve, args)
+        exit(0)
+
+    profiler = None if args.profile is None else Profiler()
+    phase_start = time.perf_counter()
+
     with open(args.program, "r") as f:
-        parsed_program = parse_program(f.read())
+        program_text = f.read()
+
+    program_cache = None if args.no_cache else ProgramCache()
+    if args.clear_cache:
+        if program_cache is None:
+            cleared = ProgramCache()
+            cleared.clear()
+            cleared.sql_manager.close()
+        else:
+            program_cache.clear()
+
+    # Checking for undefined procedures needs the parsed procedures, not just their bytecode
+    compiled_program = None
+    if program_cache is not None and not (args.check or args.add_undefined):
+        compiled_program = program_cache.load(program_text)
+
+    sections = None
+    if compiled_program is not None:
+        parsed_program = {}
+    else:
+        if program_cache is not None:
+            sections = program_cache.load_sections(program_text)
+        if sections is None:
+            parsed_program = parse_program(program_text)
+        else:
+            parsed_program = {section.name: section.procedure for section in sections}
+
+    if profiler is not None:
+        profiler.phases["parse"] = time.perf_counter() - phase_start
 
     if args.list:
-        for name in parsed_program.keys():
+        for name in (parsed_program if compiled_program is None else compiled_program).keys():
             print(name)
         exit(0)
 
-    llm_runner: BaseLLMManager
-    if args.llm_host is None:
-        llm_runner = LocalLLMRunner()
-    else:
-        llm_runner = RemoteLLMRunner(llm_host=args.llm_host)
+    llm_runner = make_llm_manager(args)
 
-    system = System(parsed_program, llm_runner, SQLManager(), args.verbose)
+    system = System(
+        parsed_program,
+        llm_runner,
+        SQLManager(cached_statements=args.sql_statement_cache, wal=args.sql_wal),
+        args.verbose,
+        args.max_llm_calls,
+        args.stream,
+    )
 
     if args.check or args.add_undefined:
         undefined = system.get_undefined_procedures()
@@ -1648,12 +4908,71 @@ A: ..."
             print("No undefined procedures!")
             exit(0)
 
+    if profiler is not None:
+        llm_runner.profiler = profiler
+        llm_runner.sql_manager.profiler = profiler
+        system.sql_manager.profiler = profiler
+    phase_start = time.perf_counter()
+    if compiled_program is not None:
+        system.load_compiled(compiled_program)
+    else:
+        if program_cache is None or sections is None:
+            system.compile_all()
+        else:
+            system.load_compiled(program_cache.compile_sections(sections, system))
+        if program_cache is not None:
+            program_cache.save(program_text, system.compiled_procedures)
+    if profiler is not None:
+        profiler.phases["compile"] = time.perf_counter() - phase_start
+
+    if args.preregister:
+        system.register_llm_procedures()
+
+    if args.batch is not None:
+        # The workers are forked from this process, and a sqlite connection mustn't be used by
+        # more than one process
+        if program_cache is not None:
+            program_cache.sql_manager.close()
+        llm_runner.sql_manager.close()
+        system.sql_manager.close()
+        workers = args.batch_workers or os.cpu_count() or 1
+        succeeded = run_batch(args, system.compiled_procedures, args.batch, workers)
+        exit(0 if succeeded else 1)
+
+    input_file: Value
     if args.input_file is None:
         input_file = sys.stdin.read()
     else:
-        with open(args.input_file, "r") as f:
-            input_file = f.read()
-
-    system.set_var("prompt", input_file)
+        input_file = read_file(args.input_file)
+
+    checkpoints = None
+    state = None
+    if args.checkpoint_every > 0 or args.resume:
+        input_id = input_identity(args.input_file, input_file if args.input_file is None else None)
+        checkpoints = CheckpointStore(ProgramCache.get_program_hash(program_text), args.procedure, input_id)
+    if args.resume:
+        assert checkpoints is not None
+        state = checkpoints.load()
+        if state is None:
+            other_runs = checkpoints.other_runs()
+            if len(other_runs) > 0:
+                print("This program only has checkpoints for other procedures or inputs:", file=sys.stderr)
+                for procedure, input_id in other_runs:
+                    print(f"  procedure {procedure or '(first)'}, input {input_id}", file=sys.stderr)
+                exit(1)
+            log("No checkpoint for this program, starting from the beginning")
+
+    def save_checkpoint(state: dict) -> None:
+        assert checkpoints is not None
+        checkpoints.save(state)
+
+    if state is not None:
+        system.resume(state, args.checkpoint_every, save_checkpoint, profiler)
+    else:
+        system.set_value("prompt", input_file)
+        system.begin(args.procedure, args.checkpoint_every, save_checkpoint, profiler)
 
-    system.begin(args.procedure)
+    if checkpoints is not None:
+        checkpoints.clear()
+    if profiler is not None:
+        profiler.write(args.profile)
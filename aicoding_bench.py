@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+"""
+Benchmarks for aicoding.py. Generates synthetic workflow programs and times how long it takes to
+parse and compile them as they grow in size and nesting, how many VM steps per second the
+interpreter runs, and how long run_llm takes to answer from a populated llm_data.db. LLM calls go
+to a deterministic fake, so ollama isn't needed. Results are printed and written as JSON so runs
+can be compared.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import statistics
+import tempfile
+import time
+from typing import Callable
+
+import aicoding
+
+
+def make_procedure(idx: int) -> str:
+    return f"""# procedure {idx}
+
+-> input
+"start"
+-> acc
+input ->
+for each {{
+  -> line
+  "{{acc}}|{{line}}"
+  -> acc
+  line ->
+  case {{
+    "stop" {{
+      /break
+    }}
+    {{
+      procedure {idx + 1}
+    }}
+  }}
+}}
+"select 1 as x"
+/sql {{
+  "{{x}}"
+  /print
+}}
+acc ->
+"""
+
+
+def make_nested_procedure(idx: int, depth: int) -> str:
+    """
+    A procedure with cases nested depth deep, each with a loop over the lines of its input.
+    """
+    body = f"\"{{line}}\"\n-> acc\nnested {idx + 1}\n"
+    for level in range(depth):
+        body = f"""for each {{
+-> line
+line ->
+case {{
+"stop" {{
+/break
+}}
+"level {level}" {{
+{body}}}
+}}
+}}
+"""
+    return f"""# nested {idx}
+
+-> input
+"start"
+-> acc
+input ->
+{body}acc ->
+"""
+
+
+LOOP_PROGRAM = """# main
+
+for each {
+  -> line
+  step
+  case {
+    "stop" {
+      /break
+    }
+  }
+}
+
+# step
+
+line ->
+"{prompt}!"
+-> result
+result ->
+"""
+
+
+LLM_PROCEDURE = aicoding.LLMProcedure(
+    model="llama3.2", system="You are a benchmark.", prompt="Answer {question}", name="bench", history=[]
+)
+
+
+class FakeLLM(aicoding.BaseLLMManager):
+    """
+    Answers every prompt with a hash of it, without running a model.
+    """
+
+    def check_model_existance(self, model_file_id: str) -> bool:
+        return True
+
+    def _upload_model_file(self, model_file_id: str, model_file: str) -> bool:
+        return True
+
+    def run_model(self, model_file_id: str, prompt: str) -> str:
+        return f"response {hashlib.sha256(prompt.encode()).hexdigest()}"
+
+
+def make_program(procedures: int) -> str:
+    return "\n".join(make_procedure(idx) for idx in range(procedures))
+
+
+def make_nested_program(procedures: int, depth: int) -> str:
+    return "\n".join(make_nested_procedure(idx, depth) for idx in range(procedures))
+
+
+def best_time(run: Callable[..., object], repeats: int, setup: Callable[[], object] | None = None) -> float:
+    """
+    The fastest of repeats runs. setup is called before each run, and what it returns is passed to
+    run, without being timed.
+    """
+    best = None
+    for _ in range(repeats):
+        arg = None if setup is None else setup()
+        start = time.perf_counter()
+        if setup is None:
+            run()
+        else:
+            run(arg)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    assert best is not None
+    return best
+
+
+def time_parse(text: str, repeats: int) -> float:
+    return best_time(lambda: aicoding.parse_program(text), repeats)
+
+
+def time_compile(text: str, repeats: int) -> float:
+    def setup() -> aicoding.System:
+        return aicoding.System(aicoding.parse_program(text), None, None)  # type: ignore
+
+    return best_time(lambda system: system.compile_all(), repeats, setup)
+
+
+def bench_programs(name: str, texts: list[tuple[str, str]], repeats: int) -> list[dict]:
+    print(f"{name:>10} {'bytes':>10} {'parse s':>10} {'us/KB':>10} {'compile s':>10}")
+    results = []
+    for label, text in texts:
+        parse = time_parse(text, repeats)
+        compiled = time_compile(text, repeats)
+        print(f"{label:>10} {len(text):>10} {parse:>10.4f} {parse * 1e6 / (len(text) / 1024):>10.1f} {compiled:>10.4f}")
+        results.append({name: label, "bytes": len(text), "parse_seconds": parse, "compile_seconds": compiled})
+    return results
+
+
+def bench_parse(sizes: list[int], repeats: int) -> list[dict]:
+    return bench_programs("procedures", [(str(size), make_program(size)) for size in sizes], repeats)
+
+
+def bench_nesting(depths: list[int], procedures: int, repeats: int) -> list[dict]:
+    return bench_programs(
+        "depth", [(str(depth), make_nested_program(procedures, depth)) for depth in depths], repeats
+    )
+
+
+def make_loop_system(lines: int) -> aicoding.System:
+    system = aicoding.System(aicoding.parse_program(LOOP_PROGRAM), None, None)  # type: ignore
+    system.compile_all()
+    system.link()
+    system.set_var("prompt", "\n".join(f"line {idx}" for idx in range(lines)))
+    system.call_stack = [aicoding.Frame("main", system.linked_procedures["main"])]
+    return system
+
+
+def bench_vm(lines: int, repeats: int) -> dict:
+    system = make_loop_system(lines)
+    steps = 0
+    while len(system.call_stack) > 0:
+        system.step()
+        steps += 1
+
+    best = best_time(lambda system: system.run(), repeats, lambda: make_loop_system(lines))
+    print(f"{steps} steps in {best:.4f}s, {steps / best:,.0f} steps per second")
+    return {"lines": lines, "steps": steps, "seconds": best, "steps_per_second": steps / best}
+
+
+def make_question(idx: int) -> str:
+    # Prompts are hashed without their digits, so questions have to differ in their letters
+    letters = []
+    while True:
+        letters.append(chr(ord("a") + idx % 26))
+        idx //= 26
+        if idx == 0:
+            return "question " + "".join(letters)
+
+
+def latency_stats(latencies: list[float]) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "calls": len(latencies),
+        "mean_us": statistics.mean(latencies) * 1e6,
+        "p50_us": latencies[len(latencies) // 2] * 1e6,
+        "p99_us": latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1e6,
+    }
+
+
+def time_calls(llm: aicoding.BaseLLMManager, questions: list[str]) -> list[float]:
+    latencies = []
+    for question in questions:
+        start = time.perf_counter()
+        llm.run_llm(LLM_PROCEDURE, {"question": question})
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_llm(prompts: int) -> dict:
+    """
+    Fills a fresh llm_data.db with prompts responses, then times answering them with a new
+    manager, first from the database and then from its in memory cache.
+    """
+    questions = [make_question(idx) for idx in range(prompts)]
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "llm_data.db")
+        populate = FakeLLM(aicoding.SQLManager(filename))
+        time_calls(populate, questions)
+        del populate
+
+        llm = FakeLLM(aicoding.SQLManager(filename))
+        # Registers the model, which only happens on the first call
+        llm.run_llm(LLM_PROCEDURE, {"question": questions[0]})
+        llm.response_cache = aicoding.ResponseCache()
+        db_hit = latency_stats(time_calls(llm, questions))
+        memory_hit = latency_stats(time_calls(llm, questions))
+        del llm
+
+    for name, stats in (("db hit", db_hit), ("memory hit", memory_hit)):
+        print(
+            f"run_llm {name}: {stats['calls']} calls, mean {stats['mean_us']:.1f}us, "
+            f"p50 {stats['p50_us']:.1f}us, p99 {stats['p99_us']:.1f}us"
+        )
+    return {"db_hit": db_hit, "memory_hit": memory_hit}
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--sizes", default="10,50,100,500,1000")
+    argparser.add_argument("--depths", default="1,2,4,8,16")
+    argparser.add_argument("--nested-procedures", type=int, default=20)
+    argparser.add_argument("--repeats", type=int, default=3)
+    argparser.add_argument("--vm-lines", type=int, default=20000)
+    argparser.add_argument("--llm-prompts", type=int, default=2000)
+    argparser.add_argument("--output", default="aicoding_bench.json", help="where to write the results as json")
+    args = argparser.parse_args()
+
+    results = {
+        "parse": bench_parse([int(x) for x in args.sizes.split(",")], args.repeats),
+        "nesting": bench_nesting([int(x) for x in args.depths.split(",")], args.nested_procedures, args.repeats),
+        "vm": bench_vm(args.vm_lines, args.repeats),
+        "llm": bench_llm(args.llm_prompts),
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
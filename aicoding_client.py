@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Runs a program on a server started with `aicoding.py --serve SOCKET`, as a drop in replacement
+for running aicoding.py directly. The server keeps programs compiled and its databases and models
+ready between runs, so small runs take milliseconds instead of seconds. What the program prints is
+written out as the server sends it.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+
+def run_job(path: str, program: str, procedure: str | None, text: str) -> bool:
+    """
+    Sends one job to the server, writing its output to stdout. Returns whether it succeeded.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        # The server resolves relative paths against this directory, as if it had been run here
+        request = {"program": program, "procedure": procedure, "input": text, "cwd": os.getcwd()}
+        connection.sendall(json.dumps(request).encode() + b"\n")
+        with connection.makefile("rb") as responses:
+            for line in responses:
+                response = json.loads(line)
+                if "output" in response:
+                    sys.stdout.write(response["output"])
+                    sys.stdout.flush()
+                elif "error" in response:
+                    print(response["error"], file=sys.stderr)
+                    return False
+                else:
+                    return True
+    print("The server closed the connection", file=sys.stderr)
+    return False
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--socket", default=os.environ.get("AICODING_SOCKET", "aicoding.sock"))
+    argparser.add_argument("--program", default="workflow.md")
+    argparser.add_argument("--procedure", default=None)
+    argparser.add_argument("--input-file", default=None)
+    args = argparser.parse_args()
+
+    with open(args.program, "r") as f:
+        program_text = f.read()
+
+    if args.input_file is None:
+        input_text = sys.stdin.read()
+    else:
+        with open(args.input_file, "r") as f:
+            input_text = f.read()
+
+    exit(0 if run_job(args.socket, program_text, args.procedure, input_text) else 1)
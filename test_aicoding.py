@@ -0,0 +1,1545 @@
+"""
+Tests for aicoding.py, run with `python -m unittest test_aicoding`. The ollama HTTP API is
+replaced by a stub server and hosts by fake runners, so ollama isn't needed.
+"""
+
+import contextlib
+import http.server
+import io
+import json
+import argparse
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import aicoding
+import aicoding_bench
+
+
+GRAMMAR_PROGRAM = """# main
+
+-> text
+for each para parallel 2 {
+  -> para
+  case {
+    "a" {
+      para ->
+      /print
+    }
+    "b" {
+      loop {
+        /break
+      }
+    }
+    {
+      "other: {para}"
+      /print
+    }
+  }
+}
+"create table t (x text)"
+/sql!
+"select * from t"
+/sql {
+  -> x
+  x ->
+  summarize
+  /print
+}
+/sql! parallel 3 {
+  /print
+}
+ask {
+  What is your name? -> name
+}
+"out.txt"
+/write
+
+# summarize
+
+Model: llama3.2
+
+## System
+
+You summarize text.
+
+## Prompt
+
+Summarize {x}
+
+## History
+
+U: Summarize this
+A: It's short
+U: And this
+A: Also short
+
+"""
+
+
+class GrammarTest(unittest.TestCase):
+    def test_optimized_grammar(self) -> None:
+        programs = [GRAMMAR_PROGRAM, GRAMMAR_PROGRAM.replace("  ", "    "), PARALLEL_PROGRAM, NESTED_PARALLEL_PROGRAM]
+        # Programs that don't parse completely have to stop at the same place
+        programs += [GRAMMAR_PROGRAM.replace("/sql {", "/sql {{"), GRAMMAR_PROGRAM.replace("## History", "##")]
+        self.assertEqual(aicoding.OptimizedProcedureDefinitions.parse_partial(GRAMMAR_PROGRAM)[1], "")
+        for program in programs:
+            expected, expected_rest = aicoding.ProcedureDefinitions.parse_partial(program)
+            result, rest = aicoding.OptimizedProcedureDefinitions.parse_partial(program)
+            self.assertEqual(rest, expected_rest)
+            self.assertEqual(result.as_data(), expected.as_data())
+
+    def test_indented_dispatch(self) -> None:
+        statement = aicoding.CodeStatement.optimize()
+        table, always = statement.indented_dispatch
+        tags = [tag for tag, _ in table["/"]]
+        self.assertIn("sql_read_only", tags)
+        self.assertNotIn("for_each", tags)
+        self.assertNotIn("branch", tags)
+        self.assertEqual(
+            statement.parse_partial("    /sql!\nrest")[0].as_data(), {"type": "sql_mut", "value": {"block": ""}}
+        )
+
+    def test_parse_at_offsets(self) -> None:
+        text = "xx-> name\nrest"
+        result, end = aicoding.SetVarStatement.parse_at(text, 2)
+        self.assertEqual(result.as_data(), {"var": "name"})
+        self.assertEqual(text[end:], "\nrest")
+        # A failed match reports the position it started from
+        self.assertEqual(aicoding.SetVarStatement.parse_at(text, 0), (None, 0))
+        self.assertEqual(aicoding.VarName.parse_at(text, 5)[1], 9)
+
+    def test_partial_patterns(self) -> None:
+        # Patterns that only implement the old slicing api still work inside other patterns
+        class Digits(aicoding.Pattern):
+            def _parse_partial(self, text: str) -> tuple[aicoding.ParseResult | None, str]:
+                digits = text[: len(text) - len(text.lstrip("0123456789"))]
+                if digits == "":
+                    return None, text
+                return aicoding.ParseResult(digits), text[len(digits) :]
+
+        pattern = aicoding.StructPattern([aicoding.ExactString("n="), Digits(), aicoding.ExactString(";")], {"n": 1})
+        for optimized in [pattern, pattern.optimize()]:
+            self.assertEqual(optimized.parse_at("  n=42;", 2)[0].as_data(), {"n": "42"})
+            self.assertEqual(optimized.parse_partial("n=42;rest")[1], "rest")
+            self.assertEqual(optimized.parse_partial("n=;"), (None, "n=;"))
+
+    def test_memoize(self) -> None:
+        class Counting(aicoding.Pattern):
+            def __init__(self, pattern: aicoding.Pattern) -> None:
+                self.pattern = pattern
+                self.calls = 0
+
+            def _parse_at(self, text: str, pos: int, memo: aicoding.ParseMemo | None):
+                self.calls += 1
+                return self.pattern.parse_at(text, pos, memo)
+
+        counting = Counting(aicoding.ExactString("ab"))
+        # Unions are memoized, so both options share the result of parsing the prefix
+        prefix = aicoding.UnionPattern([counting])
+        pattern = aicoding.UnionPattern(
+            [
+                aicoding.StructPattern([prefix, aicoding.ExactString("x")], {"end": 1}),
+                aicoding.StructPattern([prefix, aicoding.ExactString("y")], {"end": 1}),
+            ]
+        )
+        self.assertEqual(pattern.parse("aby").as_data(), {"end": "y"})
+        self.assertEqual(counting.calls, 1)
+        self.assertEqual(pattern.parse("aby", memoize=False).as_data(), {"end": "y"})
+        self.assertEqual(counting.calls, 3)
+
+        for program in [GRAMMAR_PROGRAM, GRAMMAR_PROGRAM.replace("/sql {", "/sql {{")]:
+            memoized, memoized_rest = aicoding.OptimizedProcedureDefinitions.parse_partial(program)
+            result, rest = aicoding.OptimizedProcedureDefinitions.parse_partial(program, memoize=False)
+            self.assertEqual(rest, memoized_rest)
+            self.assertEqual(result.as_data(), memoized.as_data())
+
+    def test_deep_nesting(self) -> None:
+        # Each level is tried as several kinds of loop before it's parsed as the right one
+        depth = 40
+        body = "/print"
+        for level in range(depth):
+            body = f"for each {{\n{body}\n}}" if level % 2 else f"for each para {{\n{body}\n}}"
+        result, rest = aicoding.OptimizedProcedureDefinitions.parse_partial(f"# main\n\n{body}\n")
+        self.assertEqual(rest, "")
+        statement = result.as_data()[0]["body"]["value"][0]
+        for _ in range(depth):
+            self.assertIn(statement["type"], ["for_each", "for_each_paragraph"])
+            statement = statement["value"]["block"]["statements"][0]
+        self.assertEqual(statement, {"type": "print", "value": "/print"})
+
+    def test_many_procedures(self) -> None:
+        procedure = '# shout {idx}\n\n-> word\n"{{word}}!"\n-> word\n\n'
+        text = "".join(procedure.format(idx=idx) for idx in range(500))
+        self.assertEqual(list(aicoding.parse_program(text)), [f"shout {idx}" for idx in range(500)])
+
+
+class StubOllamaHandler(http.server.BaseHTTPRequestHandler):
+    # Keeps connections open between requests, like ollama does
+    protocol_version = "HTTP/1.1"
+    server: "StubOllama"
+
+    def handle(self) -> None:
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up waiting, as in test_timeout
+            pass
+
+    def do_GET(self) -> None:
+        self.server.record(self, None)
+        self.respond(200, {"version": "0.0.0"})
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.record(self, body)
+        if self.server.delay > 0:
+            time.sleep(self.server.delay)
+        if self.path == "/api/show":
+            if body["model"] in self.server.models:
+                self.respond(200, {})
+            else:
+                self.respond(404, {"error": "model not found"})
+        elif self.path == "/api/create":
+            if "modelfile" in body or "from" not in body:
+                self.respond(400, {"error": "neither 'from' or 'files' was specified"})
+            else:
+                self.server.models.add(body["model"])
+                self.respond(200, {"status": "success"})
+        elif self.path == "/api/generate" and body["stream"]:
+            words = [""] if self.server.empty else ["say ", body["prompt"]]
+            lines = b"".join(json.dumps({"response": word}).encode() + b"\n" for word in words)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Content-Length", str(len(lines)))
+            self.end_headers()
+            self.wfile.write(lines)
+        elif self.path == "/api/generate":
+            self.respond(200, {} if self.server.empty else {"response": f"say {body['prompt']}\n"})
+        else:
+            self.respond(404, {"error": "not found"})
+
+    def respond(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class StubOllama(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), StubOllamaHandler)
+        self.models: set[str] = set()
+        self.requests: list[tuple[str, dict | None]] = []
+        # The client ports requests came from, one for each connection
+        self.client_ports: set[int] = set()
+        self.delay = 0.0
+        # Whether /api/generate answers without any response text
+        self.empty = False
+
+    def record(self, handler: StubOllamaHandler, body: dict | None) -> None:
+        self.requests.append((handler.path, body))
+        self.client_ports.add(handler.client_address[1])
+
+
+class HTTPLLMRunnerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = StubOllama()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_runner(self, **kwargs) -> aicoding.HTTPLLMRunner:
+        runner = aicoding.HTTPLLMRunner(self.url, **kwargs)
+        self.addCleanup(runner.close)
+        return runner
+
+    def test_generate(self) -> None:
+        runner = self.make_runner(keep_alive="30m")
+        self.assertEqual(runner.run_model("model", "hello"), "say hello")
+        path, body = self.server.requests[-1]
+        self.assertEqual(path, "/api/generate")
+        self.assertEqual(body, {"model": "model", "prompt": "hello", "stream": False, "keep_alive": "30m"})
+
+    def test_stream(self) -> None:
+        runner = self.make_runner()
+        text = aicoding.StreamingText()
+        runner.stream_model("model", "hello", text)
+        text.finish()
+        self.assertEqual(list(text.iter_chunks()), ["say ", "hello"])
+
+    def test_create(self) -> None:
+        runner = self.make_runner()
+        procedure = aicoding.LLMProcedure(
+            model="llama3.2", system="Be brief.", prompt="{prompt}", name="brief", history=[("user", "hi")]
+        )
+        self.assertTrue(runner._upload_model_file("brief-model", aicoding.make_model_file(procedure)))
+        path, body = self.server.requests[-1]
+        self.assertEqual(path, "/api/create")
+        self.assertEqual(
+            body,
+            {
+                "model": "brief-model",
+                "from": "llama3.2",
+                "system": "Be brief.",
+                "messages": [{"role": "user", "content": "hi"}],
+                "stream": False,
+            },
+        )
+        # Once the model exists it isn't created again
+        self.assertTrue(runner._upload_model_file("brief-model", aicoding.make_model_file(procedure)))
+        self.assertEqual(self.server.requests[-1][0], "/api/show")
+
+    def test_connection_reuse(self) -> None:
+        runner = self.make_runner()
+        runner.check_llm_host()
+        for word in ["one", "two", "three"]:
+            self.assertEqual(runner.run_model("model", word), f"say {word}")
+        text = aicoding.StreamingText()
+        runner.stream_model("model", "four", text)
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(len(self.server.client_ports), 1)
+
+    def test_timeout(self) -> None:
+        self.server.delay = 0.5
+        runner = self.make_runner(timeout=0.1)
+        with self.assertRaises(aicoding.LLMHostError):
+            runner.run_model("model", "hello")
+
+    def test_empty_response(self) -> None:
+        self.server.empty = True
+        runner = self.make_runner()
+        with self.assertRaises(aicoding.LLMHostError):
+            runner.run_model("model", "hello")
+        text = aicoding.StreamingText()
+        with self.assertRaises(aicoding.LLMHostError):
+            runner.stream_model("model", "hello", text)
+
+    def test_empty_response_not_cached(self) -> None:
+        runner = self.make_runner()
+        runner.sql_manager.close()
+        runner.sql_manager = aicoding.SQLManager(":memory:")
+        procedure = aicoding.LLMProcedure(model="llama3.2", system="", prompt="{prompt}", name="say", history=[])
+        self.server.empty = True
+        with self.assertRaises(aicoding.LLMHostError):
+            runner.run_llm(procedure, {"prompt": "hello"})
+        self.server.empty = False
+        self.assertEqual(runner.run_llm(procedure, {"prompt": "hello"}), "say hello")
+
+
+class FakeRunner(aicoding.BaseLLMManager):
+    """
+    A host that answers with its name after delay seconds, or fails when failing is set.
+    """
+
+    def __init__(self, name: str, delay: float = 0.0, failing: bool = False, filename: str = ":memory:") -> None:
+        super().__init__(aicoding.SQLManager(filename))
+        self.name = name
+        self.delay = delay
+        self.failing = failing
+        self.uploads: list[str] = []
+        self.prompts: list[str] = []
+        self.calls_lock = threading.Lock()
+        self.running = 0
+        self.most_running = 0
+
+    def check_model_existance(self, model_file_id: str) -> bool:
+        return model_file_id in self.uploads
+
+    def _upload_model_file(self, model_file_id: str, model_file: str) -> bool:
+        self.uploads.append(model_file_id)
+        return True
+
+    def run_model(self, model_file_id: str, prompt: str) -> str:
+        with self.calls_lock:
+            self.prompts.append(prompt)
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(self.delay)
+        with self.calls_lock:
+            self.running -= 1
+        if self.failing:
+            raise aicoding.LLMHostError(f"{self.name} is down")
+        return f"{self.name}: {prompt}"
+
+
+class LLMHostPoolTest(unittest.TestCase):
+    def make_pool(self, runners: list[FakeRunner], **kwargs) -> aicoding.LLMHostPool:
+        pool = aicoding.LLMHostPool([(runner.name, runner) for runner in runners], **kwargs)
+        self.addCleanup(pool.close)
+        pool.model_files["model"] = "FROM llama3.2\n"
+        return pool
+
+    def test_failover(self) -> None:
+        down, up = FakeRunner("down", failing=True), FakeRunner("up")
+        pool = self.make_pool([down, up])
+        self.assertEqual(pool.run_model("model", "hello"), "up: hello")
+        self.assertEqual(down.prompts, ["hello"])
+        self.assertEqual(pool.hosts[0].failures, 1)
+        # The failed host is left out until it's due to be retried
+        self.assertEqual(pool.run_model("model", "again"), "up: again")
+        self.assertEqual(down.prompts, ["hello"])
+        self.assertEqual(up.uploads, ["model"])
+        self.assertTrue(all(host.in_flight == 0 for host in pool.hosts))
+
+    def test_every_host_failed(self) -> None:
+        pool = self.make_pool([FakeRunner("one", failing=True), FakeRunner("two", failing=True)])
+        with self.assertRaises(aicoding.LLMHostError):
+            pool.run_model("model", "hello")
+
+    def test_hedge(self) -> None:
+        slow, fast = FakeRunner("slow", delay=1), FakeRunner("fast")
+        pool = self.make_pool([slow, fast], hedge_percentile=90)
+        pool.latencies.extend([0.01] * 20)
+        start = time.monotonic()
+        self.assertEqual(pool.run_model("model", "hello"), "fast: hello")
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(slow.prompts, ["hello"])
+
+    def test_no_hedge_without_latencies(self) -> None:
+        slow, fast = FakeRunner("slow", delay=0.2), FakeRunner("fast")
+        pool = self.make_pool([slow, fast], hedge_percentile=90)
+        self.assertEqual(pool.run_model("model", "hello"), "slow: hello")
+        self.assertEqual(fast.prompts, [])
+
+
+class StreamLLMTest(unittest.TestCase):
+    def test_stream_closes_thread_connections(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        llm = FakeRunner("fake", filename=os.path.join(directory.name, "llm_data.db"))
+        procedure = aicoding.LLMProcedure(model="llama3.2", system="", prompt="Say {word}", name="say", history=[])
+        for word in ["one", "two", "three", "four"]:
+            text = llm.stream_llm(procedure, {"word": word})
+            self.assertEqual(str(text), f"fake: Say {word}")
+            # The text is finished after the thread that generated it has saved it, so only this
+            # thread's connections are left open
+            self.assertEqual(len(llm.sql_manager.connections), 2)
+        self.assertEqual(llm.run_llm(procedure, {"word": "four"}), "fake: Say four")
+
+
+PARALLEL_PROGRAM = """# main
+
+for each parallel WORKERS {
+  -> line
+  answer
+  -> said
+  line ->
+  case {
+    "c" {
+      /break
+    }
+  }
+  said ->
+  /print
+}
+
+# answer
+
+Model: llama3.2
+
+## Prompt
+
+Say {line}
+"""
+
+class ReplayLLMRunnerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, "llm_data.db")
+        self.procedure = aicoding.LLMProcedure(model="llama3.2", system="", prompt="Say {word}", name="say", history=[])
+
+    def test_no_database(self) -> None:
+        replay = aicoding.ReplayLLMRunner(marker="MISS", filename=self.filename)
+        self.assertEqual(replay.run_llm(self.procedure, {"word": "one"}), "MISS")
+        self.assertFalse(os.path.exists(self.filename))
+        with self.assertRaises(aicoding.ReplayMissError):
+            aicoding.ReplayLLMRunner(filename=self.filename).run_llm(self.procedure, {"word": "one"})
+
+    def test_replay_then_live(self) -> None:
+        live = FakeRunner("live", filename=self.filename)
+        self.assertEqual(live.run_llm(self.procedure, {"word": "one"}), "live: Say one")
+
+        other = aicoding.LLMProcedure(
+            model="llama3.2", system="Be brief.", prompt="Say {word}", name="brief", history=[]
+        )
+        replay = aicoding.ReplayLLMRunner(marker="MISS", filename=self.filename)
+        self.assertEqual(replay.run_llm(self.procedure, {"word": "one"}), "live: Say one")
+        self.assertEqual(replay.run_llm(other, {"word": "two"}), "MISS")
+
+        # The replay registered nothing, so the live run still creates the model it missed
+        later = FakeRunner("later", filename=self.filename)
+        self.assertEqual(later.run_llm(other, {"word": "two"}), "later: Say two")
+        self.assertEqual(later.uploads, [aicoding.model_ids(other)[1]])
+        rows = later.sql_manager.execute_sql("select count(*) as count from llm_models", True, None)
+        self.assertEqual(list(rows)[0]["count"], 2)
+        modes = later.sql_manager.execute_sql("pragma journal_mode;", True, None)
+        self.assertNotEqual(list(modes)[0]["journal_mode"], "wal")
+
+
+NESTED_PARALLEL_PROGRAM = """# main
+
+for each {
+  -> outer
+  "{items}"
+  for each parallel 4 {
+    -> line
+    "select '{line}' as x"
+    /sql {
+      "{x}"
+    }
+    answer
+  }
+}
+
+# answer
+
+Model: llama3.2
+
+## Prompt
+
+Say {line}
+"""
+
+
+class ParallelLoopTest(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.llm = FakeRunner("fake", delay=0.05, filename=os.path.join(directory.name, "llm_data.db"))
+        self.sql_manager = aicoding.SQLManager(os.path.join(directory.name, "data.db"))
+
+    def run_program(self, workers: int, lines: str, max_llm_calls: int | None = None) -> str:
+        procedures = aicoding.parse_program(PARALLEL_PROGRAM.replace("WORKERS", str(workers)))
+        system = aicoding.System(procedures, self.llm, self.sql_manager, max_llm_calls=max_llm_calls)
+        system.set_var("prompt", "\n".join(lines))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            system.begin(None)
+        return output.getvalue()
+
+    def test_max_llm_calls(self) -> None:
+        self.run_program(8, "abdefghijk", max_llm_calls=2)
+        self.assertEqual(len(self.llm.prompts), 10)
+        self.assertEqual(self.llm.most_running, 2)
+
+    def test_connections_closed(self) -> None:
+        system = aicoding.System(aicoding.parse_program(NESTED_PARALLEL_PROGRAM), self.llm, self.sql_manager)
+        system.set_var("prompt", "\n".join(str(idx) for idx in range(20)))
+        system.set_var("items", "\n".join("abcdefgh"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            system.begin(None)
+        # Only connections of this thread are left once each loop's workers have ended
+        self.assertLessEqual(len(self.sql_manager.connections), 2)
+        self.assertLessEqual(len(self.llm.sql_manager.connections), 2)
+
+    def test_break_stops_scheduling(self) -> None:
+        output = self.run_program(1, "abcdefgh")
+        self.assertIn("fake: Say b", output)
+        self.assertNotIn("fake: Say c", output)
+        # Nothing after the iteration that broke is started
+        self.assertEqual(self.llm.prompts, ["Say a\n", "Say b\n", "Say c\n"])
+
+
+
+class ClosingRunner(FakeRunner):
+    """
+    Records in the current directory which processes closed their runner.
+    """
+
+    def close(self) -> None:
+        with open(f"closed-{os.getpid()}", "w"):
+            pass
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cwd = os.getcwd()
+        os.chdir(directory.name)
+        self.addCleanup(os.chdir, cwd)
+
+    def test_workers_close_runners(self) -> None:
+        procedures = aicoding.parse_program(PARALLEL_PROGRAM.replace("WORKERS", "2"))
+        system = aicoding.System(procedures, None, None)  # type: ignore
+        system.compile_all()
+        with open("inputs.txt", "w") as f:
+            f.write("a\nb\nc\nd\n")
+        args = argparse.Namespace(
+            sql_statement_cache=128,
+            sql_wal=False,
+            replay=False,
+            procedure=None,
+            verbose=False,
+            stream=False,
+            max_llm_calls=None,
+        )
+        output = io.StringIO()
+        runner = lambda args: ClosingRunner("fake", filename="llm_data.db")
+        with mock.patch.object(aicoding, "make_llm_manager", runner):
+            with contextlib.redirect_stdout(output):
+                self.assertTrue(aicoding.run_batch(args, system.compiled_procedures, "inputs.txt", 2))
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([result["input"] for result in results], [f"inputs.txt:{idx}" for idx in range(1, 5)])
+        self.assertIn("fake: Say a", results[0]["output"])
+        # Both workers closed their runner when they exited
+        self.assertEqual(len([name for name in os.listdir(".") if name.startswith("closed-")]), 2)
+
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.server_directory = os.path.join(directory.name, "server")
+        self.client_directory = os.path.join(directory.name, "client")
+        os.mkdir(self.server_directory)
+        os.mkdir(self.client_directory)
+        cwd = os.getcwd()
+        os.chdir(self.server_directory)
+        self.addCleanup(os.chdir, cwd)
+
+        self.llm = FakeRunner("fake", filename="llm_data.db")
+        args = argparse.Namespace(
+            sql_statement_cache=128,
+            sql_wal=False,
+            replay=False,
+            no_cache=True,
+            serve_workers=2,
+            max_llm_calls=None,
+            verbose=False,
+            stream=False,
+        )
+        self.path = os.path.join(directory.name, "aicoding.sock")
+        stdout = mock.patch.object(sys, "stdout", aicoding.ThreadOutput(sys.stdout))
+        stdout.start()
+        self.addCleanup(stdout.stop)
+        with mock.patch.object(aicoding, "make_llm_manager", lambda args: self.llm):
+            self.server = aicoding.AicodingServer(self.path, args)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def send(self, line: bytes) -> list[dict]:
+        """
+        Sends one line to the server, returning its responses up to the one that ends the job.
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(self.path)
+            connection.sendall(line + b"\n")
+            responses = []
+            with connection.makefile("rb") as lines:
+                for response_line in lines:
+                    responses.append(json.loads(response_line))
+                    if "output" not in responses[-1]:
+                        return responses
+        return responses
+
+    def run_job(self, program: str, text: str = "") -> list[dict]:
+        request = {"program": program, "procedure": None, "input": text, "cwd": self.client_directory}
+        return self.send(json.dumps(request).encode())
+
+    def test_paths_relative_to_client(self) -> None:
+        program = '# main\n\n"out.txt"\n-> filename\n"written"\n/write\n"create table t(x)"\n/sql!\n'
+        self.assertEqual(self.run_job(program)[-1], {"done": True})
+        with open(os.path.join(self.client_directory, "out.txt")) as f:
+            self.assertEqual(f.read(), "written")
+        self.assertTrue(os.path.exists(os.path.join(self.client_directory, "data.db")))
+        self.assertFalse(os.path.exists(os.path.join(self.server_directory, "out.txt")))
+        self.assertFalse(os.path.exists(os.path.join(self.server_directory, "data.db")))
+
+    def test_malformed_job(self) -> None:
+        self.assertIn("error", self.send(b"{not json")[-1])
+        self.assertIn("error", self.send(b"[1, 2]")[-1])
+
+    def test_ask_fails(self) -> None:
+        # The server prints the traceback of a failing job
+        with contextlib.redirect_stderr(io.StringIO()):
+            responses = self.run_job('# main\n\nask {\n  What is your name? -> name\n}\n')
+        self.assertIn("ask", responses[-1]["error"])
+
+    def test_deleted_responses(self) -> None:
+        program = PARALLEL_PROGRAM.replace("WORKERS", "1")
+        self.assertEqual(self.run_job(program, "a")[-1], {"done": True})
+        self.assertEqual(self.run_job(program, "a")[-1], {"done": True})
+        self.assertEqual(self.llm.prompts, ["Say a\n"])
+        with contextlib.closing(sqlite3.connect("llm_data.db")) as connection:
+            connection.execute("update responses set deleted = 1")
+            connection.commit()
+        self.assertEqual(self.run_job(program, "a")[-1], {"done": True})
+        self.assertEqual(self.llm.prompts, ["Say a\n", "Say a\n"])
+
+
+VM_PROGRAM = """# main
+
+-> text
+""
+-> acc
+text ->
+for each {
+  -> line
+  case {
+    "skip" {
+      "skipped {line}"
+      /print
+    }
+    {
+      shout
+      "{acc}{out.word}."
+      -> acc
+    }
+  }
+}
+"create table if not exists words (word text, n integer)"
+/sql!
+"delete from words"
+/sql!
+"insert into words values (:acc, 1), ('second', 2)"
+/sql!
+"select word, n from words order by n"
+/sql {
+  "{n}: {word}"
+  /print
+}
+text ->
+for each para {
+  -> line
+  answer
+  /print
+}
+"done {acc}"
+
+# shout
+
+-> word
+"{word}!"
+-> word
+
+# answer
+
+Model: llama3.2
+
+## Prompt
+
+Say {line}
+"""
+VM_INPUT = "a\nskip\nb\n\nc"
+VM_OUTPUT = "skipped skip\n1: a!.b!.c!.\n2: second\nfake: Say a\nskip\nb\n\nfake: Say c\n\ndone a!.b!.c!.\n"
+
+
+class ProgramTestCase(unittest.TestCase):
+    """
+    Runs programs with a fake LLM, and databases in a temporary directory.
+    """
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.llm = FakeRunner("fake", filename=self.path("llm_data.db"))
+        self.sql_manager = aicoding.SQLManager(self.path("data.db"))
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def make_system(self, procedures: dict[str, aicoding.BaseProcedure] | None = None) -> aicoding.System:
+        if procedures is None:
+            procedures = aicoding.parse_program(VM_PROGRAM)
+        return aicoding.System(procedures, self.llm, self.sql_manager)
+
+    def run_system(self, system: aicoding.System, text: aicoding.Value = VM_INPUT, **kwargs) -> str:
+        system.set_value("prompt", text)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            system.begin(None, **kwargs)
+        return output.getvalue()
+
+
+class ProgramCacheTest(ProgramTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.cache = aicoding.ProgramCache(self.path("program_cache.db"))
+
+    def test_cached_program(self) -> None:
+        system = self.make_system()
+        system.compile_all()
+        self.cache.save(VM_PROGRAM, system.compiled_procedures)
+        self.assertEqual(self.run_system(system), VM_OUTPUT)
+
+        # The next run of the program opens the cache again
+        compiled = aicoding.ProgramCache(self.path("program_cache.db")).load(VM_PROGRAM)
+        assert compiled is not None
+        self.assertEqual(compiled.keys(), system.compiled_procedures.keys())
+        cached = self.make_system({})
+        cached.load_compiled(compiled)
+        self.assertEqual(self.run_system(cached), VM_OUTPUT)
+
+    def test_keyed_by_program_and_version(self) -> None:
+        system = self.make_system()
+        system.compile_all()
+        self.cache.save(VM_PROGRAM, system.compiled_procedures)
+        self.assertIsNone(self.cache.load(VM_PROGRAM + "\n# other\n\n/print\n"))
+        with mock.patch.object(aicoding, "INTERPRETER_VERSION", "0"):
+            self.assertIsNone(self.cache.load(VM_PROGRAM))
+        self.assertIsNotNone(self.cache.load(VM_PROGRAM))
+
+    def test_unreadable_entry(self) -> None:
+        self.cache.sql_manager.execute_sql_script(
+            f"insert into compiled_programs(program_hash, bytecode) "
+            f"values ('{self.cache.get_program_hash(VM_PROGRAM)}', x'00')"
+        )
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertIsNone(self.cache.load(VM_PROGRAM))
+
+    def test_clear(self) -> None:
+        system = self.make_system()
+        system.compile_all()
+        self.cache.save(VM_PROGRAM, system.compiled_procedures)
+        self.cache.clear()
+        self.assertIsNone(self.cache.load(VM_PROGRAM))
+
+    def test_evict_programs(self) -> None:
+        cache = aicoding.ProgramCache(self.path("small_cache.db"), keep_programs=2)
+        self.addCleanup(cache.sql_manager.close)
+        system = self.make_system()
+        system.compile_all()
+        programs = [VM_PROGRAM + f"\n# extra{idx}\n\n/print\n" for idx in range(3)]
+        for program in programs:
+            cache.save(program, system.compiled_procedures)
+        self.assertIsNone(cache.load(programs[0]))
+        self.assertIsNotNone(cache.load(programs[1]))
+        # Saving a program again makes it the newest
+        cache.save(programs[1], system.compiled_procedures)
+        cache.save(VM_PROGRAM, system.compiled_procedures)
+        self.assertIsNone(cache.load(programs[2]))
+        self.assertIsNotNone(cache.load(programs[1]))
+
+    def test_evict_sections(self) -> None:
+        self.cache.keep_sections = 3
+        self.run_sections(VM_PROGRAM)
+        # As if the first run was a while ago, rather than within the same second
+        self.cache.sql_manager.execute_sql_script("update program_sections set created_at = '2000-01-01 00:00:00'")
+        edited = VM_PROGRAM.replace('"{word}!"', '"{word}?"')
+        self.assertEqual(self.run_sections(edited)[0], ["shout"])
+        # The sections of the edited program are the newest, so the old shout section went
+        self.assertEqual(self.run_sections(VM_PROGRAM), (["shout"], VM_OUTPUT))
+        rows = self.cache.sql_manager.execute_sql(
+            "select count(*) as count from program_sections", True, aicoding.ValueGetter()
+        )
+        self.assertEqual([row["count"] for row in rows], [3])
+
+    def test_no_cache(self) -> None:
+        # A directory of its own, since setUp already made a cache in self.directory
+        directory = self.path("run")
+        os.mkdir(directory)
+        with open(os.path.join(directory, "workflow.md"), "w") as f:
+            f.write(VM_PROGRAM)
+        filename = os.path.join(directory, "program_cache.db")
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aicoding.py")
+
+        def run(*flags: str) -> str:
+            return subprocess.run(
+                [sys.executable, script, "--list", *flags], cwd=directory, check=True, capture_output=True, text=True
+            ).stdout
+
+        self.assertEqual(run("--no-cache"), "main\nshout\nanswer\n")
+        self.assertFalse(os.path.exists(filename))
+
+        cache = aicoding.ProgramCache(filename)
+        system = self.make_system()
+        system.compile_all()
+        cache.save(VM_PROGRAM, system.compiled_procedures)
+        cache.sql_manager.close()
+        run("--no-cache", "--clear-cache")
+        cache = aicoding.ProgramCache(filename)
+        self.addCleanup(cache.sql_manager.close)
+        self.assertIsNone(cache.load(VM_PROGRAM))
+
+    def run_sections(self, text: str) -> tuple[list[aicoding.ProgramSection], str]:
+        # As main does when the program as a whole isn't in the cache
+        sections = self.cache.load_sections(text)
+        assert sections is not None
+        system = self.make_system({section.name: section.procedure for section in sections})
+        new = [section.name for section in sections if section.is_new]
+        system.load_compiled(self.cache.compile_sections(sections, system))
+        return new, self.run_system(system)
+
+    def test_changed_section(self) -> None:
+        self.assertEqual(self.run_sections(VM_PROGRAM), (["main", "shout", "answer"], VM_OUTPUT))
+        self.assertEqual(self.run_sections(VM_PROGRAM), ([], VM_OUTPUT))
+
+        edited = VM_PROGRAM.replace('"{word}!"', '"{word}?"')
+        with mock.patch.object(aicoding, "parse_section", wraps=aicoding.parse_section) as parse_section:
+            new, output = self.run_sections(edited)
+        self.assertEqual(new, ["shout"])
+        self.assertEqual(parse_section.call_count, 1)
+        self.assertEqual(output, self.run_system(self.make_system(aicoding.parse_program(edited))))
+        self.assertIn("1: a?.b?.c?.", output)
+
+    def test_sections_need_whole_program(self) -> None:
+        # Text before the first procedure
+        self.assertIsNone(self.cache.load_sections("-> x\n" + VM_PROGRAM))
+        # Strings with a line that looks like a procedure header
+        for program in [
+            VM_PROGRAM.replace('"done {acc}"', '"done\n# {acc}"'),
+            VM_PROGRAM.replace('"skipped {line}"', '"skipped\n# {line}"'),
+        ]:
+            self.assertIsNone(self.cache.load_sections(program))
+            self.assertEqual(list(aicoding.parse_program(program)), ["main", "shout", "answer"])
+
+
+class VMTest(ProgramTestCase):
+    def test_link(self) -> None:
+        system = self.make_system()
+        system.compile_all()
+        compiled = {name: list(code) for name, code in system.compiled_procedures.items()}
+        system.link()
+        # The compiled bytecode, which the program cache saves, isn't changed
+        self.assertEqual(system.compiled_procedures, compiled)
+        for name, code in system.linked_procedures.items():
+            self.assertEqual(code[:-1], compiled[name])
+            self.assertIsInstance(code[-1], aicoding.ReturnFromProcedure)
+        main = system.linked_procedures["main"]
+        calls = [command for command in main if isinstance(command, aicoding.CallProcedureByName)]
+        self.assertEqual([call.name for call in calls], ["shout", "answer"])
+        for call in calls:
+            self.assertIs(call.target, system.linked_procedures[call.name])
+
+    def test_step(self) -> None:
+        system = self.make_system()
+        system.compile_all()
+        system.link()
+        system.set_var("prompt", VM_INPUT)
+        system.call_stack = [aicoding.Frame("main", system.linked_procedures["main"])]
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            steps = 0
+            while len(system.call_stack) > 0:
+                system.step()
+                steps += 1
+            print(system.get_var("prompt"))
+        self.assertEqual(output.getvalue(), VM_OUTPUT)
+        self.assertGreater(steps, 50)
+
+    def test_slots(self) -> None:
+        system = self.make_system()
+        system.compile_all()
+        frame = aicoding.Frame("main", system.compiled_procedures["main"])
+        self.assertFalse(hasattr(frame, "__dict__"))
+        for code in system.compiled_procedures.values():
+            for command in code:
+                if not isinstance(command, aicoding.LLMProcedure):
+                    self.assertFalse(hasattr(command, "__dict__"), command)
+
+    def test_undefined_procedure(self) -> None:
+        system = self.make_system(aicoding.parse_program("# main\n\nmissing\n"))
+        with self.assertRaises(KeyError):
+            self.run_system(system)
+
+
+class EnvironmentTest(unittest.TestCase):
+    def test_matches_stack(self) -> None:
+        # Compare with a plain stack of scopes, which is looked up from the top down
+        rng = random.Random(7)
+        names = ["prompt", "a", "b", "c"]
+        env = aicoding.Environment()
+        stack: list[dict[str, str]] = [{}]
+        for step in range(2000):
+            action = rng.random()
+            if action < 0.5:
+                name = rng.choice(names)
+                env.set(name, str(step))
+                stack[-1][name] = str(step)
+            elif action < 0.75 or len(stack) == 1:
+                env.push()
+                stack.append({})
+            else:
+                self.assertEqual(env.pop(), stack.pop())
+            self.assertEqual(len(env), len(stack))
+            for name in names:
+                expected = next((layer[name] for layer in reversed(stack) if name in layer), "")
+                self.assertEqual(env.get(name), expected)
+
+    def test_based_on(self) -> None:
+        env = aicoding.Environment.based_on({"a": "1", "b": "2"})
+        env.set("b", "3")
+        self.assertEqual((env.get("a"), env.get("b")), ("1", "3"))
+        # Only variables set in the environment are in its scope
+        self.assertEqual(env.layers, [{"b": "3"}])
+
+    def test_pop_env(self) -> None:
+        system = aicoding.System({}, None, None)  # type: ignore
+        system.set_var("x", "outer")
+        system.set_var("prompt", "input")
+        system.new_env()
+        self.assertEqual(system.get_var("prompt"), "input")
+        system.set_var("x", "inner")
+        system.set_var("y", "new")
+        system.set_var("prompt", "result")
+        system.pop_env()
+        # The prompt is passed back, and other variables are passed back as out.*
+        self.assertEqual(system.get_var("prompt"), "result")
+        self.assertEqual(system.get_var("x"), "outer")
+        self.assertEqual(system.get_var("y"), "")
+        self.assertEqual((system.get_var("out.x"), system.get_var("out.y")), ("inner", "new"))
+
+        system.new_env()
+        system.new_env()
+        system.set_var("z", "deep")
+        system.pop_env()
+        system.pop_env()
+        self.assertEqual(system.get_var("out.out.z"), "deep")
+        self.assertEqual(system.get_var("out.z"), "")
+
+
+class Interrupted(Exception):
+    pass
+
+
+class CheckpointTest(ProgramTestCase):
+    def run_interrupted(self, directory: str, text: str, interrupt_at: int) -> tuple[str, bool]:
+        """
+        Runs the program with a checkpoint every step, stopping it right after the checkpoint
+        numbered interrupt_at is saved, and then resumes it from the checkpoint like a new run of
+        the program would. Returns the output of both, and whether the run was interrupted.
+        """
+
+        def make_system() -> aicoding.System:
+            llm = FakeRunner("fake", filename=os.path.join(directory, "llm_data.db"))
+            sql_manager = aicoding.SQLManager(os.path.join(directory, "data.db"), wal=True)
+            return aicoding.System(aicoding.parse_program(VM_PROGRAM), llm, sql_manager)
+
+        def make_store() -> aicoding.CheckpointStore:
+            result = aicoding.CheckpointStore("program", None, "input", os.path.join(directory, "checkpoints.db"))
+            # Saving every step is slow when each one waits for the disk
+            result.sql_manager.connection.execute("pragma synchronous = OFF;")
+            return result
+
+        store = make_store()
+        saved = 0
+
+        def save(state: dict) -> None:
+            nonlocal saved
+            store.save(state)
+            saved += 1
+            if saved == interrupt_at:
+                raise Interrupted()
+
+        system = make_system()
+        system.set_value("prompt", text)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            try:
+                system.begin(None, 1, save)
+                return output.getvalue(), False
+            except Interrupted:
+                pass
+            state = make_store().load()
+            assert state is not None
+            make_system().resume(state)
+        return output.getvalue(), True
+
+    def test_resume(self) -> None:
+        # Long enough for the lines to be saved once and referred to by later checkpoints
+        long_input = "\n".join(f"line {idx} " + "x" * 100 for idx in range(50))
+        for text in [VM_INPUT, long_input]:
+            states: list[dict] = []
+            # In WAL mode the rows of /sql loops are fetched as they're needed
+            system = aicoding.System(
+                aicoding.parse_program(VM_PROGRAM), self.llm, aicoding.SQLManager(self.path("wal.db"), wal=True)
+            )
+            expected = self.run_system(system, text, checkpoint_every=1, save_checkpoint=states.append)
+            self.assertEqual(expected, self.run_system(self.make_system(), text))
+            iterators = {iterator["type"] for state in states for iterator in state["iterators"]}
+            self.assertEqual(iterators, {"items", "sql"})
+            for interrupt_at in range(1, len(states) + 1, max(1, len(states) // 10)):
+                with tempfile.TemporaryDirectory() as directory:
+                    output, interrupted = self.run_interrupted(directory, text, interrupt_at)
+                self.assertTrue(interrupted)
+                self.assertEqual(output, expected, f"interrupted at checkpoint {interrupt_at}")
+
+    def test_stored_values(self) -> None:
+        system = self.make_system()
+        system.compile_all()
+        system.link()
+        system.set_value("prompt", "x" * 10000)
+        system.call_stack = [aicoding.Frame("main", system.linked_procedures["main"])]
+        first = system.get_state()
+        second = system.get_state()
+        self.assertEqual(len(first["values"]), 1)
+        # The value saved by the first state is referred to by the second
+        self.assertEqual(second["values"], {})
+        self.assertEqual(second["env"], first["env"])
+
+        store = aicoding.CheckpointStore("program", None, "input", self.path("checkpoints.db"))
+        store.save(first)
+        store.save(second)
+        resumed = self.make_system()
+        resumed.compile_all()
+        resumed.link()
+        resumed.set_state(store.load())
+        self.assertEqual(resumed.get_var("prompt"), "x" * 10000)
+
+    def test_runs(self) -> None:
+        filename = self.path("checkpoints.db")
+        store = aicoding.CheckpointStore("program", None, "input", filename)
+        store.save({"call_stack": [], "values": {}})
+        other = aicoding.CheckpointStore("program", "shout", "other input", filename)
+        self.assertIsNone(other.load())
+        self.assertEqual(other.other_runs(), [("", "input")])
+        self.assertIsNone(aicoding.CheckpointStore("other program", None, "input", filename).load())
+        store.clear()
+        self.assertIsNone(store.load())
+        self.assertEqual(other.other_runs(), [])
+
+    def test_version(self) -> None:
+        system = self.make_system()
+        system.compile_all()
+        system.link()
+        state = system.get_state()
+        state["version"] = "0"
+        with self.assertRaises(RuntimeError):
+            system.set_state(state)
+
+
+SQL_LOOP_PROGRAM = """# main
+
+"create table t (n integer)"
+/sql!
+"insert into t values (1), (2), (3)"
+/sql!
+"select n from t"
+/sql {
+  "insert into t values (:n + 10)"
+  /sql!
+  n ->
+  case {
+    "BREAK" {
+      /break
+    }
+  }
+}
+"select count(*) as c from t"
+/sql {
+  "{c}"
+}
+"""
+
+
+class SQLRowIteratorTest(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.manager = aicoding.SQLManager(os.path.join(self.directory, "data.db"), wal=True)
+        self.addCleanup(self.manager.close)
+        rows = ", ".join(f"({idx}, 'row {idx}')" for idx in range(1000))
+        self.manager.execute_sql_script(f"create table t (n integer, name text); insert into t values {rows};")
+        self.query = "select n, name from t where n >= :low order by n"
+        self.get_value = aicoding.ValueGetter(low="10")
+
+    def read_all(self, rows: aicoding.SQLRowIterator) -> list[dict[str, str]]:
+        result = []
+        while len(rows) > 0:
+            result.append(rows.popleft())
+        return result
+
+    def test_rows_match_fetchall(self) -> None:
+        expected = list(self.manager.execute_sql(self.query, True, self.get_value))
+        self.assertEqual(len(expected), 990)
+        rows = self.manager.open_query(self.query, self.get_value)
+        assert rows is not None
+        len(rows)
+        # Rows are fetched a chunk at a time
+        self.assertEqual(len(rows.ready), rows.chunk_size)
+        self.assertEqual(self.read_all(rows), expected)
+        self.assertEqual(rows.consumed, 990)
+        self.assertTrue(rows.exhausted)
+
+    def test_skip(self) -> None:
+        expected = list(self.manager.execute_sql(self.query, True, self.get_value))
+        rows = self.manager.open_query(self.query, self.get_value, skip=300)
+        assert rows is not None
+        self.assertEqual(self.read_all(rows), expected[300:])
+
+    def test_close(self) -> None:
+        rows = self.manager.open_query(self.query, self.get_value)
+        assert rows is not None
+        rows.popleft()
+        rows.close()
+        self.assertEqual(len(rows), 0)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            rows.connection.execute("select 1")
+
+    def test_needs_wal(self) -> None:
+        self.assertIsNone(aicoding.SQLManager(":memory:").open_query("select 1", None))
+        manager = aicoding.SQLManager(os.path.join(self.directory, "other.db"))
+        self.addCleanup(manager.close)
+        self.assertIsNone(manager.open_query("select 1", None))
+
+    def test_writes_in_loop(self) -> None:
+        # The loop goes over the rows as they were when it started, in both modes
+        for wal in [False, True]:
+            manager = aicoding.SQLManager(os.path.join(self.directory, f"loop-{wal}.db"), wal=wal)
+            self.addCleanup(manager.close)
+            for program in [SQL_LOOP_PROGRAM, SQL_LOOP_PROGRAM.replace("BREAK", "2")]:
+                list(manager.execute_sql("drop table if exists t", False, None))
+                system = aicoding.System(aicoding.parse_program(program), None, manager)  # type: ignore
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    system.begin(None)
+                self.assertEqual(output.getvalue(), "6\n" if program == SQL_LOOP_PROGRAM else "5\n")
+                self.assertEqual(system.iterators, [])
+
+
+MAPPED_TEXTS = [
+    VM_INPUT,
+    "one\ntwo  \n\n  three\n",
+    "windows\r\nline\r\n\r\npara\r\n",
+    "old mac\rline\r\rpara",
+    "mixed\r\nends\rhere\n\n\n\nlast",
+    "caf\u00e9\n\u65e5\u672c\n",
+]
+
+
+class MappedTextTest(ProgramTestCase):
+    def write(self, text: str, name: str = "input.txt") -> str:
+        path = self.path(name)
+        with open(path, "wb") as f:
+            f.write(text.encode())
+        return path
+
+    def read_lines(self, iterator: aicoding.MappedLineIterator) -> list[str]:
+        result = []
+        while len(iterator) > 0:
+            result.append(iterator.popleft())
+        return result
+
+    def test_lines(self) -> None:
+        for text in MAPPED_TEXTS:
+            mapped = aicoding.MappedText(self.write(text))
+            translated = text.replace("\r\n", "\n").replace("\r", "\n")
+            self.assertEqual(str(mapped), translated)
+            for separator in ["\n", "\n\n"]:
+                # The same lines as looping over the text read into a str
+                expected = [line.strip() for line in translated.split(separator) if line.strip() != ""]
+                self.assertEqual(self.read_lines(aicoding.MappedLineIterator(mapped, separator)), expected, text)
+
+    def test_position(self) -> None:
+        for text in MAPPED_TEXTS:
+            mapped = aicoding.MappedText(self.write(text))
+            lines = self.read_lines(aicoding.MappedLineIterator(mapped, "\n"))
+            for used in range(len(lines)):
+                iterator = aicoding.MappedLineIterator(mapped, "\n")
+                for _ in range(used):
+                    iterator.popleft()
+                # Checking for the next line reads it, but it hasn't been used yet
+                len(iterator)
+                rest = aicoding.MappedLineIterator(mapped, "\n", iterator.unused_position())
+                self.assertEqual(self.read_lines(rest), lines[used:])
+
+    def test_program(self) -> None:
+        for text in MAPPED_TEXTS:
+            # As the text would be read into a str, from a file opened in text mode
+            translated = text.replace("\r\n", "\n").replace("\r", "\n")
+            expected = self.run_system(self.make_system(), translated)
+            value = aicoding.read_file(self.write(text))
+            self.assertIsInstance(value, aicoding.MappedText)
+            self.assertEqual(self.run_system(self.make_system(), value), expected)
+
+    def test_read(self) -> None:
+        self.write(VM_INPUT, "read.txt")
+        program = VM_PROGRAM.replace("-> text\n", '"read.txt"\n-> filename\n/read\n-> text\n', 1)
+        system = self.make_system(aicoding.parse_program(program))
+        system.directory = self.directory
+        self.assertEqual(self.run_system(system, ""), VM_OUTPUT)
+
+    def test_empty_file(self) -> None:
+        self.assertEqual(aicoding.read_file(self.write("")), "")
+
+
+ACCUMULATE_PROGRAM = """# main
+
+-> text
+""
+-> acc
+text ->
+for each {
+  -> line
+  "{acc}<{line}>"
+  -> acc
+}
+"{acc}"
+/write
+acc ->
+"""
+
+
+class RopeTextTest(ProgramTestCase):
+    def test_append(self) -> None:
+        start = aicoding.RopeText(["a"], 1)
+        first = start.append(["b", "c"])
+        # Appending to text that's already been appended to copies the pieces it uses
+        second = start.append(["d"])
+        self.assertIs(first.chunks, start.chunks)
+        self.assertIsNot(second.chunks, start.chunks)
+        self.assertEqual((str(start), str(first), str(second)), ("a", "abc", "ad"))
+        self.assertEqual(str(first.append(["e"])), "abce")
+
+    def test_threads(self) -> None:
+        start = aicoding.RopeText(["start"], 1)
+        results: list[tuple[str, aicoding.RopeText]] = []
+
+        def append(name: str) -> None:
+            text = start
+            for idx in range(200):
+                text = text.append([f" {name}{idx}"])
+            results.append((name, text))
+
+        threads = [threading.Thread(target=append, args=(name,)) for name in "abcd"]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for name, text in results:
+            self.assertEqual(str(text), "start" + "".join(f" {name}{idx}" for idx in range(200)))
+
+    def run_accumulate(self, min_length: int, lines: list[str]) -> str:
+        system = self.make_system(aicoding.parse_program(ACCUMULATE_PROGRAM))
+        system.set_var("filename", self.path("acc.txt"))
+        with mock.patch.object(aicoding, "ROPE_MIN_LENGTH", min_length):
+            output = self.run_system(system, "\n".join(lines))
+        # Ropes are only kept while accumulating
+        self.assertEqual(isinstance(system.get_value("acc"), aicoding.RopeText), min_length < 10**9)
+        with open(self.path("acc.txt")) as f:
+            self.assertEqual(f.read() + "\n", output)
+        return output
+
+    def test_accumulate(self) -> None:
+        lines = [f"line {idx}" for idx in range(5000)]
+        expected = "".join(f"<{line}>" for line in lines) + "\n"
+        self.assertEqual(self.run_accumulate(10**9, lines), expected)
+        self.assertEqual(self.run_accumulate(1, lines), expected)
+        self.assertEqual(self.run_accumulate(aicoding.ROPE_MIN_LENGTH, lines), expected)
+
+    def test_consumers(self) -> None:
+        # The accumulated text is passed to SQL, an LLM and printed as a str
+        with mock.patch.object(aicoding, "ROPE_MIN_LENGTH", 1):
+            self.assertEqual(self.run_system(self.make_system()), VM_OUTPUT)
+
+
+class CountingCursor:
+    def __init__(self, cursor: sqlite3.Cursor) -> None:
+        self.cursor = cursor
+        self.executes = 0
+
+    def execute(self, query: str, data: dict) -> sqlite3.Cursor:
+        self.executes += 1
+        return self.cursor.execute(query, data)
+
+
+class SQLManagerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.manager = aicoding.SQLManager(os.path.join(directory.name, "data.db"))
+        self.manager.debug_errors = False
+        self.addCleanup(self.manager.close)
+        self.query = "select :a || :b || :a || :c as x"
+        self.get_value = aicoding.ValueGetter(a="1", b="2", c="3")
+
+    def execute(self, query: str) -> tuple[dict[str, str], int]:
+        cursor = CountingCursor(self.manager.connection.cursor())
+        data = self.manager._execute(self.manager.connection, cursor, query, self.get_value)  # type: ignore
+        self.assertEqual(cursor.cursor.fetchall(), [("1213",)])
+        return data, cursor.executes
+
+    def test_param_names(self) -> None:
+        # The first run finds the parameters one at a time, later runs bind them all at once
+        self.assertEqual(self.execute(self.query), ({"a": "1", "b": "2", "c": "3"}, 4))
+        self.assertEqual(sorted(self.manager.param_names[self.query]), ["a", "b", "c"])
+        self.assertEqual(self.execute(self.query), ({"a": "1", "b": "2", "c": "3"}, 1))
+        self.assertEqual(list(self.manager.execute_sql(self.query, True, self.get_value)), [{"x": "1213"}])
+
+    def test_stale_param_names(self) -> None:
+        self.manager.param_names[self.query] = ["a", "d"]
+        # Like System.get_var, variables that aren't set are empty
+        self.get_value = lambda name: {"a": "1", "b": "2", "c": "3"}.get(name, "")
+        self.assertEqual(self.execute(self.query)[0], {"a": "1", "b": "2", "c": "3"})
+        self.assertEqual(sorted(self.manager.param_names[self.query]), ["a", "b", "c"])
+
+    def test_read_only(self) -> None:
+        for manager in [self.manager, aicoding.SQLManager(":memory:")]:
+            manager.debug_errors = False
+            manager.execute_sql_script("create table t (x text);")
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                with self.assertRaises(sqlite3.OperationalError):
+                    list(manager.execute_sql("insert into t values ('a')", True, None))
+            list(manager.execute_sql("insert into t values ('b')", False, None))
+            self.assertEqual(list(manager.execute_sql("select x from t", True, None)), [{"x": "b"}])
+            manager.close()
+
+    def test_reads_see_writes(self) -> None:
+        self.manager.execute_sql_script("create table t (x text);")
+        for value in ["a", "b", "c"]:
+            list(self.manager.execute_sql("insert into t values (:value)", False, aicoding.ValueGetter(value=value)))
+            rows = list(self.manager.execute_sql("select count(*) as n from t", True, None))
+            self.assertEqual(rows, [{"n": "abc".index(value) + 1}])
+
+
+class ProfilerTest(ProgramTestCase):
+    def run_profiled(
+        self, llm: FakeRunner, program: str = VM_PROGRAM, text: str = VM_INPUT
+    ) -> tuple[aicoding.Profiler, str]:
+        # As main does with --profile
+        profiler = aicoding.Profiler()
+        llm.profiler = profiler
+        llm.sql_manager.profiler = profiler
+        self.sql_manager.profiler = profiler
+        system = aicoding.System(aicoding.parse_program(program), llm, self.sql_manager)
+        return profiler, self.run_system(system, text, profiler=profiler)
+
+    def counts(self, table: dict[str, dict]) -> dict[str, int]:
+        return {key: value["count"] for key, value in table.items()}
+
+    def test_report(self) -> None:
+        profiler, output = self.run_profiled(self.llm)
+        self.assertEqual(output, VM_OUTPUT)
+        report = profiler.report()
+        self.assertEqual(self.counts(report["procedures"]), {"main": 1, "shout": 3, "answer": 2})
+        # Every step is counted once
+        system = self.make_system()
+        system.compile_all()
+        system.link()
+        system.set_var("prompt", VM_INPUT)
+        system.call_stack = [aicoding.Frame("main", system.linked_procedures["main"])]
+        steps = 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            while len(system.call_stack) > 0:
+                system.step()
+                steps += 1
+        self.assertEqual(sum(self.counts(report["bytecodes"]).values()), steps)
+        self.assertEqual(report["bytecodes"]["CallProcedureByName"]["count"], 5)
+        self.assertEqual(self.counts(report["llm"]), {"miss": 2})
+        self.assertEqual(report["sql"]["select word, n from words order by n"]["count"], 1)
+        self.assertIn("run", report["phases"])
+
+        # Answered from the in memory cache, and from the database by a new manager
+        self.assertEqual(self.counts(self.run_profiled(self.llm)[0].report()["llm"]), {"memory_hit": 2})
+        other = FakeRunner("fake", filename=self.path("llm_data.db"))
+        self.assertEqual(self.counts(self.run_profiled(other)[0].report()["llm"]), {"db_hit": 2})
+        self.assertEqual(other.prompts, [])
+
+    def test_stacks(self) -> None:
+        profiler = self.run_profiled(self.llm)[0]
+        self.assertIn("main;shout;FormatString", profiler.stacks)
+        self.assertIn("main;answer;LLMProcedure", profiler.stacks)
+        self.assertAlmostEqual(
+            sum(profiler.stacks.values()), sum(seconds for _, seconds in profiler.bytecodes.values())
+        )
+        path = self.path("profile.json")
+        profiler.write(path)
+        with open(path) as f:
+            self.assertEqual(json.load(f)["procedures"].keys(), profiler.procedures.keys())
+        with open(f"{path}.folded") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), len(profiler.stacks))
+        for line in lines:
+            stack, microseconds = line.rsplit(" ", 1)
+            self.assertIn(stack, profiler.stacks)
+            self.assertGreaterEqual(int(microseconds), 0)
+
+    def test_parallel(self) -> None:
+        profiler, _ = self.run_profiled(self.llm, PARALLEL_PROGRAM.replace("WORKERS", "3"), "x\ny\nz\nw")
+        report = profiler.report()
+        # The iterations run inside main, which is only timed once
+        self.assertEqual(self.counts(report["procedures"]), {"main": 1, "answer": 4})
+        self.assertEqual(report["bytecodes"]["LLMProcedure"]["count"], 4)
+        self.assertEqual(self.counts(report["llm"]), {"miss": 4})
+
+    def test_off(self) -> None:
+        system = self.make_system()
+        self.assertEqual(self.run_system(system), VM_OUTPUT)
+        self.assertIsNone(system.profiler)
+        self.assertIsNone(self.sql_manager.profiler)
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_programs(self) -> None:
+        procedures = aicoding.parse_program(aicoding_bench.make_program(3))
+        self.assertEqual(list(procedures), ["procedure 0", "procedure 1", "procedure 2"])
+        nested = aicoding.parse_program(aicoding_bench.make_nested_program(2, 4))
+        self.assertEqual(list(nested), ["nested 0", "nested 1"])
+        system = aicoding.System(nested, None, None)  # type: ignore
+        system.compile_all()
+        # Each level of nesting has a loop
+        code = system.compiled_procedures["nested 0"]
+        loops = [command for command in code if isinstance(command, aicoding.AddLineIterator)]
+        self.assertEqual(len(loops), 4)
+
+    def test_vm(self) -> None:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = aicoding_bench.bench_vm(100, 1)
+        system = aicoding_bench.make_loop_system(100)
+        with contextlib.redirect_stdout(io.StringIO()):
+            system.run()
+        self.assertEqual(system.get_var("prompt"), "line 99!")
+        self.assertEqual(result["lines"], 100)
+        self.assertGreater(result["steps"], 100)
+
+    def test_llm(self) -> None:
+        questions = [aicoding_bench.make_question(idx) for idx in range(100)]
+        # Prompts that only differ in their digits would share a response
+        self.assertEqual(len(set(questions)), 100)
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = aicoding_bench.bench_llm(30)
+        self.assertEqual(result["db_hit"]["calls"], 30)
+        self.assertEqual(result["memory_hit"]["calls"], 30)
+
+    def test_json(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "bench.json")
+            subprocess.run(
+                [
+                    sys.executable,
+                    os.path.join(os.path.dirname(os.path.abspath(__file__)), "aicoding_bench.py"),
+                    "--sizes=1,2",
+                    "--depths=1",
+                    "--nested-procedures=2",
+                    "--repeats=1",
+                    "--vm-lines=10",
+                    "--llm-prompts=5",
+                    f"--output={output}",
+                ],
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            with open(output) as f:
+                results = json.load(f)
+        self.assertEqual(list(results), ["parse", "nesting", "vm", "llm"])
+        self.assertEqual([entry["procedures"] for entry in results["parse"]], ["1", "2"])
+        self.assertEqual(results["llm"]["db_hit"]["calls"], 5)
+
+
+if __name__ == "__main__":
+    unittest.main()